@@ -0,0 +1,62 @@
+# Micro-benchmark for broker worker and request bookkeeping
+#
+# Registers N idle workers on one service, then times dispatching N
+# requests and deleting workers from the middle of the waiting queue.
+# Per-operation cost should stay flat as N grows.
+#
+# Usage: python benchmarks/bench_dispatch.py [N ...]
+
+import sys
+import time
+
+from mdbase.broker import MajorDomoBroker
+
+
+def setup(count):
+    """Broker with count idle workers on a single service"""
+    broker = MajorDomoBroker()
+    broker.socket.send_multipart = lambda msg: None
+    service = broker.require_service(b"bench")
+    workers = []
+    for i in range(count):
+        worker = broker.require_worker(b"worker-%d" % i)
+        worker.service = service
+        broker.worker_waiting(worker)
+        workers.append(worker)
+    return broker, service, workers
+
+
+def bench_dispatch(count):
+    broker, service, workers = setup(count)
+    start = time.time()
+    for i in range(count):
+        broker.dispatch(service, [b"client", b"", b"body"])
+    elapsed = time.time() - start
+    broker.destroy()
+    return elapsed
+
+
+def bench_delete(count):
+    broker, service, workers = setup(count)
+    # delete from the middle outwards, worst case for list.remove
+    middle = workers[count // 4:3 * count // 4]
+    start = time.time()
+    for worker in middle:
+        broker.delete_worker(worker, False)
+    elapsed = time.time() - start
+    broker.destroy()
+    return elapsed, len(middle)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    print("%10s %18s %18s" % ("workers", "dispatch us/op", "delete us/op"))
+    for count in sizes:
+        dispatch = bench_dispatch(count)
+        delete, deleted = bench_delete(count)
+        print("%10d %18.2f %18.2f" % (
+            count, 1e6 * dispatch / count, 1e6 * delete / deleted
+        ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# Benchmark for sharded broker throughput
+#
+# Runs a plain broker, then sharded brokers with 1, 2 and 4 shards,
+# each with one echo worker process per service and client processes
+# keeping a window of requests in flight, spread over the services.
+# Sharded brokers run twice: with plain clients and workers on the
+# public endpoint, forwarded by the shard front, and with clients and
+# workers that ask the front for the shard endpoints and go to their
+# shards directly. Reports replies per second.
+#
+# Shards, workers and clients are all processes, so measured throughput
+# can only scale with shards while there are cores to spare for them.
+# To show how far it could scale where there are, the benchmark also
+# reads each broker side process's CPU time from /proc (Linux only):
+# busy is the CPU time per reply of the busiest one, the front or a
+# shard, and ceiling the replies per second it allows once every
+# process has a core of its own. Spreading services over more shards
+# lowers busy for direct peers, while everything forwarded still costs
+# the front its share.
+#
+# Usage: python benchmarks/bench_shard.py [seconds [shards ...]]
+
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import zmq
+
+from mdbase.broker import MajorDomoBroker
+from mdbase.client import MajorDomoClient
+from mdbase.shard import (ShardedBroker, resolve_shards, shard_endpoint,
+                          shard_for)
+from mdbase.worker import MajorDomoWorker
+
+ENDPOINT = "tcp://127.0.0.1:5571"
+SERVICES = [b"echo-%d" % i for i in range(8)]
+CLIENTS = 4
+WINDOW = 100 # Requests each client keeps in flight
+TICK = 1.0 / os.sysconf("SC_CLK_TCK")
+
+
+def run_broker(shards):
+    if shards:
+        sharded = ShardedBroker(shards, batch_size=64)
+        parent = os.getpid()
+
+        def stop(signum, frame):
+            # Take the shard processes down with us, they inherit this
+            if os.getpid() == parent:
+                for process in sharded.processes:
+                    process.terminate()
+                for process in sharded.processes:
+                    process.join() # Free their ports for the next run
+            os._exit(0)
+        signal.signal(signal.SIGTERM, stop)
+        sharded.run(ENDPOINT)
+    else:
+        broker = MajorDomoBroker(batch_size=64)
+        broker.bind(ENDPOINT)
+        broker.mediate()
+
+
+def endpoints(direct):
+    """Broker endpoints, in shard order"""
+    return resolve_shards(ENDPOINT) if direct else [ENDPOINT]
+
+
+def run_worker(direct, service):
+    endpoint = shard_endpoint(endpoints(direct), service)
+    worker = MajorDomoWorker(endpoint, service, credit=WINDOW)
+    reply = None
+    while True:
+        reply = worker.recv(reply)
+
+
+def run_client(direct, index, seconds, replies):
+    ctx = zmq.Context()
+    clients = [MajorDomoClient(endpoint, ctx=ctx)
+               for endpoint in endpoints(direct)]
+    by_socket = dict((client.client, client) for client in clients)
+    poller = zmq.Poller()
+    for client in clients:
+        poller.register(client.client, zmq.POLLIN)
+
+    def send(sent):
+        service = SERVICES[(index + sent) % len(SERVICES)]
+        clients[shard_for(service, len(clients))].send(service, b"hello")
+
+    sent = received = 0
+    for i in range(WINDOW):
+        send(sent)
+        sent += 1
+    start = time.time()
+    end = start + seconds
+    while time.time() < end:
+        items = poller.poll(5000)
+        if not items:
+            break
+        for socket, event in items:
+            by_socket[socket].recv()
+            if time.time() > start + 1: # Don't count warm up
+                received += 1
+            send(sent)
+            sent += 1
+    replies.put(received)
+
+
+def cpu_times(pid):
+    """CPU seconds used by pid and each of its children, by pid"""
+    times = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as f:
+                fields = f.read().rpartition(")")[2].split()
+        except IOError:
+            continue # Gone
+        if int(name) == pid or int(fields[1]) == pid:
+            times[int(name)] = TICK * (int(fields[11]) + int(fields[12]))
+    return times
+
+
+def bench(shards, direct, seconds):
+    # The broker starts shard processes, so it can't be a daemon
+    broker = multiprocessing.Process(target=run_broker, args=(shards,))
+    broker.start()
+    time.sleep(0.5)
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(direct, service))
+        for service in SERVICES
+    ]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    time.sleep(1)
+
+    replies = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(
+            target=run_client, args=(direct, i, seconds + 1, replies)
+        )
+        for i in range(CLIENTS)
+    ]
+    for client in clients:
+        client.start()
+    time.sleep(1) # Warm up, as the clients do
+    before = cpu_times(broker.pid)
+    total = sum(replies.get() for client in clients)
+    after = cpu_times(broker.pid)
+    for client in clients:
+        client.join()
+    for process in processes + [broker]:
+        process.terminate()
+        process.join()
+    busy = max(after[pid] - before.get(pid, 0.0) for pid in after)
+    return (total / float(seconds), 1e6 * busy / max(total, 1),
+            total / busy if busy else 0.0)
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4]
+    print("%d cores, %d services, %d clients x %d in flight" % (
+        multiprocessing.cpu_count(), len(SERVICES), CLIENTS, WINDOW
+    ))
+    print("%10s %8s %12s %10s %12s" % (
+        "shards", "peers", "replies/s", "busy us", "ceiling/s"
+    ))
+    print("%10s %8s %12d %10.1f %12d" % (("none", "-") + bench(0, False,
+                                                               seconds)))
+    for shards in counts:
+        for direct in (False, True):
+            print("%10d %8s %12d %10.1f %12d" % (
+                (shards, "direct" if direct else "front") +
+                bench(shards, direct, seconds)
+            ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Benchmark for Titanic request intake under each sync mode
+#
+# Stores N requests from T threads, as Titanic's titanic.request
+# workers do, and reports requests per second and the latency of each
+# store call. Run it on the disk Titanic will use, fsync cost is what's
+# being measured.
+#
+# Usage: python benchmarks/bench_titanic_store.py [N [T [directory]]]
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from uuid import uuid4
+
+from mdbase.titanic_store import FileStore, SegmentStore, SYNC_MODES
+
+
+def bench(store_class, sync, count, threads, directory):
+    path = tempfile.mkdtemp(dir=directory)
+    store = store_class(path, sync=sync)
+    request = [b"echo", b"x" * 200]
+    latencies = []
+
+    def intake(n):
+        mine = []
+        for i in range(n):
+            uuid = uuid4().hex.encode("ascii")
+            start = time.time()
+            store.store_request(uuid, request)
+            mine.append(time.time() - start)
+        latencies.extend(mine)
+
+    runners = [
+        threading.Thread(target=intake, args=(count // threads,))
+        for i in range(threads)
+    ]
+    start = time.time()
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+    elapsed = time.time() - start
+    store.close()
+    shutil.rmtree(path)
+
+    latencies.sort()
+    return (
+        len(latencies) / elapsed,
+        1e3 * latencies[len(latencies) // 2],
+        1e3 * latencies[int(len(latencies) * 0.99)],
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    directory = sys.argv[3] if len(sys.argv) > 3 else "."
+    print("%d requests from %d threads" % (count, threads))
+    print("%14s %8s %12s %10s %10s" % (
+        "store", "sync", "requests/s", "p50 ms", "p99 ms"
+    ))
+    for store_class in (SegmentStore, FileStore):
+        for sync in SYNC_MODES:
+            rate, p50, p99 = bench(
+                store_class, sync, count, threads, directory
+            )
+            print("%14s %8s %12d %10.3f %10.3f" % (
+                store_class.__name__, sync, rate, p50, p99
+            ))
+
+if __name__ == "__main__":
+    main()
@@ -6,42 +6,420 @@
 # Based on Java exmple by Arkadiusz Orzechowski
 # Copyright (c) 2010-2011 iMatix Corporation and Contributors
 
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import struct
 import sys
 import time
 
 from binascii import hexlify
+from collections import deque, OrderedDict
 
 import zmq
 
-from mdbase.constants import (C_CLIENT, W_WORKER, W_REQUEST, W_READY,
-                       W_REPLY, W_DISCONNECT, W_HEARTBEAT)
+from mdbase.codec import (frame_bytes, recv_frames, pack_properties,
+                          unpack_properties, properties_deadline)
+from mdbase.constants import (C_CLIENT, C_CLIENT_EXT, C_STATUS, REJECTED,
+                              EXPIRED, W_WORKER, W_REQUEST, W_READY, W_REPLY,
+                              W_DISCONNECT, W_HEARTBEAT)
+from mdbase.stats import ServiceStats
 from mdbase.utils import dump
 
 log = logging.getLogger(__name__)
 
+# Broker timer events
+T_HEARTBEAT = 0
+T_EXPIRY = 1
+
 class Service(object):
     """A single service"""
-    name = None # Service name
-    requests = None # List of client requests
-    waiting = None # List of waiting workers
+    __slots__ = (
+        'name', # Service name
+        'requests', # Client requests, in priority lanes
+        'waiting', # Workers with free credit, most free then longest idle
+        'workers', # All workers, by identity
+        'stats', # Counters and latency histograms
+        'queued_bytes', # Body bytes of queued and following requests
+        'following', # Requests waiting on an identical one's reply
+        'max_requests', # Max queued requests, None for no limit
+        'max_bytes', # Max queued body bytes, None for no limit
+        'ring', # HashRing of workers for keyed requests, built on first use
+        'flights', # Requests waiting on an identical one, by body digest,
+                   # None unless the service is idempotent
+        'deadline', # No queued or following request expires before this,
+                    # None if none has a deadline
+    )
 
-    def __init__(self, name):
+    def __init__(self, name, max_requests=None, max_bytes=None, lanes=1,
+                 default_lane=0, weights=None):
         self.name = name
-        self.requests = []
-        self.waiting = []
+        self.requests = RequestQueue(lanes, default_lane, weights)
+        self.waiting = WorkerQueue()
+        self.workers = {}
+        self.stats = ServiceStats(lanes)
+        self.queued_bytes = 0
+        self.following = 0
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.ring = None
+        self.flights = None
+        self.deadline = None
+
+    def oldest_age(self, now=None):
+        """Seconds the oldest queued request has been waiting"""
+        if not self.requests:
+            return 0
+        if now is None:
+            now = time.time()
+        return now - self.requests.oldest().queued_at
+
+class Request(object):
+    """A client request queued for a service"""
+    __slots__ = (
+        'msg', # Client return envelope and body
+        'properties', # Request properties, None for plain MDP clients
+        'size', # Body bytes
+        'queued_at', # When the request was queued
+        'deadline', # When the client gives up on a reply, or None
+        'lane', # Priority lane it's queued in
+        'key', # Routing key for worker affinity, or None
+        'digest', # Body digest while it leads a flight, or None
+    )
+
+    def __init__(self, msg, properties=None):
+        self.msg = msg
+        self.properties = properties
+        self.size = sum(len(frame) for frame in msg[2:])
+        self.queued_at = time.time()
+        self.deadline = properties_deadline(properties, self.queued_at)
+        self.lane = None
+        self.key = properties.get(b"key") if properties else None
+        self.digest = None
+
+    def expired(self, now):
+        """Has the client given up on this request"""
+        return self.deadline is not None and self.deadline <= now
+
+    def body_digest(self):
+        """Digest of the body frames, identical requests share it"""
+        digest = hashlib.sha1()
+        for frame in self.msg[2:]:
+            digest.update(struct.pack(">I", len(frame)))
+            digest.update(frame)
+        return digest.digest()
+
+    def worker_msg(self, now):
+        """Return envelope, with any properties, and body for the worker
+
+        The timeout property is cut down to the msecs the client has
+        left from now, which goes in the dispatched property for the
+        worker to count time the request waits there. A flight leader
+        carries its digest for the broker to find the flight when the
+        reply comes back.
+        """
+        properties = self.properties
+        if self.deadline is not None or self.digest is not None:
+            properties = dict(properties or ())
+            if self.deadline is not None:
+                properties[b"timeout"] = \
+                    b"%d" % (1e3 * (self.deadline - now))
+                properties[b"dispatched"] = b"%d" % (1e3 * now)
+            if self.digest is not None:
+                properties[b"flight"] = self.digest
+        if not properties:
+            return self.msg
+        return [self.msg[0]] + pack_properties(properties) + self.msg[1:]
+
+class RequestQueue(object):
+    """Requests queued for a service, in priority lanes
+
+    Lane 0 has the highest priority, and clients pick a lane with the
+    priority request property. Without weights, requests are taken from
+    the highest priority lane that has any. With weights, lanes that
+    have requests share dispatches in proportion to their weights,
+    smoothly interleaved, so low priority lanes aren't starved.
+    """
+    __slots__ = (
+        'lanes', # Requests per lane, oldest first
+        'default', # Lane for requests without a valid priority
+        'weights', # Dispatch share per lane, None for strict priority
+        'current', # Weighted round robin credit per lane
+        'size', # Requests queued in all lanes
+    )
+
+    def __init__(self, lanes=1, default=0, weights=None):
+        assert 0 <= default < lanes
+        assert weights is None or len(weights) == lanes
+        self.lanes = [deque() for i in range(lanes)]
+        self.default = default
+        self.weights = weights
+        self.current = [0] * lanes
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def lane(self, properties):
+        """Lane for a request with properties"""
+        if properties and b"priority" in properties:
+            try:
+                priority = int(properties[b"priority"])
+            except ValueError:
+                return self.default
+            return min(max(priority, 0), len(self.lanes) - 1)
+        return self.default
+
+    def append(self, request):
+        """Queue request at the back of its lane"""
+        request.lane = self.lane(request.properties)
+        self.lanes[request.lane].append(request)
+        self.size += 1
+
+    def popleft(self):
+        """Remove and return the next request to dispatch"""
+        if self.weights is None:
+            for lane in self.lanes:
+                if lane:
+                    break
+        else:
+            # Smooth weighted round robin over lanes with requests
+            total = 0
+            best = None
+            for index, lane in enumerate(self.lanes):
+                if lane:
+                    self.current[index] += self.weights[index]
+                    total += self.weights[index]
+                    if best is None or self.current[index] > self.current[best]:
+                        best = index
+            self.current[best] -= total
+            lane = self.lanes[best]
+        self.size -= 1
+        return lane.popleft()
+
+    def oldest(self):
+        """The request queued longest, across lanes, or None"""
+        heads = [lane[0] for lane in self.lanes if lane]
+        if not heads:
+            return None
+        return min(heads, key=lambda request: request.queued_at)
+
+    def pop_oldest(self):
+        """Remove and return the request queued longest"""
+        request = self.oldest()
+        self.lanes[request.lane].popleft()
+        self.size -= 1
+        return request
+
+    def depths(self):
+        """Number of requests queued in each lane"""
+        return [len(lane) for lane in self.lanes]
+
+    def remove_expired(self, now):
+        """Remove and return the requests whose client has given up"""
+        removed = []
+        for index, lane in enumerate(self.lanes):
+            expired = [request for request in lane if request.expired(now)]
+            if expired:
+                self.lanes[index] = deque(
+                    request for request in lane if not request.expired(now)
+                )
+                removed.extend(expired)
+        self.size -= len(removed)
+        return removed
+
+POINTS = struct.Struct(">8Q")
+
+class HashRing(object):
+    """Consistent hash ring of a service's workers
+
+    Each worker is placed at REPLICAS points on the ring, and a key
+    belongs to the worker at the next point after the key's hash. Adding
+    or removing a worker only moves the keys next to its own points.
+
+    The ring is built with one sort, and membership changes are only
+    recorded as they happen and applied together on the next lookup, so
+    a burst of workers joining or leaving costs one pass over the ring.
+    """
+    __slots__ = (
+        'hashes', # Sorted points on the ring, as of the last lookup
+        'owners', # Worker at each point
+        'added', # Points added since the last lookup
+        'removed', # Points removed since the last lookup
+    )
+
+    REPLICAS = 64 # Points per worker, more spread keys more evenly
+    BATCH = 256 # Changed points past which the ring is rebuilt in one pass
+
+    def __init__(self, workers=()):
+        self.owners = {}
+        for worker in workers:
+            for point in self.points(worker):
+                self.owners.setdefault(point, worker)
+        self.hashes = sorted(self.owners)
+        self.added = []
+        self.removed = []
+
+    def __len__(self):
+        return len(self.owners) // self.REPLICAS
+
+    @staticmethod
+    def hash(key):
+        # Stable across processes and restarts, unlike hash(), and
+        # spreads points more evenly than crc32. 64 bits, so points of
+        # different workers practically never collide.
+        return struct.unpack(">Q", hashlib.md5(key).digest()[:8])[0]
+
+    def points(self, worker):
+        # Eight points from each sha512 digest, a hash call per point
+        # would dominate building a big ring
+        points = []
+        for i in range(self.REPLICAS // 8):
+            digest = hashlib.sha512(b"%s-%d" % (worker.identity, i)).digest()
+            points.extend(POINTS.unpack(digest))
+        return points
+
+    def add(self, worker):
+        """Place worker on the ring"""
+        for point in self.points(worker):
+            if point not in self.owners:
+                self.owners[point] = worker
+                self.added.append(point)
+
+    def remove(self, worker):
+        """Take worker off the ring"""
+        for point in self.points(worker):
+            if self.owners.get(point) is worker:
+                del self.owners[point]
+                self.removed.append(point)
+
+    def contains(self, point):
+        """Is point in hashes"""
+        index = bisect.bisect_left(self.hashes, point)
+        return index < len(self.hashes) and self.hashes[index] == point
+
+    def apply(self):
+        """Bring hashes up to date with the changes since the last lookup"""
+        # A point may have been removed and added back, or the reverse
+        gone = set(p for p in self.removed if p not in self.owners)
+        new = set(p for p in self.added if p in self.owners)
+        self.added = []
+        self.removed = []
+        if len(gone) > self.BATCH:
+            self.hashes = [p for p in self.hashes if p not in gone]
+        else:
+            for point in gone:
+                if self.contains(point):
+                    del self.hashes[bisect.bisect_left(self.hashes, point)]
+        new = [p for p in new if not self.contains(p)]
+        if len(new) > self.BATCH:
+            # Sorting a sorted list with a sorted run on the end merges
+            self.hashes.extend(sorted(new))
+            self.hashes.sort()
+        else:
+            for point in new:
+                bisect.insort(self.hashes, point)
+
+    def get(self, key):
+        """The worker owning key, or None if the ring is empty"""
+        if self.added or self.removed:
+            self.apply()
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, self.hash(key))
+        return self.owners[self.hashes[index % len(self.hashes)]]
 
 class Worker(object):
     """A worker, idle or active"""
-    identity = None # hex identity of worker
-    address = None # Address to route to
-    service = None # Owning service, if known
-    expiry = None # Expires at this point, unless heartbeat
+    __slots__ = (
+        'identity', # hex identity of worker
+        'address', # Address to route to
+        'service', # Owning service, if known
+        'expiry', # Expires at this point, unless heartbeat
+        'credit', # Max requests in flight to this worker
+        'inflight', # When each request in flight was sent, oldest first
+        'queued', # Free credit it's queued under in service waiting
+        'flights', # Flight leaders in flight to it, digest to deadline
+    )
 
     def __init__(self, identity, address, lifetime):
         self.identity = identity
         self.address = address
+        self.service = None
         self.expiry = time.time() + 1e-3 * lifetime
+        self.credit = 1
+        self.inflight = deque()
+        self.queued = None
+        self.flights = {}
+
+    def free(self):
+        """Number of further requests this worker will accept"""
+        return self.credit - len(self.inflight)
+
+class WorkerQueue(object):
+    """Workers with free credit, most free credit first
+
+    Workers are bucketed by free credit, each bucket longest idle
+    first. There are only as many buckets as distinct free credit
+    values, so choosing a worker doesn't depend on the worker count.
+    """
+    __slots__ = (
+        'buckets', # Workers by identity, by free credit
+        'size', # Number of workers queued
+    )
+
+    def __init__(self):
+        self.buckets = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, worker):
+        return worker.queued is not None
+
+    def add(self, worker):
+        """Queue worker under its free credit, if it has any"""
+        self.discard(worker)
+        free = worker.free()
+        if free > 0:
+            bucket = self.buckets.get(free)
+            if bucket is None:
+                bucket = self.buckets[free] = OrderedDict()
+            bucket[worker.identity] = worker
+            worker.queued = free
+            self.size += 1
+
+    def discard(self, worker):
+        """Remove worker, if queued"""
+        if worker.queued is None:
+            return
+        bucket = self.buckets[worker.queued]
+        del bucket[worker.identity]
+        if not bucket:
+            del self.buckets[worker.queued]
+        worker.queued = None
+        self.size -= 1
+
+    def pop(self):
+        """Remove and return the worker with most free credit"""
+        free = max(self.buckets)
+        bucket = self.buckets[free]
+        worker = bucket.popitem(last=False)[1]
+        if not bucket:
+            del self.buckets[free]
+        worker.queued = None
+        self.size -= 1
+        return worker
+
+    def values(self):
+        """Queued workers, in the order they'd be chosen"""
+        for free in sorted(self.buckets, reverse=True):
+            for worker in self.buckets[free].values():
+                yield worker
 
 
 class MajorDomoBroker(object):
@@ -51,29 +429,51 @@ class MajorDomoBroker(object):
     """
 
     # We'd normally pull these from config data
-    INTERNAL_SERVICE_PREFIX = 'mmi.'
+    INTERNAL_SERVICE_PREFIX = b'mmi.'
     HEARTBEAT_LIVENESS = 3 # 3 - 5 is reasonable
     HEARTBEAT_INTERVAL = 2500 # msecs
     HEARTBEAT_EXPIRY = HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
 
+    # Queue limits, None for no limit
+    SERVICE_MAX_REQUESTS = None # Queued requests per service
+    SERVICE_MAX_BYTES = None # Queued body bytes per service
+    MAX_REQUESTS = None # Queued requests across all services
+    MAX_BYTES = None # Queued body bytes across all services
+    MAX_REQUEST_AGE = None # msecs a request may be queued before it's shed
+    MAX_CREDIT = 100 # Most requests a worker may ask to have in flight
+    PRIORITY_LANES = 3 # Request priority lanes per service, 0 first
+    DEFAULT_PRIORITY = 1 # Lane for requests without a priority
+    LANE_WEIGHTS = None # Dispatch share per lane, None for strict priority
+    AFFINITY_MAX_LOAD = 1.0 # Credit share in use before keyed requests move
+    # msecs a worker with requests in flight may go unheard before it's
+    # deleted, its requests are lost with it. The sync worker only
+    # heartbeats between requests, so a handler that runs longer than
+    # this looks just like a dead worker, raise it for services that
+    # have those.
+    BUSY_EXPIRY = HEARTBEAT_EXPIRY * 8
+
     ctx = None # Out context
     socket = None # Socket for clients and workers
     poller = None # Out poller
 
-    heartbeat_at = None # When to send HEARTBEAT
+    timers = None # Heap of (when, seq, event, worker) timer events
+    timer_seq = None # Tie breaker for timers due at the same time
     services = None # Known services
     workers = None # Known workers
-    waiting = None # Idle workers
+    queued_requests = 0 # Requests queued across all services
+    queued_bytes = 0 # Body bytes queued across all services
 
     verbose = False # Print activity to stdout
+    batch_size = 1 # Max messages handled per wakeup
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, batch_size=1):
         """Initialize broker state"""
         self.verbose = verbose
+        self.batch_size = batch_size
         self.services = {}
         self.workers = {}
-        self.waiting = []
-        self.heartbeat_at = time.time() + 1e-3 * self.HEARTBEAT_INTERVAL
+        self.timers = []
+        self.timer_seq = itertools.count()
         self.ctx = zmq.Context()
         self.socket = self.ctx.socket(zmq.ROUTER)
         self.socket.linger = 0
@@ -81,83 +481,146 @@ class MajorDomoBroker(object):
         self.poller.register(self.socket, zmq.POLLIN)
 
     def mediate(self):
-        """Main broker work happens here"""
+        """Main broker work happens here
+
+        Each wakeup drains up to batch_size messages before doing
+        housekeeping, trading latency for throughput under load.
+        """
         while True:
             try:
-                items = self.poller.poll(self.HEARTBEAT_INTERVAL)
+                items = self.poller.poll(self.next_timeout())
             except KeyboardInterrupt:
                 break # Interrupt
 
             if items:
-                msg = self.socket.recv_multipart()
-                if self.verbose:
-                    log.info("I: received message: ")
-                    dump(msg)
-
-                sender = msg.pop(0)
-                empty = msg.pop(0)
-                assert empty == ''
-                header = msg.pop(0)
-
-                if (C_CLIENT == header):
-                    self.process_client(sender, msg)
-                elif (W_WORKER == header):
-                    self.process_worker(sender, msg)
-                else:
-                    log.error("E: invalid message: ")
-                    dump(msg)
+                for msg in self.recv_batch():
+                    self.process_message(msg)
+
+            self.run_timers()
+            self.shed_requests()
+
+    def recv_batch(self):
+        """Receive up to batch_size pending messages without blocking
 
-            self.purge_workers()
-            self.send_heartbeats()
+        Stops early once the socket is drained, or when a timer is due
+        so housekeeping isn't starved by traffic.
+        """
+        msgs = []
+        while len(msgs) < self.batch_size:
+            try:
+                msgs.append(recv_frames(self.socket, zmq.NOBLOCK))
+            except zmq.Again:
+                break
+            if self.timers and self.timers[0][0] <= time.time():
+                break
+        return msgs
+
+    def process_message(self, msg):
+        """Route a single message to the client or worker handler
+
+        Body frames are handed on as received, only the envelope is
+        read as bytes.
+        """
+        if self.verbose:
+            log.info("I: received message: ")
+            dump(msg)
+
+        sender = frame_bytes(msg[0])
+        assert frame_bytes(msg[1]) == b''
+        header = frame_bytes(msg[2])
+
+        if (C_CLIENT == header):
+            self.process_client(sender, msg[3:])
+        elif (C_CLIENT_EXT == header):
+            properties, body = unpack_properties(msg, 4)
+            self.process_client(sender, [msg[3]] + msg[body:], properties)
+        elif (W_WORKER == header):
+            self.process_worker(sender, msg[3:])
+        else:
+            log.error("E: invalid message: ")
+            dump(msg[3:])
 
     def destroy(self):
         """Disconnect all workers, destroy context"""
-        while self.workers:
-            self.delete_worker(self.workers[list(self.workers)[0]], True)
+        for worker in list(self.workers.values()):
+            self.delete_worker(worker, True)
         self.ctx.destroy()
 
-    def process_client(self, sender, msg):
-        """Process a request coming from a client."""
+    def process_client(self, sender, msg, properties=None):
+        """Process a request coming from a client.
+
+        properties are the request properties of an extended client,
+        None for a plain MDP client.
+        """
         assert len(msg) >= 2 # Service name + body
-        service = msg.pop(0)
+        service = frame_bytes(msg[0])
         # Set reply return address to client sender
-        msg = [sender, ''] + msg
+        msg = [sender, b''] + msg[1:]
         if service.startswith(self.INTERNAL_SERVICE_PREFIX):
-            self.service_internal(service, msg)
+            self.service_internal(service, msg, properties)
         else:
-            self.dispatch(self.require_service(service), msg)
+            self.dispatch(self.require_service(service), msg, properties)
 
     def process_worker(self, sender, msg):
         """Process message sent to us by a worker."""
         assert len(msg) >= 1 # At least, command
 
-        command = msg.pop(0)
+        command = frame_bytes(msg[0])
 
         worker_ready = hexlify(sender) in self.workers
 
         worker = self.require_worker(sender)
 
         if (W_READY == command):
-            assert len(msg) >= 1 # At least, a service name
-            service = msg.pop(0)
+            assert len(msg) >= 2 # At least, a service name
+            service = frame_bytes(msg[1])
             # Not first command in session or Reserved service name
             if (worker_ready or service.startswith(
                     self.INTERNAL_SERVICE_PREFIX
             )):
                 self.delete_worker(worker, True)
             else:
+                # Optional credit, the number of requests the worker
+                # wants in flight at once
+                if len(msg) >= 3:
+                    try:
+                        credit = int(frame_bytes(msg[2]))
+                    except ValueError:
+                        credit = 1
+                    worker.credit = max(1, min(credit, self.MAX_CREDIT))
                 # Attach worker to service and mark as idle
                 worker.service = self.require_service(service)
+                worker.service.workers[worker.identity] = worker
+                if worker.service.ring is not None:
+                    worker.service.ring.add(worker)
                 self.worker_waiting(worker)
 
         elif (W_REPLY == command):
             if (worker_ready):
                 # Remove and save client return envelope and insert the
                 # protocol header and service name, then rewrap envelope
-                client = msg.pop(0)
-                empty = msg.pop(0)
-                msg = [client, empty, C_CLIENT, worker.service.name] + msg
-                self.socket.send_multipart(msg)
+                # Properties of extended clients come back in the
+                # return envelope, up to the empty frame
+                client = msg[1]
+                properties, body = unpack_properties(msg, 2)
+                flight = properties.pop(b"flight", None)
+                properties.pop(b"dispatched", None)
+                self.send_to_client(
+                    client, worker.service.name, msg[body:], properties
+                )
+                if flight is not None:
+                    self.land_flight(
+                        worker, flight, msg[body:],
+                        properties.get(C_STATUS) == EXPIRED
+                    )
+                stats = worker.service.stats
+                stats.replies += 1
+                if worker.inflight:
+                    # Replies may come back out of order when a worker
+                    # has credit, so this is the oldest request's time
+                    stats.service_time.record(
+                        time.time() - worker.inflight.popleft()
+                    )
                 self.worker_waiting(worker)
             else:
                 self.delete_worker(worker, True)
@@ -172,7 +635,7 @@ class MajorDomoBroker(object):
             self.delete_worker(worker, False)
         else:
             log.error("E: invalid message: ")
-            dump(msg)
+            dump(msg[1:])
 
     def delete_worker(self, worker, disconnect):
         """Deletes worker from all data structures, and deletes worker"""
@@ -181,7 +644,18 @@ class MajorDomoBroker(object):
             self.send_to_worker(worker, W_DISCONNECT, None, None)
 
         if worker.service is not None:
-            worker.service.waiting.remove(worker)
+            # Clients coalesced onto requests the worker had will retry
+            if worker.service.flights is not None:
+                for digest in worker.flights:
+                    self.drop_followers(
+                        worker.service,
+                        worker.service.flights.pop(digest, None)
+                    )
+            worker.flights.clear()
+            worker.service.waiting.discard(worker)
+            if worker.service.workers.pop(worker.identity, None) is not None:
+                if worker.service.ring is not None:
+                    worker.service.ring.remove(worker)
         self.workers.pop(worker.identity)
 
     def require_worker(self, address):
@@ -192,6 +666,12 @@ class MajorDomoBroker(object):
         if worker is None:
             worker = Worker(identity, address, self.HEARTBEAT_EXPIRY)
             self.workers[identity] = worker
+            self.schedule(worker.expiry, T_EXPIRY, worker)
+            self.schedule(
+                time.time() + 1e-3 * self.HEARTBEAT_INTERVAL,
+                T_HEARTBEAT,
+                worker
+            )
             if self.verbose:
                 log.info("I: registering new worker: %s", identity)
 
@@ -202,11 +682,45 @@ class MajorDomoBroker(object):
         assert name is not None
         service = self.services.get(name)
         if service is None:
-            service = Service(name)
+            service = Service(
+                name, self.SERVICE_MAX_REQUESTS, self.SERVICE_MAX_BYTES,
+                self.PRIORITY_LANES, self.DEFAULT_PRIORITY, self.LANE_WEIGHTS
+            )
             self.services[name] = service
 
         return service
 
+    def set_queue_limits(self, name, max_requests=None, max_bytes=None):
+        """Override queue limits for a service, None for no limit"""
+        service = self.require_service(name)
+        service.max_requests = max_requests
+        service.max_bytes = max_bytes
+
+    def set_idempotent(self, name, idempotent=True):
+        """Coalesce identical requests for a service in flight at once
+
+        Only for services whose replies depend on nothing but the
+        request body. Their workers must echo the return envelope.
+        """
+        service = self.require_service(name)
+        if not idempotent:
+            if service.flights is not None:
+                for followers in service.flights.values():
+                    self.drop_followers(service, followers)
+            service.flights = None
+        elif service.flights is None:
+            service.flights = {}
+
+    def set_lane_weights(self, name, weights=None):
+        """Share dispatches between a service's priority lanes by weight,
+        or use strict priority for None
+        """
+        service = self.require_service(name)
+        requests = service.requests
+        assert weights is None or len(weights) == len(requests.lanes)
+        requests.weights = weights
+        requests.current = [0] * len(requests.lanes)
+
     def bind(self, endpoint):
         """Bind broker to endpoint, can call this multiple times.
 
@@ -215,61 +729,426 @@ class MajorDomoBroker(object):
         self.socket.bind(endpoint)
         log.info("I: MDP broker/0.1.1 is active at %s", endpoint)
 
-    def service_internal(self, service, msg):
-        """Handle internal service according to 8/MMI specification"""
+    def service_internal(self, service, msg, properties=None):
+        """Handle internal service according to 8/MMI specification
+
+        mmi.service answers 200 only while the service has workers, a
+        client asking for it is enough to make it known.
+        """
         returncode = b"501"
+        body = []
+        name = frame_bytes(msg[-1])
         if b"mmi.service" == service:
-            name = msg[-1]
-            returncode = b"200" if name in self.services else b"404"
+            known = self.services.get(name)
+            returncode = b"200" if known and known.workers else b"404"
+        elif service in (b"mmi.stats", b"mmi.workers"):
+            returncode = b"404"
+            if name in self.services:
+                returncode = b"200"
+                if b"mmi.stats" == service:
+                    info = self.service_stats(self.services[name])
+                else:
+                    info = self.service_workers(self.services[name])
+                body = [json.dumps(info).encode("utf-8")]
         msg[-1] = returncode
 
-        # insert the protocol header and service name after the routing
-        # envelope ([client, ''])
-        msg = msg[:2] + [C_CLIENT, service] + msg[2:]
-        self.socket.send_multipart(msg)
+        self.send_to_client(msg[0], service, msg[2:] + body, properties)
 
-    def send_heartbeats(self):
-        """Send heartbeats to idle workers if it's time"""
-        if (time.time() > self.heartbeat_at):
-            for worker in self.waiting:
-                self.send_to_worker(worker, W_HEARTBEAT, None, None)
+    def service_workers(self, service):
+        """Worker and queue counts for a service"""
+        return {
+            "service": service.name.decode("utf-8", "replace"),
+            "workers": len(service.workers),
+            "waiting": len(service.waiting),
+            "inflight": sum(
+                len(worker.inflight) for worker in service.workers.values()
+            ),
+            "requests": len(service.requests),
+            "identities": [
+                identity.decode("ascii") for identity in service.workers
+            ],
+        }
+
+    def service_stats(self, service):
+        """Queue state, throughput counters and latencies for a service"""
+        info = service.stats.summary()
+        info.update({
+            "service": service.name.decode("utf-8", "replace"),
+            "workers": len(service.workers),
+            "waiting": len(service.waiting),
+            "queued": len(service.requests),
+            "following": service.following,
+            "queued_bytes": service.queued_bytes,
+            "oldest_age": 1e3 * service.oldest_age(),
+        })
+        now = time.time()
+        for lane, requests in zip(info["lanes"], service.requests.lanes):
+            lane["depth"] = len(requests)
+            lane["oldest_age"] = (
+                1e3 * (now - requests[0].queued_at) if requests else 0
+            )
+        return info
+
+    def schedule(self, when, event, worker):
+        """Schedule a timer event for worker at when (secs)"""
+        heapq.heappush(self.timers, (when, next(self.timer_seq), event, worker))
+
+    def next_timeout(self):
+        """Poll timeout in msecs, until the next timer is due"""
+        if not self.timers:
+            return self.HEARTBEAT_INTERVAL
+        timeout = 1e3 * (self.timers[0][0] - time.time())
+        return max(0, min(timeout, self.HEARTBEAT_INTERVAL))
 
-            self.heartbeat_at = time.time() + 1e-3 * self.HEARTBEAT_INTERVAL
+    def run_timers(self):
+        """Send heartbeats and kill expired workers.
 
-    def purge_workers(self):
-        """Look for and kill expired workers.
+        Idle workers expire after HEARTBEAT_EXPIRY, workers with
+        requests in flight after BUSY_EXPIRY.
 
-        Workers are oldest to most recent, so we stop at the first
-        alive worker
+        Every known worker has one heartbeat and one expiry timer, so
+        the cost is proportional to the number of due events. Expiry
+        timers are pushed back lazily when the worker has been heard
+        from since they were scheduled, and timers left behind by
+        deleted workers are dropped as they come due.
         """
-        while self.waiting:
-            w = self.waiting[0]
-            if w.expiry < time.time():
-                log.info("I: deleting expired worker: %s", w.identity)
-                self.delete_worker(w, False)
-                self.waiting.pop(0)
+        now = time.time()
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            when, _, event, worker = heapq.heappop(timers)
+            if self.workers.get(worker.identity) is not worker:
+                continue # Deleted since scheduled
+
+            if event == T_EXPIRY:
+                expiry = self.worker_expiry(worker)
+                if expiry > now:
+                    # Look again within a heartbeat expiry, a busy
+                    # worker may go idle and expire sooner
+                    self.schedule(
+                        min(expiry, now + 1e-3 * self.HEARTBEAT_EXPIRY),
+                        T_EXPIRY, worker
+                    )
+                else:
+                    log.info("I: deleting expired worker: %s", worker.identity)
+                    self.delete_worker(worker, False)
             else:
-                break
+                self.send_to_worker(worker, W_HEARTBEAT, None, None)
+                # Keep to the original cadence unless we've fallen behind
+                when += 1e-3 * self.HEARTBEAT_INTERVAL
+                if when <= now:
+                    when = now + 1e-3 * self.HEARTBEAT_INTERVAL
+                self.schedule(when, T_HEARTBEAT, worker)
+
+    def worker_expiry(self, worker):
+        """When worker expires unless it's heard from again (secs)"""
+        if not worker.inflight:
+            return worker.expiry
+        heard = worker.expiry - 1e-3 * self.HEARTBEAT_EXPIRY
+        return heard + 1e-3 * max(self.BUSY_EXPIRY, self.HEARTBEAT_EXPIRY)
 
     def worker_waiting(self, worker):
-        """This worker is now waiting for work."""
-        # Queue to broker and service waiting lists
-        self.waiting.append(worker)
-        worker.service.waiting.append(worker)
+        """This worker has credit for more work."""
+        # Queue to service waiting list under its free credit
+        worker.service.waiting.add(worker)
         worker.expiry = time.time() + 1e-3 * self.HEARTBEAT_EXPIRY
         self.dispatch(worker.service, None)
 
-    def dispatch(self, service, msg):
+    def dispatch(self, service, msg, properties=None):
         """Dispatch requests to waiting workers as possible"""
         assert service is not None
         if msg is not None: # Queue message if any
-            service.requests.append(msg)
-        self.purge_workers()
+            request = Request(msg, properties)
+            full = self.queue_full(service, request)
+            if full and self.purge_expired(service):
+                full = self.queue_full(service, request)
+            if full:
+                # Followers count too, a stampede on a stuck service
+                # mustn't grow without bound
+                log.warning("W: queue full, rejecting request for %s",
+                            service.name)
+                service.stats.rejected += 1
+                self.reject(service, request)
+            elif self.join_flight(service, request):
+                pass # Answered with an identical request's reply
+            else:
+                self.enqueue(service, request)
+        self.run_timers()
+        now = time.time()
         while service.waiting and service.requests:
-            msg = service.requests.pop(0)
-            worker = service.waiting.pop(0)
-            self.waiting.remove(worker)
-            self.send_to_worker(worker, W_REQUEST, None, msg)
+            request = self.dequeue(service)
+            if request.expired(now):
+                # Nobody is waiting for the reply, don't spend a worker
+                service.stats.expired += 1
+                self.abandon_flight(service, request.digest)
+                continue
+            worker = self.choose_worker(service, request)
+            self.send_to_worker(
+                worker, W_REQUEST, None, request.worker_msg(now)
+            )
+            worker.inflight.append(now)
+            if request.digest is not None:
+                worker.flights[request.digest] = request.deadline
+            # Back in the queue if the worker has credit to spare
+            service.waiting.add(worker)
+            service.stats.dispatched += 1
+            service.stats.queue_time.record(now - request.queued_at)
+            lane = service.stats.lanes[request.lane]
+            lane.dispatched += 1
+            lane.queue_time.record(now - request.queued_at)
+
+    def choose_worker(self, service, request):
+        """Take the worker to send request to off the waiting queue
+
+        Keyed requests go to the key's worker on the service's hash ring
+        while that worker is within AFFINITY_MAX_LOAD, so its caches
+        stay hot. Other requests, and keyed requests whose worker is too
+        busy, go to the worker with most free credit.
+        """
+        if request.key is not None:
+            if service.ring is None:
+                service.ring = HashRing(service.workers.values())
+            worker = service.ring.get(request.key)
+            if (worker is not None and worker in service.waiting and
+                    len(worker.inflight) <
+                    self.AFFINITY_MAX_LOAD * worker.credit):
+                service.waiting.discard(worker)
+                service.stats.affinity += 1
+                return worker
+            service.stats.rerouted += 1
+        return service.waiting.pop()
+
+    def enqueue(self, service, request):
+        """Queue request for service, leading a flight if it has a digest"""
+        if request.digest is not None:
+            service.flights.setdefault(request.digest, deque())
+        service.stats.requests += 1
+        service.requests.append(request)
+        service.stats.lanes[request.lane].requests += 1
+        service.queued_bytes += request.size
+        self.queued_requests += 1
+        self.queued_bytes += request.size
+        self.note_deadline(service, request)
+
+    def note_deadline(self, service, request):
+        """Keep service.deadline at or before request's deadline"""
+        if request.deadline is not None and (
+                service.deadline is None or
+                request.deadline < service.deadline):
+            service.deadline = request.deadline
+
+    def join_flight(self, service, request):
+        """Coalesce request onto an identical one already queued or in
+        flight, for idempotent services
+
+        Returns True if it joined one, otherwise notes the digest so
+        the request leads a new flight once queued.
+        """
+        if service.flights is None:
+            return False
+        digest = request.body_digest()
+        followers = service.flights.get(digest)
+        if followers is None:
+            request.digest = digest
+            return False
+        followers.append(request)
+        service.stats.coalesced += 1
+        service.following += 1
+        service.queued_bytes += request.size
+        self.queued_requests += 1
+        self.queued_bytes += request.size
+        self.note_deadline(service, request)
+        return True
+
+    def unfollow(self, service, request):
+        """A request no longer waits on a flight"""
+        service.following -= 1
+        service.queued_bytes -= request.size
+        self.queued_requests -= 1
+        self.queued_bytes -= request.size
+
+    def drop_followers(self, service, followers):
+        """Forget the requests waiting on a flight that won't land,
+        their clients will retry
+        """
+        for request in followers or ():
+            self.unfollow(service, request)
+
+    def land_flight(self, worker, digest, reply, expired=False):
+        """Send a flight leader's reply to the requests that joined it,
+        dropping any whose client has given up
+
+        If the worker didn't run the leader, because its client had
+        given up, the next request in the flight leads instead. Workers
+        mark that reply as expired, an unmarked 504 counts too once the
+        leader's deadline has passed.
+        """
+        deadline = worker.flights.pop(digest, None)
+        service = worker.service
+        if service.flights is None:
+            return
+        now = time.time()
+        if not expired and deadline is not None and deadline <= now:
+            expired = len(reply) == 1 and frame_bytes(reply[0]) == EXPIRED
+        if expired:
+            self.abandon_flight(service, digest)
+            return
+        followers = service.flights.pop(digest, None)
+        for request in followers or ():
+            self.unfollow(service, request)
+            if request.expired(now):
+                service.stats.expired += 1
+                continue
+            self.send_to_client(
+                request.msg[0], service.name, reply, request.properties
+            )
+
+    def abandon_flight(self, service, digest):
+        """A flight leader was dropped, the next request in it leads"""
+        if digest is None or service.flights is None:
+            return
+        followers = service.flights.pop(digest, None)
+        if followers:
+            leader = followers.popleft()
+            self.unfollow(service, leader)
+            leader.digest = digest
+            service.flights[digest] = followers
+            self.enqueue(service, leader)
+
+    def dequeue(self, service, oldest=False):
+        """Remove and return the next request to dispatch for service,
+        or the one queued longest
+        """
+        if oldest:
+            request = service.requests.pop_oldest()
+        else:
+            request = service.requests.popleft()
+        service.queued_bytes -= request.size
+        self.queued_requests -= 1
+        self.queued_bytes -= request.size
+        return request
+
+    def queue_full(self, service, request):
+        """Would queueing request exceed the service or global limits"""
+        return (
+            (service.max_requests is not None
+             and len(service.requests) + service.following >=
+             service.max_requests) or
+            (service.max_bytes is not None
+             and service.queued_bytes + request.size > service.max_bytes) or
+            (self.MAX_REQUESTS is not None
+             and self.queued_requests >= self.MAX_REQUESTS) or
+            (self.MAX_BYTES is not None
+             and self.queued_bytes + request.size > self.MAX_BYTES)
+        )
+
+    def purge_expired(self, service):
+        """Drop queued and following requests whose client has given up
+
+        Called when a queue is full, so dead requests don't hold the
+        capacity live ones would be refused for. Purges every service
+        when there are global limits. Returns how many requests were
+        dropped.
+        """
+        now = time.time()
+        if self.MAX_REQUESTS is None and self.MAX_BYTES is None:
+            return self.purge_service(service, now)
+        return sum(
+            self.purge_service(each, now) for each in self.services.values()
+        )
+
+    def purge_service(self, service, now):
+        """Drop service's expired requests, if its earliest deadline
+        may have passed
+        """
+        if service.deadline is None or service.deadline > now:
+            return 0
+        purged = 0
+        # Followers first, so an expired leader hands its flight to a
+        # live one
+        if service.following:
+            for followers in service.flights.values():
+                live = [request for request in followers
+                        if not request.expired(now)]
+                if len(live) == len(followers):
+                    continue
+                for request in followers:
+                    if request.expired(now):
+                        self.unfollow(service, request)
+                        service.stats.expired += 1
+                        purged += 1
+                followers.clear()
+                followers.extend(live)
+        for request in service.requests.remove_expired(now):
+            service.queued_bytes -= request.size
+            self.queued_requests -= 1
+            self.queued_bytes -= request.size
+            service.stats.expired += 1
+            purged += 1
+            self.abandon_flight(service, request.digest)
+
+        # What's left sets when to look again
+        service.deadline = None
+        for lane in service.requests.lanes:
+            for request in lane:
+                self.note_deadline(service, request)
+        for followers in (service.flights or {}).values():
+            for request in followers:
+                self.note_deadline(service, request)
+        return purged
+
+    def reject(self, service, request):
+        """Tell the client its request was not accepted, MMI style
+
+        Extended clients also get a status property, so the reply can't
+        be mistaken for the service's.
+        """
+        properties = request.properties
+        if properties is not None:
+            properties = dict(properties)
+            properties[C_STATUS] = REJECTED
+        self.send_to_client(
+            request.msg[0], service.name, [REJECTED], properties
+        )
+
+    def shed_requests(self):
+        """Reject requests that have been queued longer than allowed
+
+        Lanes and flights are oldest first, so we stop at the first
+        young request
+        """
+        if self.MAX_REQUEST_AGE is None:
+            return
+        oldest = time.time() - 1e-3 * self.MAX_REQUEST_AGE
+        for service in self.services.values():
+            while (service.requests and
+                   service.requests.oldest().queued_at < oldest):
+                log.warning("W: shedding request for %s", service.name)
+                service.stats.shed += 1
+                request = self.dequeue(service, oldest=True)
+                self.reject(service, request)
+                self.abandon_flight(service, request.digest)
+            if not service.following:
+                continue
+            for followers in service.flights.values():
+                while followers and followers[0].queued_at < oldest:
+                    log.warning("W: shedding request for %s", service.name)
+                    service.stats.shed += 1
+                    request = followers.popleft()
+                    self.unfollow(service, request)
+                    self.reject(service, request)
+
+    def send_to_client(self, address, service, msg, properties=None):
+        """Send message to client, wrapped in the MDP/Client envelope
+
+        Extended clients get their request properties back, before the
+        body.
+        """
+        if properties:
+            msg = [address, b'', C_CLIENT_EXT, service] + \
+                pack_properties(properties) + [b''] + msg
+        else:
+            msg = [address, b'', C_CLIENT, service] + msg
+        self.socket.send_multipart(msg)
 
     def send_to_worker(self, worker, command, option, msg=None):
         """Send message to worker.
@@ -0,0 +1,152 @@
+# Client side service availability
+#
+# Wraps a sync client or client pool so callers don't pay an mmi.service
+# round trip per request, and don't wait out the full timeout, again and
+# again, on a service that is down. mmi.service answers are cached for a
+# short TTL, and each service gets a circuit breaker that opens after
+# repeated timeouts, fails fast while open, and lets a single probe
+# through once it has cooled down.
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class ServiceUnavailable(Exception):
+    """The service has no workers at the broker, or its circuit is open"""
+
+
+class Circuit(object):
+    """Circuit breaker state for one service"""
+    __slots__ = (
+        'state', # CLOSED, OPEN or HALF_OPEN
+        'failures', # Timeouts in a row
+        'opened_at', # When the circuit last opened
+        'known', # Last mmi.service answer, None if unknown
+        'known_until', # When the mmi.service answer expires
+    )
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.known = None
+        self.known_until = 0.0
+
+
+class ServiceGuard(object):
+    """Availability checks and circuit breakers in front of a client
+
+    client is anything with send(service, request) returning the reply
+    or None on timeout, such as a sync MajorDomoClient or a ClientPool.
+    Those also return None when the broker keeps refusing a request, so
+    an overloaded service counts against its circuit like a dead one.
+    send() raises ServiceUnavailable instead of sending when the broker
+    has no workers for the service or its circuit is open. Safe to share
+    between threads if the client is.
+    """
+
+    ttl = 5000 # How long to trust an mmi.service answer, msecs
+    threshold = 3 # Timeouts in a row that open a circuit
+    cooldown = 5000 # How long a circuit stays open before a probe, msecs
+
+    def __init__(self, client, ttl=5000, threshold=3, cooldown=5000):
+        self.client = client
+        self.ttl = ttl
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def circuit(self, service):
+        """Returns the circuit for service, creating it if needed"""
+        circuit = self.circuits.get(service)
+        if circuit is None:
+            circuit = self.circuits[service] = Circuit()
+        return circuit
+
+    def send(self, service, request):
+        """Send request unless the service is known to be unavailable
+
+        Returns the reply, or None if it timed out or the broker refused
+        it, either of which counts as a failure, as does the client
+        raising.
+        """
+        self.allow(service)
+        if not self.available(service):
+            if self.circuit(service).state == HALF_OPEN:
+                # The probe found no workers, stay open
+                self.record(service, False)
+            raise ServiceUnavailable(service)
+        try:
+            reply = self.client.send(service, request)
+        except Exception:
+            # Count it, or a half-open circuit waits on its probe forever
+            self.record(service, False)
+            raise
+        self.record(service, reply is not None)
+        return reply
+
+    def available(self, service):
+        """Returns whether the broker has workers for service
+
+        Asks mmi.service at most once per ttl.
+        """
+        now = time.time()
+        with self.lock:
+            circuit = self.circuit(service)
+            if now < circuit.known_until:
+                return circuit.known
+        reply = self.client.send(b"mmi.service", service)
+        if reply is None:
+            # Can't reach the broker, count it against the service
+            self.record(service, False)
+            return False
+        with self.lock:
+            circuit.known = reply[0] == b"200"
+            circuit.known_until = now + 1e-3 * self.ttl
+            return circuit.known
+
+    def allow(self, service):
+        """Raise ServiceUnavailable if the circuit for service is open
+
+        Once the cooldown has passed, the circuit goes half-open and the
+        caller is let through as a probe, while others keep failing fast
+        until the probe's outcome is known.
+        """
+        with self.lock:
+            circuit = self.circuit(service)
+            if circuit.state == CLOSED:
+                return
+            elapsed = 1e3 * (time.time() - circuit.opened_at)
+            if circuit.state == OPEN and elapsed >= self.cooldown:
+                log.info("I: probing %s", service)
+                circuit.state = HALF_OPEN
+                circuit.known_until = 0.0 # Probe asks the broker afresh
+                return
+        raise ServiceUnavailable(service)
+
+    def record(self, service, success):
+        """Update the circuit for service with the outcome of a request"""
+        with self.lock:
+            circuit = self.circuit(service)
+            if success:
+                if circuit.state != CLOSED:
+                    log.info("I: closing circuit for %s", service)
+                circuit.state = CLOSED
+                circuit.failures = 0
+                return
+            circuit.failures += 1
+            if (circuit.state == HALF_OPEN or
+                    circuit.failures >= self.threshold):
+                if circuit.state != OPEN:
+                    log.warning("W: opening circuit for %s", service)
+                circuit.state = OPEN
+                circuit.opened_at = time.time()
+                circuit.known_until = 0.0
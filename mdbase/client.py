@@ -6,13 +6,34 @@
 # Based on Java exmple by Arkadiusz Orzechowski
 # Copyright (c) 2010-2011 iMatix Corporation and Contributors
 
+import heapq
+import itertools
 import logging
+import time
+from concurrent.futures import Future
 
 import zmq
 
-from mdbase.constants import C_CLIENT
+from mdbase.codec import (frame_bytes, frames_bytes, recv_frames,
+                          pack_properties, unpack_properties)
+from mdbase.constants import (C_CLIENT, C_CLIENT_EXT, C_STATUS, EXPIRED,
+                              REJECTED)
+from mdbase.stats import HedgeStats
 from mdbase.utils import dump
 
+
+class RequestTimeout(Exception):
+    """No reply arrived for a request within its timeout"""
+
+class RequestRejected(Exception):
+    """The broker refused a request, its service being overloaded"""
+
+class RequestExpired(Exception):
+    """The worker didn't run a request, its timeout having passed"""
+
+# Exception for a reply status, failing the request it came back on
+STATUS_ERRORS = {REJECTED: RequestRejected, EXPIRED: RequestExpired}
+
 class MajorDomoClient(object):
     """Majordomo Protocol Client API
 
@@ -24,11 +45,12 @@ class MajorDomoClient(object):
     poller = None
     timeout = 2500
     verbose = False
+    copy = True # Return replies as bytes, or as zmq.Frame when False
 
-    def __init__(self, broker, verbose=False):
+    def __init__(self, broker, verbose=False, ctx=None):
         self.broker = broker
         self.verbose = verbose
-        self.ctx = zmq.Context()
+        self.ctx = ctx or zmq.Context()
         self.poller = zmq.Poller()
         logging.basicConfig(
             format="%(asctime)s %(message)s",
@@ -58,7 +80,7 @@ class MajorDomoClient(object):
         # Frame 0: empty (REQ emulation)
         # Frame 1: "MDPCxy" (six bytes, MDP/Client x.y)
         # Frame 2: Service name (printable string)
-        request = ['', C_CLIENT, service] + request
+        request = [b'', C_CLIENT, service] + request
         if self.verbose:
             logging.warn("I: send request to '%s' service: ", service)
             dump(request)
@@ -72,7 +94,7 @@ class MajorDomoClient(object):
             return # interrupted
 
         if items:
-            msg = self.client.recv_multipart()
+            msg = recv_frames(self.client)
             if self.verbose:
                 logging.info("I: received reply: ")
                 dump(msg)
@@ -80,14 +102,309 @@ class MajorDomoClient(object):
             # Don't try to handle errors, just assert noisily
             assert len(msg) >= 4
 
-            empty = msg.pop(0)
-            assert empty == ''
-            header = msg.pop(0)
-            assert C_CLIENT == header
+            assert frame_bytes(msg[0]) == b''
+            assert C_CLIENT == frame_bytes(msg[1])
 
-            # pop service part of message off
-            msg.pop(0)
-
-            return msg
+            # skip service part of message
+            reply = msg[3:]
+            if self.copy:
+                reply = frames_bytes(reply)
+            return reply
         else:
             logging.warn("W: permanent error, abandoning request")
+
+    def close(self):
+        """Close our socket, leaving the context"""
+        self.poller.unregister(self.client)
+        self.client.close()
+
+    def destroy(self):
+        self.ctx.destroy(0)
+
+
+class PipelinedMajorDomoClient(object):
+    """Majordomo Protocol Client API with many requests in flight
+
+    Each request is tagged with a correlation id, which the broker and
+    worker carry back on the reply, and send() returns a
+    concurrent.futures.Future for it. Futures are resolved by poll() or
+    wait(), which read replies as they arrive and fail requests past
+    their timeout with RequestTimeout. A request the broker refused
+    fails with RequestRejected, and one the worker found expired with
+    RequestExpired. Use asyncio.wrap_future() for an asyncio future.
+
+    With hedge set to a percentile, a request still unanswered after
+    that percentile of the service's recent latency is sent again, and
+    the first reply resolves its future, like MajorDomoClient in
+    client_sync. Duplicates are sent by poll(), so only while polling.
+
+    Not thread safe, like the socket it wraps.
+    """
+    broker = None
+    ctx = None
+    client = None
+    poller = None
+    timeout = 2500 # Default per request timeout, msecs
+    verbose = False
+    copy = True # Return replies as bytes, or as zmq.Frame when False
+    hedge = None # Latency percentile to send a duplicate at, None disables
+    hedge_budget = 0.05 # Most duplicates per request, per service
+    hedge_min_samples = 20 # Replies needed before hedging a service
+    hedges = None # HedgeStats by service
+
+    pending = None # Futures waiting for a reply, by correlation id
+    deadlines = None # Heap of (deadline, correlation id)
+    hedging = None # Heap of (time to send a duplicate, correlation id)
+    sent = None # Requests by correlation id while hedging, [service,
+                # request, timeout, priority, key, sent at, copies out]
+
+    def __init__(self, broker, verbose=False, ctx=None):
+        self.broker = broker
+        self.verbose = verbose
+        self.ctx = ctx or zmq.Context()
+        self.poller = zmq.Poller()
+        self.pending = {}
+        self.deadlines = []
+        self.hedging = []
+        self.sent = {}
+        self.hedges = {}
+        self.ids = itertools.count(1)
+        logging.basicConfig(
+            format="%(asctime)s %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+            level=logging.INFO
+        )
+        self.reconnect_to_broker()
+
+    def reconnect_to_broker(self):
+        """Connect or reconnect to broker"""
+        if self.client:
+            self.poller.unregister(self.client)
+            self.client.close()
+        self.client = self.ctx.socket(zmq.DEALER)
+        self.client.linger = 0
+        # Outstanding requests are bounded by timeouts, not the HWM
+        self.client.sndhwm = 0
+        self.client.rcvhwm = 0
+        self.client.connect(self.broker)
+        self.poller.register(self.client, zmq.POLLIN)
+        if self.verbose:
+            logging.info("I: connecting to broker at %s..." % self.broker)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def send(self, service, request, timeout=None, priority=None,
+             key=None):
+        """Send request to broker, returns a Future for the reply
+
+        timeout is in msecs and defaults to the client timeout. priority
+        picks the broker's priority lane, 0 first, None for the default.
+        Requests with the same key go to the same worker while it has
+        capacity.
+        """
+        if not isinstance(request, list):
+            request = [request]
+
+        if timeout is None:
+            timeout = self.timeout
+        correlation = b"%d" % next(self.ids)
+        self.client.send_multipart(
+            self.wrap(service, correlation, request, timeout, priority, key)
+        )
+
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.pending[correlation] = future
+        now = time.time()
+        heapq.heappush(self.deadlines, (now + 1e-3 * timeout, correlation))
+        if self.hedge is not None:
+            stats = self.hedge_stats(service)
+            stats.requests += 1
+            self.sent[correlation] = [
+                service, request, timeout, priority, key, now, 1
+            ]
+            delay = self.hedge_delay(stats, timeout)
+            if delay < timeout:
+                heapq.heappush(self.hedging, (now + 1e-3 * delay, correlation))
+        return future
+
+    def wrap(self, service, correlation, request, timeout, priority=None,
+             key=None):
+        """Returns request in the client envelope, tagged with its id,
+        timeout and any priority and routing key
+        """
+        # The broker and worker drop the request once it has timed out
+        properties = {b"id": correlation, b"timeout": b"%d" % timeout}
+        if priority is not None:
+            properties[b"priority"] = b"%d" % priority
+        if key is not None:
+            properties[b"key"] = key
+        request = [b'', C_CLIENT_EXT, service] + \
+            pack_properties(properties) + [b''] + request
+        if self.verbose:
+            logging.info("I: send request to '%s' service: ", service)
+            dump(request)
+        return request
+
+    def hedge_stats(self, service):
+        """Returns the HedgeStats for service, created on first use"""
+        stats = self.hedges.get(service)
+        if stats is None:
+            stats = self.hedges[service] = HedgeStats()
+        return stats
+
+    def hedge_delay(self, stats, timeout):
+        """Msecs to wait before sending a duplicate, timeout for none
+
+        No duplicate is sent until the service has a latency history, or
+        once duplicates would exceed the budget.
+        """
+        if (stats.latency.count < self.hedge_min_samples or
+                stats.hedges >= self.hedge_budget * stats.requests):
+            return timeout
+        return max(int(1e3 * stats.latency.percentile(self.hedge)), 1)
+
+    def poll(self, timeout=0):
+        """Resolve futures for replies arriving within timeout msecs
+
+        Returns the number of replies read.
+        """
+        received = 0
+        self.expire()
+        self.send_hedges()
+        for heap in (self.deadlines, self.hedging):
+            if heap:
+                expiry = 1e3 * (heap[0][0] - time.time())
+                timeout = min(timeout, max(int(expiry), 0))
+        try:
+            items = self.poller.poll(timeout)
+        except KeyboardInterrupt:
+            return received # interrupted
+
+        while items:
+            try:
+                msg = recv_frames(self.client, zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.resolve(msg)
+            received += 1
+        self.expire()
+        self.send_hedges()
+        return received
+
+    def wait(self, futures=None, timeout=None):
+        """Poll until futures, by default all pending, are done
+
+        Gives up after timeout msecs if given, returns True when all
+        futures are done.
+        """
+        if futures is None:
+            futures = list(self.pending.values())
+        end = None if timeout is None else time.time() + 1e-3 * timeout
+        while not all(future.done() for future in futures):
+            left = self.timeout
+            if end is not None:
+                left = int(1e3 * (end - time.time()))
+                if left <= 0:
+                    return False
+            self.poll(left)
+        return True
+
+    def resolve(self, msg):
+        """Set the result of the request a reply belongs to
+
+        A reply with a status wasn't made by the service, and fails the
+        request instead.
+        """
+        if self.verbose:
+            logging.info("I: received reply: ")
+            dump(msg)
+
+        # Don't try to handle errors, just assert noisily
+        assert len(msg) >= 4
+        assert frame_bytes(msg[0]) == b''
+        assert C_CLIENT_EXT == frame_bytes(msg[1])
+
+        properties, body = unpack_properties(msg, 3)
+        correlation = properties.get(b"id")
+        hedged = correlation is not None and correlation.endswith(b"h")
+        if hedged:
+            correlation = correlation[:-1] # The duplicate's request
+        future = self.pending.get(correlation)
+        if future is None:
+            # Late reply to a request that already timed out or was
+            # answered
+            return
+        sent = self.sent.get(correlation)
+        status = properties.get(C_STATUS)
+        if status is not None:
+            if sent is not None and sent[6] > 1:
+                # The other copy may yet be answered
+                sent[6] -= 1
+                return
+            del self.pending[correlation]
+            self.sent.pop(correlation, None)
+            error = STATUS_ERRORS.get(status, RequestRejected)
+            future.set_exception(error(correlation))
+            return
+        del self.pending[correlation]
+        if sent is not None:
+            del self.sent[correlation]
+            stats = self.hedges[sent[0]]
+            if hedged:
+                stats.wins += 1
+            stats.record(time.time() - sent[5])
+        reply = msg[body:]
+        if self.copy:
+            reply = frames_bytes(reply)
+        future.set_result(reply)
+
+    def expire(self):
+        """Fail requests whose timeout has passed"""
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, correlation = heapq.heappop(self.deadlines)
+            future = self.pending.pop(correlation, None)
+            if future is not None:
+                self.sent.pop(correlation, None)
+                future.set_exception(RequestTimeout(correlation))
+        if not self.pending:
+            # Nothing left to time out, drop deadlines of answered requests
+            del self.deadlines[:]
+            del self.hedging[:]
+
+    def send_hedges(self):
+        """Send a duplicate of requests slower than usual for their
+        service, under the request's id with an h appended
+
+        The hedge budget is checked again as each duplicate is sent, as
+        with many requests in flight all of them are planned before any
+        duplicate counts against it.
+        """
+        now = time.time()
+        while self.hedging and self.hedging[0][0] <= now:
+            hedge_at, correlation = heapq.heappop(self.hedging)
+            sent = self.sent.get(correlation)
+            if sent is None:
+                continue # Answered or timed out
+            service, request, timeout, priority, key, sent_at, copies = sent
+            stats = self.hedges[service]
+            if stats.hedges >= self.hedge_budget * stats.requests:
+                # Spent by duplicates sent since this one was planned
+                continue
+            # Only for as long as the request has left
+            timeout = max(timeout - int(1e3 * (now - sent_at)), 1)
+            self.client.send_multipart(self.wrap(
+                service, correlation + b"h", request, timeout, priority, key
+            ))
+            sent[6] += 1
+            stats.hedges += 1
+
+    def close(self):
+        """Close our socket, leaving the context"""
+        self.poller.unregister(self.client)
+        self.client.close()
+
+    def destroy(self):
+        self.ctx.destroy(0)
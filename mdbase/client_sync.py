@@ -6,17 +6,34 @@
 # Based on Java exmple by Arkadiusz Orzechowski
 # Copyright (c) 2010-2011 iMatix Corporation and Contributors
 
+import itertools
 import logging
+import random
+import time
 
 import zmq
 
-from mdbase.constants import C_CLIENT
+from mdbase.codec import (frame_bytes, frames_bytes, recv_frames,
+                          pack_properties, unpack_properties)
+from mdbase.constants import C_CLIENT_EXT, C_STATUS
+from mdbase.stats import HedgeStats
 from mdbase.utils import dump
 
 class MajorDomoClient(object):
     """Majordomo Protocol Client API
 
     Implements the MDP/Client spec http:#rfc.zeromq.org/spec:7
+
+    Each attempt at a request carries its own id, so a retry is resent
+    on the same connection and replies to attempts we gave up on are
+    discarded. A reply carrying a status, because the broker refused
+    the request or the worker found it expired, fails the attempt like
+    a timeout, and is never returned as the reply.
+
+    With hedge set to a percentile, a request still unanswered after
+    that percentile of the service's recent latency is sent again, and
+    the first reply wins. hedge_budget caps duplicates as a fraction of
+    requests, per service, and counters are kept in hedges.
     """
     broker = None
     ctx = None
@@ -24,13 +41,23 @@ class MajorDomoClient(object):
     poller = None
     timeout = 2500
     retries = 3
+    backoff = 100 # Delay before the first retry, msecs
+    backoff_max = 5000 # Cap on the delay between retries, msecs
+    priority = None # Broker priority lane, 0 first, None for the default
+    hedge = None # Latency percentile to send a duplicate at, None disables
+    hedge_budget = 0.05 # Most duplicates per request, per service
+    hedge_min_samples = 20 # Replies needed before hedging a service
+    hedges = None # HedgeStats by service
     verbose = False
+    copy = True # Return replies as bytes, or as zmq.Frame when False
 
-    def __init__(self, broker, verbose=False):
+    def __init__(self, broker, verbose=False, ctx=None):
         self.broker = broker
         self.verbose = verbose
-        self.ctx = zmq.Context()
+        self.ctx = ctx or zmq.Context()
         self.poller = zmq.Poller()
+        self.ids = itertools.count(1)
+        self.hedges = {}
         logging.basicConfig(
             format="%(asctime)s %(message)s",
             datefmt="%Y-%m-%d %H:%M:%S",
@@ -43,64 +70,312 @@ class MajorDomoClient(object):
         if self.client:
             self.poller.unregister(self.client)
             self.client.close()
-        self.client = self.ctx.socket(zmq.REQ)
+        self.client = self.ctx.socket(zmq.DEALER)
         self.client.linger = 0
         self.client.connect(self.broker)
         self.poller.register(self.client, zmq.POLLIN)
         if self.verbose:
             logging.info("I: connecting to broker at %s..." % self.broker)
 
-    def send(self, service, request):
+    def send(self, service, request, key=None):
         """Send request to broker and get reply by hook or crook.
 
         Takes ownership of request message and destroys it when sent.
         Returns the reply message or None if there was no reply.
+        Requests with the same key go to the same worker while it has
+        capacity, to keep its caches hot.
         """
-        if not isinstance(request, list):
-            request = [request]
-        request = [C_CLIENT, service] + request
-        if self.verbose:
-            logging.warn("I: send request to '%s' service: ", service)
-            dump(request)
         reply = None
 
         retries = self.retries
         while retries > 0:
-            self.client.send_multipart(request)
+            # A fresh id per attempt, so a late reply to an abandoned
+            # attempt can't be taken for this one's
+            correlation = b"%d" % next(self.ids)
             try:
-                items = self.poller.poll(self.timeout)
+                reply = self.attempt(service, correlation, request, key)
             except KeyboardInterrupt:
                 break # interrupted
+            if reply is not None:
+                break
 
-            if items:
-                msg = self.client.recv_multipart()
-                if self.verbose:
-                    logging.info("I: received reply")
-                    dump(msg)
+            retries -= 1
+            if retries:
+                delay = self.retry_delay(self.retries - retries)
+                logging.warn("W: no reply, retrying in %d msecs...", delay)
+                try:
+                    time.sleep(1e-3 * delay)
+                except KeyboardInterrupt:
+                    break
+            else:
+                logging.warn("W: permanent error, abandoning")
 
-                # Don't try to handle errors, just assert noisily
-                assert len(msg) >= 3
+        return reply
 
-                # make sure that we have the correct header
-                header = msg.pop(0)
-                assert C_CLIENT == header
+    def send_many(self, service, requests, window=100, ordered=True):
+        """Send requests to service, keeping up to window in flight.
 
-                # make sure we got the correct response
-                reply_service = msg.pop(0)
-                assert service == reply_service
+        Yields (index, reply) for each request, in request order, or as
+        replies arrive if ordered is False. Each request is timed out,
+        retried and hedged like send(), and reply is None for a request
+        that got no reply, without stopping the rest of the batch.
+        """
+        requests = enumerate(requests)
+        stats = None if self.hedge is None else self.hedge_stats(service)
+        # Requests by index, [request, attempt, due, resend, sent,
+        # hedge_at, ids], ids holding the attempt's id then any duplicate's
+        pending = {}
+        inflight = {} # Request index by id
+        done = {} # Replies held back to keep order, by index
+        next_index = 0
+        more = True
+
+        def send(index, entry, now):
+            # Send an attempt under a new id, so a late reply to the last
+            # one is discarded
+            correlation = b"%d" % next(self.ids)
+            self.client.send_multipart(
+                self.wrap(service, correlation, entry[0])
+            )
+            inflight[correlation] = index
+            entry[2] = now + 1e-3 * self.timeout
+            entry[3] = False
+            entry[4] = now
+            entry[5] = None
+            entry[6] = [correlation]
+            if stats is not None:
+                stats.requests += 1
+                delay = self.hedge_delay(stats)
+                if delay < self.timeout:
+                    entry[5] = now + 1e-3 * delay
 
-                reply = msg
+        while more or pending:
+            while more and len(pending) < window:
+                try:
+                    index, request = next(requests)
+                except StopIteration:
+                    more = False
+                    break
+                entry = pending[index] = [request, 1, 0, False, 0, None, []]
+                send(index, entry, time.time())
+            if not pending:
                 break
-            else:
-                if retries:
-                    logging.warn("W: no reply, reconnecting...")
-                    self.reconnect_to_broker()
-                else:
-                    logging.warn("W: permanent error, abandoning")
+
+            # Wait for replies until the next timeout, resend or duplicate
+            # falls due
+            due = min(min(entry[2], entry[5] or entry[2])
+                      for entry in pending.values())
+            timeout = max(int(1e3 * (due - time.time())), 0)
+            finished = []
+            try:
+                items = self.poller.poll(timeout)
+            except KeyboardInterrupt:
+                return # interrupted
+            while items:
+                try:
+                    msg = recv_frames(self.client, zmq.NOBLOCK)
+                except zmq.Again:
                     break
-                retries -= 1
+                correlation, name, reply = self.unwrap(msg)
+                index = inflight.pop(correlation, None)
+                if index is None:
+                    if self.verbose:
+                        logging.info("I: discarding late reply")
+                    continue
+                assert service == name
+                entry = pending[index]
+                if reply is None:
+                    # Refused or expired, retry or give up below, as if
+                    # timed out, unless another copy is still out
+                    if not any(other in inflight for other in entry[6]):
+                        entry[2] = 0
+                        entry[3] = False
+                        entry[5] = None
+                    continue
+                del pending[index]
+                for other in entry[6]:
+                    inflight.pop(other, None)
+                if stats is not None:
+                    if correlation != entry[6][0]:
+                        stats.wins += 1
+                    stats.record(time.time() - entry[4])
+                finished.append((index, reply))
+
+            now = time.time()
+            for index, entry in list(pending.items()):
+                request, attempt, due, resend, sent, hedge_at, ids = entry
+                if hedge_at is not None and hedge_at <= now:
+                    entry[5] = None
+                    # Slow for the service, send a duplicate and take
+                    # whichever reply comes first, unless the duplicates
+                    # sent since this one was planned spent the budget
+                    if stats.hedges < self.hedge_budget * stats.requests:
+                        hedge = ids[0] + b"h"
+                        self.client.send_multipart(
+                            self.wrap(service, hedge, request)
+                        )
+                        inflight[hedge] = index
+                        ids.append(hedge)
+                        stats.hedges += 1
+                if due > now:
+                    continue
+                if resend:
+                    for other in ids:
+                        inflight.pop(other, None)
+                    send(index, entry, now)
+                    entry[1] += 1
+                elif attempt < self.retries:
+                    entry[2] = now + 1e-3 * self.retry_delay(attempt)
+                    entry[3] = True
+                    entry[5] = None
+                else:
+                    logging.warn("W: permanent error, abandoning request %d",
+                                 index)
+                    del pending[index]
+                    for other in ids:
+                        inflight.pop(other, None)
+                    finished.append((index, None))
+
+            if not ordered:
+                for result in finished:
+                    yield result
+                continue
+            done.update(finished)
+            while next_index in done:
+                yield next_index, done.pop(next_index)
+                next_index += 1
+
+    def wrap(self, service, correlation, request, key=None):
+        """Returns request in the client envelope, tagged with its id,
+        timeout and any routing key
+        """
+        if not isinstance(request, list):
+            request = [request]
+        # The broker and worker drop the request once we've given up
+        properties = {b"id": correlation, b"timeout": b"%d" % self.timeout}
+        if self.priority is not None:
+            properties[b"priority"] = b"%d" % self.priority
+        if key is not None:
+            properties[b"key"] = key
+        request = [b'', C_CLIENT_EXT, service] + \
+            pack_properties(properties) + [b''] + request
+        if self.verbose:
+            logging.warn("I: send request to '%s' service: ", service)
+            dump(request)
+        return request
+
+    def unwrap(self, msg):
+        """Returns the request id, service and body of a reply
+
+        The body is None if the reply carries a status, the broker
+        having refused the request or the worker having found it
+        expired, as it isn't the service's answer.
+        """
+        if self.verbose:
+            logging.info("I: received reply")
+            dump(msg)
+
+        # Don't try to handle errors, just assert noisily
+        assert len(msg) >= 4
+        assert frame_bytes(msg[0]) == b''
+
+        # make sure that we have the correct header
+        assert C_CLIENT_EXT == frame_bytes(msg[1])
+
+        properties, body = unpack_properties(msg, 3)
+        if C_STATUS in properties:
+            return properties.get(b"id"), frame_bytes(msg[2]), None
+        reply = msg[body:]
+        if self.copy:
+            reply = frames_bytes(reply)
+        return properties.get(b"id"), frame_bytes(msg[2]), reply
+
+    def attempt(self, service, correlation, request, key=None):
+        """Send request once and wait up to timeout for its reply
+
+        Sends a duplicate if hedging is on and the reply is slower than
+        usual for the service. Returns the reply or None.
+        """
+        self.client.send_multipart(
+            self.wrap(service, correlation, request, key)
+        )
+        sent_at = time.time()
+        if self.hedge is None:
+            return self.recv_reply(service, [correlation], self.timeout)[1]
 
+        stats = self.hedge_stats(service)
+        stats.requests += 1
+        ids = [correlation]
+        delay = min(self.hedge_delay(stats), self.timeout)
+        reply_id, reply = self.recv_reply(service, ids, delay)
+        if reply_id is None and delay < self.timeout:
+            hedge = correlation + b"h"
+            self.client.send_multipart(
+                self.wrap(service, hedge, request, key)
+            )
+            stats.hedges += 1
+            ids.append(hedge)
+            reply_id, reply = self.recv_reply(
+                service, ids, self.timeout - delay
+            )
+        if reply_id is None or reply is None:
+            return None
+        if reply_id != correlation:
+            stats.wins += 1
+        stats.record(time.time() - sent_at)
         return reply
 
+    def hedge_stats(self, service):
+        """Returns the HedgeStats for service, created on first use"""
+        stats = self.hedges.get(service)
+        if stats is None:
+            stats = self.hedges[service] = HedgeStats()
+        return stats
+
+    def hedge_delay(self, stats):
+        """Msecs to wait before sending a duplicate, timeout for none
+
+        No duplicate is sent until the service has a latency history, or
+        once duplicates would exceed the budget.
+        """
+        if (stats.latency.count < self.hedge_min_samples or
+                stats.hedges >= self.hedge_budget * stats.requests):
+            return self.timeout
+        return max(int(1e3 * stats.latency.percentile(self.hedge)), 1)
+
+    def recv_reply(self, service, ids, timeout):
+        """Wait up to timeout msecs for the reply to one of ids
+
+        Replies to earlier requests are discarded. Returns the id and
+        reply, or None, None if no reply arrives in time. The reply is
+        None if the request was refused or expired.
+        """
+        expiry = time.time() + 1e-3 * timeout
+        while timeout > 0 and self.poller.poll(timeout):
+            reply_id, name, reply = self.unwrap(recv_frames(self.client))
+            if reply_id in ids:
+                # make sure we got the correct response
+                assert service == name
+                return reply_id, reply
+
+            if self.verbose:
+                logging.info("I: discarding late reply")
+            timeout = int(1e3 * (expiry - time.time()))
+        return None, None
+
+    def retry_delay(self, attempt):
+        """Delay before retry attempt, in msecs
+
+        Doubles per attempt up to backoff_max, with full jitter so
+        clients retrying after the same outage spread out.
+        """
+        delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, delay)
+
+    def close(self):
+        """Close our socket, leaving the context"""
+        self.poller.unregister(self.client)
+        self.client.close()
+
     def destroy(self):
-        self.context.destroy()
\ No newline at end of file
+        self.ctx.destroy(0)
@@ -0,0 +1,84 @@
+# Majordomo Protocol frame codec
+#
+# Shared by the broker, worker and client APIs. Messages are received
+# with copy=False so each part arrives as a zmq.Frame, and envelopes are
+# parsed by index. Only the short control frames (addresses, headers,
+# commands, service names) are read as bytes. Body frames are forwarded
+# as the same zmq.Frame objects, so their payload is never copied.
+
+import zmq
+
+SNDMORE = int(zmq.SNDMORE)
+
+def recv_frames(socket, flags=0):
+    """Receive all message parts from socket as zmq.Frame objects"""
+    return socket.recv_multipart(flags, copy=False)
+
+def send_frames(socket, frames):
+    """Send frames as one message, without copying them
+
+    Like send_multipart(copy=False), but with plain int flags, which
+    saves pyzmq building a flag enum per frame where every message
+    counts.
+    """
+    send = socket.send
+    for frame in frames[:-1]:
+        send(frame, SNDMORE, copy=False)
+    send(frames[-1], 0, copy=False)
+
+def frame_bytes(frame):
+    """Returns the bytes of a single frame, frame may already be bytes"""
+    if isinstance(frame, zmq.Frame):
+        return frame.bytes
+    return frame
+
+def frames_bytes(frames):
+    """Returns a list of frames as bytes, copying each payload once"""
+    return [frame_bytes(frame) for frame in frames]
+
+def pack_properties(properties):
+    """Returns request properties as a list of key, value frames"""
+    frames = []
+    for key, value in properties.items():
+        frames.append(key)
+        frames.append(value)
+    return frames
+
+def unpack_properties(msg, start=0):
+    """Parse key, value frames from msg[start] up to an empty frame
+
+    Returns the properties and the index just past the empty frame.
+    """
+    properties = {}
+    index = start
+    while frame_bytes(msg[index]) != b'':
+        properties[frame_bytes(msg[index])] = frame_bytes(msg[index + 1])
+        index += 2
+    return properties, index + 1
+
+def dispatch_time(properties, now):
+    """Returns when the broker sent a request on to the worker, in secs
+
+    Taken from the dispatched property, the broker's clock in msecs, so
+    time a request spends waiting at a worker with credit counts against
+    its timeout. now if there is no valid dispatched property, or if it
+    is later than now, the broker's clock being ahead of ours.
+    """
+    if not properties or b"dispatched" not in properties:
+        return now
+    try:
+        return min(now, 1e-3 * int(properties[b"dispatched"]))
+    except ValueError:
+        return now
+
+def properties_deadline(properties, now):
+    """Returns when the timeout property, in msecs from now, runs out
+
+    None if there is no valid timeout property.
+    """
+    if not properties or b"timeout" not in properties:
+        return None
+    try:
+        return now + 1e-3 * int(properties[b"timeout"])
+    except ValueError:
+        return None
@@ -3,6 +3,22 @@
 # this is the version of the MDP/Client we implement
 C_CLIENT = b'MDPC01'
 
+# MDP/Client with request properties, an mdbase extension. The service
+# name is followed by key, value frame pairs and an empty frame, then
+# the body. Properties ride in the worker return envelope, and come back
+# on the reply in the same layout
+C_CLIENT_EXT = b'MDPCX1'
+
+# Reply property set on replies the service didn't make, so clients
+# can tell them from its answers. The broker sets REJECTED when it
+# refused a request, its queue being full or it having waited too
+# long, and a worker sets EXPIRED when it didn't run a request whose
+# client had already given up. Only extended clients get properties
+# back, plain MDP clients just get the status as the body
+C_STATUS = b'status'
+REJECTED = b'503'
+EXPIRED = b'504'
+
 # this is the version of the MDP/Worker we implement
 W_WORKER = b'MDPW01'
 
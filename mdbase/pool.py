@@ -0,0 +1,170 @@
+# Majordomo Protocol Client Pool
+#
+# zmq sockets can't be shared between threads, so a threaded application
+# would otherwise build a client, with its own context, I/O thread and
+# TCP connection, per request. The pool keeps connected clients on one
+# shared context and lends them out, so a call costs a send and a
+# receive.
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import zmq
+
+from mdbase.client_sync import MajorDomoClient
+
+log = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """No client came free within the checkout timeout"""
+
+
+class ClientPool(object):
+    """Pool of connected sync clients, shared by threads
+
+    Threads borrow a client with checkout() or the client() context
+    manager, or call send() to borrow one for a single request. No more
+    than size clients are open at once, callers wait for one when all
+    are lent out.
+
+    A client is pinged before it's lent if it sat idle longer than
+    check_interval, or its last request got no reply, and replaced if
+    the ping gets no answer either.
+    """
+
+    broker = None
+    ctx = None # Context shared by all clients
+    size = 8 # Most clients open at once
+    timeout = 2500 # Client request timeout, msecs
+    retries = 3 # Client request attempts
+    check_interval = 30000 # Ping clients idle longer than this, msecs
+    verbose = False # Print activity to stdout
+
+    idle = None # Clients not lent out and when they were returned
+    opened = 0 # Clients open, lent out or idle
+    closed = False
+    lock = None # Guards idle and opened, notified when a client comes free
+
+    def __init__(self, broker, size=8, verbose=False, ctx=None):
+        self.broker = broker
+        self.size = size
+        self.verbose = verbose
+        self.ctx = ctx or zmq.Context()
+        self.idle = []
+        self.lock = threading.Condition()
+
+    def connect(self):
+        """Open a new client on the shared context"""
+        client = MajorDomoClient(self.broker, self.verbose, ctx=self.ctx)
+        client.timeout = self.timeout
+        client.retries = self.retries
+        return client
+
+    def checkout(self, timeout=None):
+        """Borrow a client, waiting up to timeout secs if all are lent
+
+        Raises PoolTimeout if none comes free in time.
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while True:
+                assert not self.closed
+                if self.idle:
+                    # Most recently used first, its connection is warmest
+                    client, returned_at = self.idle.pop()
+                    break
+                if self.opened < self.size:
+                    # Take the slot now, connect outside the lock
+                    self.opened += 1
+                    client = None
+                    break
+                wait = None if end is None else end - time.time()
+                if wait is not None and wait <= 0:
+                    raise PoolTimeout()
+                self.lock.wait(wait)
+
+        try:
+            if client is None:
+                return self.connect()
+            if not self.healthy(client, returned_at):
+                log.warning("W: replacing unhealthy client")
+                client.close()
+                return self.connect()
+            return client
+        except Exception:
+            self.release()
+            raise
+
+    def checkin(self, client, suspect=False):
+        """Return a borrowed client
+
+        A suspect client, one whose last request got no reply, is pinged
+        before it's lent again.
+        """
+        with self.lock:
+            if self.closed:
+                client.close()
+                self.opened -= 1
+            else:
+                self.idle.append((client, 0 if suspect else time.time()))
+            self.lock.notify()
+
+    def release(self):
+        """Give up the slot of a client that was closed while lent out"""
+        with self.lock:
+            self.opened -= 1
+            self.lock.notify()
+
+    @contextmanager
+    def client(self, timeout=None):
+        """Borrow a client for the duration of a with block"""
+        client = self.checkout(timeout)
+        try:
+            yield client
+        except Exception:
+            # The socket may be mid request, don't lend it again
+            client.close()
+            self.release()
+            raise
+        self.checkin(client)
+
+    def send(self, service, request):
+        """Send request on a pooled client, returns the reply or None"""
+        client = self.checkout()
+        try:
+            reply = client.send(service, request)
+        except Exception:
+            client.close()
+            self.release()
+            raise
+        self.checkin(client, suspect=reply is None)
+        return reply
+
+    def healthy(self, client, returned_at):
+        """Returns whether a client being lent out can reach the broker"""
+        if client.client.closed:
+            return False
+        if 1e3 * (time.time() - returned_at) < self.check_interval:
+            return True
+        # Any reply will do, even an unknown service
+        retries, client.retries = client.retries, 1
+        try:
+            return client.send(b"mmi.service", b"mmi.service") is not None
+        finally:
+            client.retries = retries
+
+    def close(self):
+        """Close idle clients now, and lent out clients as they return"""
+        with self.lock:
+            self.closed = True
+            for client, returned_at in self.idle:
+                client.close()
+            self.opened -= len(self.idle)
+            self.idle = []
+
+    def destroy(self):
+        self.close()
+        self.ctx.destroy(0)
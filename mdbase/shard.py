@@ -0,0 +1,401 @@
+# Sharded Majordomo Protocol Broker
+#
+# Services are spread over N broker processes by a stable hash of their
+# name, so shards own disjoint sets of services. Each shard is a plain
+# MajorDomoBroker bound to its own endpoint, and shards share nothing.
+#
+# Clients and workers keep using the one public endpoint, a thin front
+# that forwards each message to the shard owning its service. For each
+# client or worker it connects a DEALER to the shard, so the shard sees
+# every peer as a connection of its own and runs unchanged, and replies
+# come back on the DEALER they belong to. Frames are forwarded as the
+# zmq.Frames they arrived as, only the envelope is read.
+#
+# The front is one Python process every forwarded message passes
+# through, so it sets the ceiling for peers using it. Peers that want
+# to scale with the shards go to them directly: the front answers
+# mmi.shards with the shard endpoints, in shard order, and peers pick
+# the shard for a service with shard_for(), the same way the front
+# does. ShardedClient does this for sync clients, and shard_endpoint()
+# gives a worker the endpoint to connect to. A message from them then
+# passes through only the broker that owns its service.
+
+import json
+import logging
+import multiprocessing
+import socket
+import sys
+import time
+import zlib
+
+import zmq
+
+from mdbase.broker import MajorDomoBroker
+from mdbase.client_sync import MajorDomoClient
+from mdbase.codec import (frame_bytes, pack_properties, recv_frames,
+                          send_frames, unpack_properties)
+from mdbase.constants import (C_CLIENT, C_CLIENT_EXT, W_WORKER, W_READY,
+                              W_DISCONNECT)
+from mdbase.utils import dump
+
+log = logging.getLogger(__name__)
+
+
+class ShardsUnavailable(Exception):
+    """The shard front didn't say where the shards are"""
+
+
+def shard_for(name, shards):
+    """Returns the shard index owning a service name
+
+    Uses crc32 rather than hash() so the mapping is stable across
+    processes and restarts.
+    """
+    return (zlib.crc32(name) & 0xffffffff) % shards
+
+def shard_endpoints(endpoint, shards):
+    """Endpoints for shards to bind, next to the front's endpoint
+
+    tcp endpoints take the ports after the front's, others get the
+    shard index appended.
+    """
+    scheme, _, address = endpoint.partition("://")
+    if scheme == "tcp":
+        host, _, port = address.rpartition(":")
+        return ["tcp://%s:%d" % (host, int(port) + 1 + index)
+                for index in range(shards)]
+    return ["%s-%d" % (endpoint, index) for index in range(shards)]
+
+def shard_endpoint(endpoints, service):
+    """Endpoint of the shard owning service"""
+    return endpoints[shard_for(service, len(endpoints))]
+
+def resolve_shards(endpoint, verbose=False, ctx=None):
+    """Ask the shard front at endpoint for the shard endpoints
+
+    Returns them in shard order, or None if the front didn't answer.
+    """
+    client = MajorDomoClient(endpoint, verbose, ctx=ctx)
+    try:
+        reply = client.send(b"mmi.shards", b"")
+    finally:
+        if ctx is None:
+            client.destroy()
+        else:
+            client.close()
+    if not reply or reply[0] != b"200":
+        return None
+    return json.loads(reply[1].decode("utf-8"))
+
+def run_shard(endpoint, verbose=False, batch_size=1):
+    """Run a single shard broker, bound to its own endpoint"""
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO
+    )
+    broker = MajorDomoBroker(verbose, batch_size)
+    broker.bind(endpoint)
+    broker.mediate()
+    broker.destroy()
+
+
+class ShardFront(object):
+    """Public endpoint of a sharded broker
+
+    Answers mmi.shards with the shard endpoints as a JSON list, and
+    forwards everything else to the shard owning the service, over a
+    DEALER per peer and shard. Client requests go to the shard owning
+    their service, MMI requests to the shard owning the service they ask
+    about. Workers go to the shard owning the service they sent READY
+    for, and stay there.
+    """
+
+    INTERNAL_SERVICE_PREFIX = MajorDomoBroker.INTERNAL_SERVICE_PREFIX
+
+    ctx = None # Our context
+    socket = None # Socket for clients and workers
+    poller = None # Our poller
+    endpoints = None # Shard endpoints for peers, in shard order
+    backends = None # Shard endpoints for us to connect to, in shard order
+    proxies = None # DEALER to a shard for a peer, by (address, shard)
+    peers = None # [address, shard, last used] of each DEALER, by socket
+    workers = None # Shard index of each worker, by address
+    verbose = False # Print activity to stdout
+    batch_size = 64 # Max messages taken from each socket per wakeup
+    # Close a peer's DEALER unused this long, secs. Workers heartbeat,
+    # so this only ever closes those of gone workers and idle clients
+    proxy_ttl = 300.0
+    proxy_linger = 1000 # Time a closed DEALER has to deliver, msecs
+    purge_at = 0.0 # When to next look for idle DEALERs
+
+    def __init__(self, endpoints, verbose=False, backends=None,
+                 batch_size=64):
+        self.endpoints = endpoints
+        self.backends = backends or endpoints
+        self.verbose = verbose
+        self.batch_size = batch_size
+        self.proxies = {}
+        self.peers = {}
+        self.workers = {}
+        self.ctx = zmq.Context()
+        self.socket = self.ctx.socket(zmq.ROUTER)
+        self.socket.linger = 0
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+
+    def bind(self, endpoint):
+        """Bind the public endpoint for clients and workers"""
+        self.socket.bind(endpoint)
+        log.info("I: MDP shard front is active at %s", endpoint)
+
+    def mediate(self):
+        """Forward messages between peers and shards until interrupted
+
+        Each wakeup drains up to batch_size messages from each socket
+        that has any, so the front polls once per batch rather than per
+        message.
+        """
+        interval = MajorDomoBroker.HEARTBEAT_INTERVAL
+        while True:
+            try:
+                items = self.poller.poll(interval)
+            except KeyboardInterrupt:
+                break # Interrupt
+
+            for ready, event in items:
+                if ready is self.socket:
+                    for msg in self.recv_batch(ready):
+                        self.process_message(msg)
+                else:
+                    for msg in self.recv_batch(ready):
+                        self.process_reply(ready, msg)
+            if time.time() >= self.purge_at:
+                self.purge_proxies()
+                self.purge_at = time.time() + 1e-3 * interval
+
+    def recv_batch(self, socket):
+        """Receive up to batch_size pending messages without blocking"""
+        msgs = []
+        while len(msgs) < self.batch_size:
+            try:
+                msgs.append(recv_frames(socket, zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        return msgs
+
+    def process_message(self, msg):
+        """Answer or forward a single message from a client or worker"""
+        if self.verbose:
+            log.info("I: received message: ")
+            dump(msg)
+
+        sender = frame_bytes(msg[0])
+        header = frame_bytes(msg[2])
+        command = None
+        if header in (C_CLIENT, C_CLIENT_EXT):
+            service = frame_bytes(msg[3])
+            if service == b"mmi.shards":
+                self.answer_shards(sender, header, msg)
+                return
+            if service.startswith(self.INTERNAL_SERVICE_PREFIX):
+                service = frame_bytes(msg[-1])
+            shard = shard_for(service, len(self.backends))
+        elif header == W_WORKER:
+            command = frame_bytes(msg[3])
+            if command == W_READY and len(msg) > 4:
+                shard = shard_for(frame_bytes(msg[4]), len(self.backends))
+                self.workers[sender] = shard
+            else:
+                shard = self.workers.get(sender)
+                if shard is None:
+                    # Unknown worker, any shard will tell it to go away
+                    shard = shard_for(sender, len(self.backends))
+        else:
+            log.error("E: invalid message: ")
+            dump(msg)
+            return
+
+        proxy = self.proxy(sender, shard)
+        send_frames(proxy, msg[1:])
+        if command == W_DISCONNECT:
+            self.close_proxy(proxy)
+
+    def process_reply(self, proxy, msg):
+        """Pass a shard's message back to the peer its DEALER is for"""
+        peer = self.peers[proxy]
+        peer[2] = time.time()
+        send_frames(self.socket, [peer[0]] + msg)
+        if (len(msg) >= 3 and frame_bytes(msg[1]) == W_WORKER and
+                frame_bytes(msg[2]) == W_DISCONNECT):
+            # The worker reconnects under a new address
+            self.close_proxy(proxy)
+
+    def answer_shards(self, sender, header, msg):
+        """Reply to mmi.shards with the shard endpoints"""
+        body = [b"200", json.dumps(self.endpoints).encode("utf-8")]
+        if header == C_CLIENT_EXT:
+            properties = unpack_properties(msg, 4)[0]
+            reply = [sender, b'', C_CLIENT_EXT, b"mmi.shards"] + \
+                pack_properties(properties) + [b''] + body
+        else:
+            reply = [sender, b'', C_CLIENT, b"mmi.shards"] + body
+        self.socket.send_multipart(reply)
+
+    def proxy(self, address, shard):
+        """Returns the DEALER to shard for the peer at address
+
+        Connects one on first use.
+        """
+        proxy = self.proxies.get((address, shard))
+        if proxy is None:
+            proxy = self.ctx.socket(zmq.DEALER)
+            proxy.linger = self.proxy_linger
+            proxy.connect(self.backends[shard])
+            self.poller.register(proxy, zmq.POLLIN)
+            self.proxies[(address, shard)] = proxy
+            self.peers[proxy] = [address, shard, 0.0]
+        self.peers[proxy][2] = time.time()
+        return proxy
+
+    def close_proxy(self, proxy):
+        """Close a peer's DEALER, once it has passed on what it holds"""
+        address, shard, last = self.peers.pop(proxy)
+        del self.proxies[(address, shard)]
+        if self.workers.get(address) == shard:
+            del self.workers[address]
+        self.poller.unregister(proxy)
+        proxy.close()
+
+    def purge_proxies(self):
+        """Close the DEALERs of peers not heard from within proxy_ttl
+
+        Clients never say goodbye, and workers that die or reconnect
+        under a new address don't either, their shards just expire them.
+        """
+        now = time.time()
+        for proxy, (address, shard, last) in list(self.peers.items()):
+            if now - last > self.proxy_ttl:
+                if self.verbose:
+                    log.info("I: closing idle proxy for %r", address)
+                self.close_proxy(proxy)
+
+    def destroy(self):
+        self.ctx.destroy(0)
+
+
+class ShardedClient(object):
+    """Sync client sending each request straight to its service's shard
+
+    Asks the shard front for the shard endpoints once, and keeps a
+    MajorDomoClient per shard on a shared context. MMI requests go to
+    the shard owning the service they ask about.
+    """
+
+    ctx = None # Context shared by the clients
+    clients = None # MajorDomoClient per shard, in shard order
+
+    def __init__(self, endpoint, verbose=False, ctx=None):
+        self.ctx = ctx or zmq.Context()
+        endpoints = resolve_shards(endpoint, verbose, self.ctx)
+        if endpoints is None:
+            if ctx is None:
+                self.ctx.destroy(0)
+            raise ShardsUnavailable(endpoint)
+        self.clients = [
+            MajorDomoClient(endpoint, verbose, ctx=self.ctx)
+            for endpoint in endpoints
+        ]
+
+    def client_for(self, service, request=None):
+        """Returns the client for the shard owning service"""
+        if service.startswith(MajorDomoBroker.INTERNAL_SERVICE_PREFIX):
+            service = request[-1] if isinstance(request, list) else request
+        return self.clients[shard_for(service, len(self.clients))]
+
+    def send(self, service, request, key=None):
+        """Send request to its shard, see MajorDomoClient.send"""
+        return self.client_for(service, request).send(service, request, key)
+
+    def send_many(self, service, requests, window=100, ordered=True):
+        """Send requests to service's shard, see MajorDomoClient.send_many"""
+        return self.client_for(service).send_many(
+            service, requests, window, ordered
+        )
+
+    def close(self):
+        """Close every client, leaving the context"""
+        for client in self.clients:
+            client.close()
+
+    def destroy(self):
+        self.ctx.destroy(0)
+
+
+class ShardedBroker(object):
+    """Runs a shard front and N shard broker processes
+
+    Shards bind endpoints next to the front's, unless endpoints are
+    given. Clients are sent the shard endpoints with a wildcard host
+    replaced by host, this machine's name by default, and the front
+    connects to them on the loopback.
+    """
+
+    def __init__(self, shards=None, verbose=False, batch_size=1,
+                 endpoints=None, host=None, front_batch_size=64):
+        if endpoints:
+            shards = len(endpoints)
+        self.shards = shards or multiprocessing.cpu_count()
+        self.verbose = verbose
+        self.batch_size = batch_size # For each shard broker
+        self.front_batch_size = front_batch_size
+        self.endpoints = endpoints
+        self.host = host or socket.gethostname()
+        self.processes = []
+
+    def start(self, endpoints):
+        """Start shard processes, before any zmq context exists here"""
+        for endpoint in endpoints:
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(endpoint, self.verbose, self.batch_size)
+            )
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def run(self, endpoint):
+        """Start the shards and serve the public endpoint until
+        interrupted
+        """
+        endpoints = self.endpoints or shard_endpoints(endpoint, self.shards)
+        self.start(endpoints)
+        front = ShardFront(
+            [shard.replace("://*:", "://%s:" % self.host)
+             for shard in endpoints],
+            self.verbose,
+            [shard.replace("://*:", "://127.0.0.1:") for shard in endpoints],
+            self.front_batch_size
+        )
+        front.bind(endpoint)
+        try:
+            front.mediate()
+        finally:
+            front.destroy()
+            for process in self.processes:
+                process.terminate()
+
+def main():
+    """Create and start new sharded broker"""
+    logging.basicConfig(
+        format="%(asctime)s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO
+    )
+
+    verbose = "-v" in sys.argv
+    broker = ShardedBroker(verbose=verbose)
+    broker.run("tcp://*:5555")
+
+if __name__ == "__main__":
+    main()
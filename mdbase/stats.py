@@ -0,0 +1,169 @@
+# Broker and client statistics
+#
+# Counters and streaming latency histograms, cheap enough to leave on
+# in production: recording is a bit_length and a list increment.
+
+class Histogram(object):
+    """Streaming latency histogram with power of two buckets
+
+    Values are recorded in seconds and bucketed by microseconds, bucket
+    i counting values below 2**i usecs, so percentiles are accurate to
+    within a factor of two.
+    """
+    __slots__ = (
+        'buckets', # Count of values per bucket
+        'count', # Number of values recorded
+        'total', # Sum of values recorded, secs
+        'max', # Largest value recorded, secs
+    )
+
+    BUCKETS = 40 # 2**39 usecs is over six days
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """Record a single value, in seconds"""
+        index = int(value * 1e6).bit_length() if value > 0 else 0
+        self.buckets[min(index, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def decay(self):
+        """Halve all counts, so newer values outweigh older ones"""
+        self.buckets = [count >> 1 for count in self.buckets]
+        self.count = sum(self.buckets)
+        self.total *= 0.5
+
+    def percentile(self, percent):
+        """Upper bound of the given percentile, in seconds"""
+        if not self.count:
+            return 0.0
+        rank = percent * 1e-2 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(1e-6 * (1 << index), self.max)
+        return self.max
+
+    def summary(self):
+        """Count, mean, percentiles and max, in msecs"""
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "mean": 1e3 * mean,
+            "p50": 1e3 * self.percentile(50),
+            "p90": 1e3 * self.percentile(90),
+            "p99": 1e3 * self.percentile(99),
+            "max": 1e3 * self.max,
+        }
+
+
+class LaneStats(object):
+    """Counters and wait times for one priority lane of a service"""
+    __slots__ = (
+        'requests', # Requests queued
+        'dispatched', # Requests sent to a worker
+        'queue_time', # Enqueue to dispatch
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.dispatched = 0
+        self.queue_time = Histogram()
+
+    def summary(self):
+        """Counters and wait time summary as a dict"""
+        return {
+            "requests": self.requests,
+            "dispatched": self.dispatched,
+            "queue_time": self.queue_time.summary(),
+        }
+
+
+class ServiceStats(object):
+    """Throughput counters and latency histograms for a service"""
+    __slots__ = (
+        'requests', # Requests queued
+        'rejected', # Requests refused because a queue was full
+        'shed', # Requests dropped after queueing too long
+        'coalesced', # Requests answered by an identical one's reply
+        'expired', # Requests dropped as their client's deadline passed
+        'dispatched', # Requests sent to a worker
+        'affinity', # Keyed requests sent to their key's worker
+        'rerouted', # Keyed requests sent elsewhere, their worker was busy
+        'replies', # Replies returned to clients
+        'queue_time', # Enqueue to dispatch
+        'service_time', # Dispatch to reply
+        'lanes', # LaneStats per priority lane
+    )
+
+    def __init__(self, lanes=1):
+        self.requests = 0
+        self.rejected = 0
+        self.shed = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.dispatched = 0
+        self.affinity = 0
+        self.rerouted = 0
+        self.replies = 0
+        self.queue_time = Histogram()
+        self.service_time = Histogram()
+        self.lanes = [LaneStats() for i in range(lanes)]
+
+    def summary(self):
+        """Counters and histogram summaries as a dict"""
+        return {
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "coalesced": self.coalesced,
+            "expired": self.expired,
+            "dispatched": self.dispatched,
+            "affinity": self.affinity,
+            "rerouted": self.rerouted,
+            "replies": self.replies,
+            "queue_time": self.queue_time.summary(),
+            "service_time": self.service_time.summary(),
+            "lanes": [lane.summary() for lane in self.lanes],
+        }
+
+
+class HedgeStats(object):
+    """A client's latency and hedging counters for a service"""
+    __slots__ = (
+        'latency', # Send to reply, decayed so it follows recent load
+        'requests', # Requests sent
+        'hedges', # Duplicate requests sent
+        'wins', # Requests answered by the duplicate first
+    )
+
+    WINDOW = 1000 # Latencies recorded between decays
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def record(self, value):
+        """Record the latency of a reply, in seconds"""
+        if self.latency.count >= self.WINDOW:
+            self.latency.decay()
+        self.latency.record(value)
+
+    def summary(self):
+        """Counters and latency summary as a dict"""
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "wins": self.wins,
+            "latency": self.latency.summary(),
+        }
@@ -0,0 +1,252 @@
+# Majordomo Protocol Worker Supervisor
+#
+# Runs a handler function across a pool of worker threads or processes
+# per service, and scales each pool between its min and max size from
+# the queue depth and idle worker counts the broker reports through
+# mmi.workers.
+
+import json
+import logging
+import multiprocessing
+import threading
+import time
+
+import zmq
+
+from mdbase.client_sync import MajorDomoClient
+from mdbase.worker import MajorDomoWorker
+
+log = logging.getLogger(__name__)
+
+def serve(worker, handler):
+    """Answer requests with handler until the worker is stopped
+
+    A request the handler fails on is answered 500, and the worker
+    carries on.
+    """
+    reply = None
+    try:
+        while True:
+            request = worker.recv(reply)
+            if request is None:
+                break
+            try:
+                reply = handler(request)
+            except Exception:
+                log.exception("E: handler failed")
+                reply = [b"500"]
+    finally:
+        worker.close()
+
+def serve_process(broker, service, handler, stop, verbose=False):
+    """Process entry point, serving until the stop event is set"""
+    worker = MajorDomoWorker(broker, service, verbose)
+
+    def watch():
+        stop.wait()
+        worker.stop()
+
+    watcher = threading.Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+    serve(worker, handler)
+    worker.destroy()
+
+
+class ThreadMember(object):
+    """A pool worker running in a thread of the supervisor process"""
+
+    def __init__(self, pool):
+        self.worker = MajorDomoWorker(
+            pool.broker, pool.service, pool.verbose, ctx=pool.ctx
+        )
+        self.thread = threading.Thread(
+            target=serve, args=(self.worker, pool.handler)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.worker.stop()
+
+    def alive(self):
+        return self.thread.is_alive()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+
+class ProcessMember(object):
+    """A pool worker running in its own process"""
+
+    def __init__(self, pool):
+        self.stopping = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=serve_process,
+            args=(pool.broker, pool.service, pool.handler, self.stopping,
+                  pool.verbose)
+        )
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+
+
+class Pool(object):
+    """Workers serving one service"""
+
+    members = None # Running workers, oldest first
+    stopping = None # Workers told to stop that haven't disconnected yet
+
+    def __init__(self, ctx, broker, service, handler, min_workers,
+                 max_workers, mode="thread", verbose=False):
+        assert 0 <= min_workers <= max_workers
+        assert mode in ("thread", "process")
+        self.ctx = ctx
+        self.broker = broker
+        self.service = service
+        self.handler = handler
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.mode = mode
+        self.verbose = verbose
+        self.members = []
+        self.stopping = []
+
+    def __len__(self):
+        return len(self.members)
+
+    def grow(self, count):
+        """Start up to count more workers, staying within max_workers"""
+        count = min(count, self.max_workers - len(self.members))
+        member = ThreadMember if self.mode == "thread" else ProcessMember
+        for i in range(count):
+            self.members.append(member(self))
+        return max(count, 0)
+
+    def reap(self):
+        """Forget workers that died without being stopped
+
+        Returns how many there were, so they can be replaced.
+        """
+        members = [member for member in self.members if member.alive()]
+        dead = len(self.members) - len(members)
+        self.members = members
+        return dead
+
+    def shrink(self, count):
+        """Stop up to count workers, staying within min_workers"""
+        count = min(count, len(self.members) - self.min_workers)
+        for i in range(count):
+            # Newest first, they've had least time to warm up
+            member = self.members.pop()
+            member.stop()
+            self.stopping.append(member)
+        return max(count, 0)
+
+    def pending_stops(self):
+        """Workers told to stop that the broker may still count"""
+        self.stopping = [member for member in self.stopping if member.alive()]
+        return len(self.stopping)
+
+    def stop(self):
+        """Stop all workers and wait for them to finish"""
+        members, self.members = self.members + self.stopping, []
+        self.stopping = []
+        for member in members:
+            member.stop()
+        for member in members:
+            member.join()
+
+
+class Supervisor(object):
+    """Runs and autoscales worker pools, one per service
+
+    Threads share the supervisor's zmq.Context, processes get their own.
+    """
+
+    ctx = None
+    broker = None
+    client = None # Client for asking the broker about queues
+    pools = None # Worker pools, by service name
+    interval = 1000 # Scaling interval, msecs
+    verbose = False # Print activity to stdout
+
+    def __init__(self, broker, interval=1000, verbose=False, ctx=None):
+        self.broker = broker
+        self.interval = interval
+        self.verbose = verbose
+        self.pools = {}
+        self.ctx = ctx or zmq.Context()
+        self.client = MajorDomoClient(broker, verbose, ctx=self.ctx)
+        self.client.timeout = interval
+        self.client.retries = 1
+
+    def add_service(self, service, handler, min_workers=1, max_workers=8,
+                    mode="thread"):
+        """Serve service with handler, using min to max workers"""
+        pool = Pool(self.ctx, self.broker, service, handler, min_workers,
+                    max_workers, mode, self.verbose)
+        pool.grow(min_workers)
+        self.pools[service] = pool
+        return pool
+
+    def queue_info(self, service):
+        """Broker's worker and queue counts for service, or None"""
+        reply = self.client.send(b"mmi.workers", service)
+        if not reply or reply[0] != b"200":
+            return None
+        return json.loads(reply[1].decode("utf-8"))
+
+    def scale(self, pool, info):
+        """Resize pool from the broker's queue depth and idle workers
+
+        Grows by the backlog when requests queue with no idle worker,
+        and shrinks one worker at a time while workers sit idle with
+        nothing queued, so bursts are absorbed quickly and capacity is
+        handed back gradually. Workers that died are replaced first.
+        """
+        dead = pool.reap()
+        if dead:
+            log.warning("W: %s lost %d workers, replacing them",
+                        pool.service, dead)
+            pool.grow(dead)
+        if info is None:
+            return 0
+        if info["requests"] > 0 and info["waiting"] == 0:
+            added = pool.grow(info["requests"])
+            if added:
+                log.info("I: %s grew by %d to %d workers",
+                         pool.service, added, len(pool))
+            return added
+        idle = info["waiting"] - pool.pending_stops()
+        if info["requests"] == 0 and idle > 1:
+            removed = pool.shrink(1)
+            if removed:
+                log.info("I: %s shrank to %d workers",
+                         pool.service, len(pool))
+            return -removed
+        return 0
+
+    def run(self):
+        """Scale pools every interval until interrupted"""
+        try:
+            while True:
+                for service, pool in self.pools.items():
+                    self.scale(pool, self.queue_info(service))
+                time.sleep(1e-3 * self.interval)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self):
+        """Stop every pool"""
+        for pool in self.pools.values():
+            pool.stop()
@@ -5,33 +5,31 @@
 # Author: Min RK <benjaminrk@gmail.com>
 # Copyright (c) 2010-2011 iMatix Corporation and Contributors
 
-import cPickle as pickle
+import logging
 import os
 import sys
 import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from uuid import uuid4
 
 import zmq
 
 from mdbase.worker import MajorDomoWorker
-from mdbase.client_sync import MajorDomoClient
-
-from mdbase.utils import zpipe
+from mdbase.circuit import ServiceGuard, ServiceUnavailable
+from mdbase.pool import ClientPool
+from mdbase.titanic_store import (FileStore, SegmentStore, SYNC_GROUP,
+                                  SYNC_MODES)
 
 TITANIC_DIR = ".titanic"
-
-def request_filename(uuid):
-    """Returns freshly allocated request filename for given UUID"""
-    return os.path.join(TITANIC_DIR, "%s.req" % uuid)
-
-def reply_filename(uuid):
-    """Returns freshly allocated reply filename for given UUID"""
-    return os.path.join(TITANIC_DIR, "%s.reo" % uuid)
+REQUEST_THREADS = 8 # titanic.request workers, fsyncs are shared between them
 
 # Titanic request service
-def titanic_request(pipe):
-    worker = MajorDomoWorker("tcp://localhost:5555", "titanic.request")
+def titanic_request(pipe, store):
+    worker = MajorDomoWorker("tcp://localhost:5555", b"titanic.request")
 
     reply = None
 
@@ -42,26 +40,21 @@ def titanic_request(pipe):
         if not request:
             break
 
-        # Ensure message directory exists
-        if not os.path.exists(TITANIC_DIR):
-            os.mkdir(TITANIC_DIR)
+        # Generate UUID and save message to disk, this returns once
+        # it's as durable as the store's sync mode asks
+        uuid = uuid4().hex.encode("ascii")
+        store.store_request(uuid, request)
 
-        # Generate UUID and save message to disk
-        uuid = uuid4().hex
-        filename = request_filename(uuid)
-        with open(filename, 'w') as f:
-            pickle.dump(request, f)
-
-        # Send UUID through to message queue
-        pipe.send(uuid)
+        # Send UUID and service through to message queue
+        pipe.send_multipart([uuid, request[0]])
 
         # Now send UUID back to client
         # Done by the worker.recv() at the top of the loop
-        reply = ["200", uuid]
+        reply = [b"200", uuid]
 
 # Titanic reply service
-def titanic_reply():
-    worker = MajorDomoWorker("tcp://localhost:5555", "titanic.reply")
+def titanic_reply(store):
+    worker = MajorDomoWorker("tcp://localhost:5555", b"titanic.reply")
     reply = None
 
     while True:
@@ -70,21 +63,18 @@ def titanic_reply():
             break
 
         uuid = request.pop(0)
-        req_filename = request_filename(uuid)
-        rep_filename = reply_filename(uuid)
-        if os.path.exists(rep_filename):
-            with open(rep_filename, 'r') as f:
-                reply = pickle.load(f)
-            reply = ["200"] + reply
+        stored = store.fetch_reply(uuid)
+        if stored is not None:
+            reply = [b"200"] + stored
         else:
-            if os.path.exists(req_filename):
-                reply = ["300"] # pending
+            if store.has_request(uuid):
+                reply = [b"300"] # pending
             else:
-                reply = ["400"] # unknown
+                reply = [b"400"] # unknown
 
 # Titanic close service
-def titanic_close():
-    worker = MajorDomoWorker("tcp://localhost:5555", "titanic.close")
+def titanic_close(store):
+    worker = MajorDomoWorker("tcp://localhost:5555", b"titanic.close")
     reply = None
 
     while True:
@@ -93,61 +83,254 @@ def titanic_close():
             break
 
         uuid = request.pop(0)
-        req_filename = request_filename(uuid)
-        rep_filename = reply_filename(uuid)
-
-        # should these be protected? Does zfile_delete ignore files
-        # that have already been removed? That's what we are doing here
-        if os.path.exists(req_filename):
-            os.remove(req_filename)
-        if os.path.exists(rep_filename):
-            os.remove(rep_filename)
-        reply = ["200"]
-
-def service_success(client, uuid):
-    """Attempt to process a single request, return True if successful"""
+        # Closing an unknown or already closed request is fine
+        store.forget(uuid)
+        reply = [b"200"]
+
+def service_success(client, store, uuid, attempts=1):
+    """Attempt to process a single request, return True if successful
+
+    attempts counts this one, it's kept with the reply.
+    """
     # Load request message, service will be first frame
-    filename = request_filename(uuid)
+    request = store.fetch_request(uuid)
 
     # If the client already closed request, treat as successful
-    if not os.path.exists(filename):
+    if request is None:
         return True
 
-    with open(filename, 'r') as f:
-        request = pickle.load(f)
     service = request.pop(0)
-    # Use MMI protocol to check if service is available
-    mmi_request = [service]
-    mmi_reply = client.send("mmi.service", mmi_request)
-    service_ok = mmi_reply and mmi_reply[0] == "200"
-
-    if service_ok:
+    # The guard checks the service is available, from its MMI cache,
+    # and fails fast while the service's circuit is open
+    try:
         reply = client.send(service, request)
-        if reply:
-            filename = reply_filename(uuid)
-            with open(filename, "w") as f:
-                pickle.dump(reply, f)
-            return True
+    except ServiceUnavailable:
+        return False
+
+    # A request the broker refused comes back as None, like a timeout,
+    # and is retried later
+    if reply:
+        store.store_reply(uuid, reply, attempts)
+        return True
 
     return False
 
+class PendingQueue(object):
+    """Requests waiting to be dispatched, and the queue log behind them
+
+    Pending requests are queued per service and dispatched on a thread
+    pool, taking services in turn, with at most service_limit requests
+    in flight to any one service. A service whose request fails is
+    paused until the next retry(), so a slow or missing service holds
+    up only its own requests.
+
+    The log has a "-<uuid>" line per request taken in, and a "+<uuid>"
+    line once it's dispatched. It's read once when Titanic starts, and
+    rewritten with just the pending requests then and whenever enough
+    dispatched ones have piled up, so neither start up nor dispatch
+    cost grows with history.
+    """
+
+    compact_after = 1024 # Least dispatched entries before a rewrite
+    workers = 16 # Most requests in flight, across all services
+    service_limit = 4 # Most requests in flight to one service
+
+    def __init__(self, filename, store, client, workers=16, service_limit=4):
+        self.filename = filename
+        self.store = store
+        self.client = client
+        self.workers = workers
+        self.service_limit = service_limit
+        self.queues = {} # Service to its pending UUIDs
+        self.order = deque() # Services with queued requests, taken in turn
+        self.inflight = {} # Service to its requests in flight
+        self.dispatching = {} # UUID to service, for requests in flight
+        self.paused = set() # Services that failed, until the next retry
+        self.attempts = {} # UUID to dispatch attempts, for those tried
+        self.dispatched = 0 # Entries in the log since the last rewrite
+        self.log = None
+        self.closed = False
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(workers)
+
+        pending = {}
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                for entry in f:
+                    uuid = entry[1:].rstrip()
+                    if entry[:1] == b'-':
+                        pending[uuid] = len(pending)
+                    elif entry[:1] == b'+':
+                        pending.pop(uuid, None)
+        # The log isn't fsynced, so also pick up requests that made it
+        # to the store but whose entry didn't make it to the log
+        for uuid in store.unanswered():
+            pending.setdefault(uuid, len(pending))
+        for uuid in sorted(pending, key=pending.get):
+            # Only the record header is read, not the whole request
+            service = store.request_service(uuid)
+            if service is not None:
+                self.enqueue(uuid, service)
+        self.compact()
+
+    def __len__(self):
+        return len(self.dispatching) + sum(
+            len(queue) for queue in self.queues.values()
+        )
+
+    def compact(self):
+        """Rewrite the log with only the pending requests"""
+        if self.log is not None:
+            self.log.close()
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'wb') as f:
+            for uuid in self.dispatching:
+                f.write(b"-" + uuid + b"\n")
+            for queue in self.queues.values():
+                for uuid in queue:
+                    f.write(b"-" + uuid + b"\n")
+        os.rename(temporary, self.filename)
+        self.log = open(self.filename, 'ab')
+        self.dispatched = 0
+
+    def add(self, uuid, service):
+        """Queue a new request, dispatching it if there's room"""
+        with self.lock:
+            self.log.write(b"-" + uuid + b"\n")
+            self.log.flush()
+            self.enqueue(uuid, service)
+            self.dispatch()
+
+    def enqueue(self, uuid, service, first=False):
+        queue = self.queues.get(service)
+        if queue is None:
+            queue = self.queues[service] = deque()
+            self.order.append(service)
+        if first:
+            queue.appendleft(uuid)
+        else:
+            queue.append(uuid)
+
+    def done(self, uuid):
+        """Record that a request no longer needs dispatching"""
+        self.log.write(b"+" + uuid + b"\n")
+        self.log.flush()
+        self.dispatched += 1
+        if self.dispatched >= max(self.compact_after, len(self)):
+            self.compact()
+
+    def dispatch(self):
+        """Start queued requests, services in turn, while there's room"""
+        with self.lock:
+            while not self.closed and len(self.dispatching) < self.workers:
+                for _ in range(len(self.order)):
+                    service = self.order[0]
+                    self.order.rotate(-1)
+                    if (service not in self.paused and
+                            self.inflight.get(service, 0) <
+                            self.service_limit):
+                        break
+                else:
+                    return # Nothing can start
+
+                queue = self.queues[service]
+                uuid = queue.popleft()
+                if not queue:
+                    del self.queues[service]
+                    self.order.remove(service)
+                self.inflight[service] = self.inflight.get(service, 0) + 1
+                self.dispatching[uuid] = service
+                attempts = self.attempts[uuid] = self.attempts.get(uuid, 0) + 1
+                future = self.executor.submit(self.attempt, uuid, attempts)
+                future.add_done_callback(
+                    lambda future, uuid=uuid: self.finished(uuid, future)
+                )
+
+    def attempt(self, uuid, attempts):
+        """Dispatch one request, returns True once it needs no more tries"""
+        print("I: processing request %s" % uuid.decode("ascii"))
+        return service_success(self.client, self.store, uuid, attempts)
+
+    def finished(self, uuid, future):
+        """Record the outcome of a request and start the next ones"""
+        success = future.exception() is None and future.result()
+        if future.exception() is not None:
+            logging.error("E: dispatching %s failed: %r",
+                          uuid.decode("ascii"), future.exception())
+        with self.lock:
+            service = self.dispatching.pop(uuid)
+            self.inflight[service] -= 1
+            if not self.inflight[service]:
+                del self.inflight[service]
+            if success:
+                del self.attempts[uuid]
+                self.done(uuid)
+            else:
+                # Keep its place, and leave the service be for a while
+                self.enqueue(uuid, service, first=True)
+                self.paused.add(service)
+            self.dispatch()
+
+    def retry(self):
+        """Resume paused services"""
+        with self.lock:
+            self.paused.clear()
+            self.dispatch()
+
+    def close(self):
+        """Wait for requests in flight, then close the log
+
+        Requests still queued stay pending in the log.
+        """
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=True)
+        self.log.close()
+
 def main():
     verbose = '-v' in sys.argv
     ctx = zmq.Context()
 
-    # Create MDP client session with short timeout
-    client = MajorDomoClient("tcp://localhost:5555", verbose)
-    client.timeout = 1000 # 1 sec
-    client.retries = 1 # only 1 retry
-
-    request_pipe, peer = zpipe(ctx)
-    request_thread = threading.Thread(target=titanic_request, args=(peer,))
-    request_thread.daemon = True
-    request_thread.start()
-    reply_thread = threading.Thread(target=titanic_reply)
+    # Requests and replies go to segment files, or with --files to the
+    # original file per message, fsynced as --sync=none|group|message says
+    sync = SYNC_GROUP
+    for arg in sys.argv[1:]:
+        if arg.startswith('--sync='):
+            sync = arg[len('--sync='):]
+            assert sync in SYNC_MODES, "--sync must be one of %s" % (
+                ", ".join(SYNC_MODES)
+            )
+    if '--files' in sys.argv:
+        store = FileStore(TITANIC_DIR, sync=sync)
+    else:
+        store = SegmentStore(TITANIC_DIR, sync=sync)
+
+    # Pooled MDP clients with short timeout, one per dispatch thread
+    pool = ClientPool(
+        "tcp://localhost:5555", size=PendingQueue.workers, verbose=verbose
+    )
+    pool.timeout = 1000 # 1 sec
+    pool.retries = 1 # only 1 retry
+    client = ServiceGuard(pool)
+    queue = PendingQueue(os.path.join(TITANIC_DIR, 'queue'), store, client)
+
+    # Request threads push new UUIDs to the dispatcher
+    request_pipe = ctx.socket(zmq.PULL)
+    request_pipe.linger = 0
+    request_pipe.bind("inproc://titanic.queue")
+    for _ in range(REQUEST_THREADS):
+        peer = ctx.socket(zmq.PUSH)
+        peer.linger = 0
+        peer.connect("inproc://titanic.queue")
+        request_thread = threading.Thread(
+            target=titanic_request, args=(peer, store)
+        )
+        request_thread.daemon = True
+        request_thread.start()
+    reply_thread = threading.Thread(target=titanic_reply, args=(store,))
     reply_thread.daemon = True
     reply_thread.start()
-    close_thread = threading.Thread(target=titanic_close)
+    close_thread = threading.Thread(target=titanic_close, args=(store,))
     close_thread.daemon = True
     close_thread.start()
 
@@ -155,35 +338,27 @@ def main():
     poller.register(request_pipe, zmq.POLLIN)
 
     # Main dispatcher loop
+    retry_at = time.time()
     while True:
-        # Ensure message directory exists
-        if not os.path.exists(TITANIC_DIR):
-            os.mkdir(TITANIC_DIR)
-        # We'll dispatch once per second, if there's no activity
+        # We'll retry failed services once per second
+        timeout = max(0, 1e3 * (retry_at - time.time()))
         try:
-            items = poller.poll(1000)
+            items = poller.poll(timeout)
         except KeyboardInterrupt:
             break
 
         if items:
-            # Append UUID to queue, prefixed with '-' for pending
-            uuid = request_pipe.recv()
-            with open(os.path.join(TITANIC_DIR, 'queue'), 'a') as f:
-                f.write("-%s\n" % uuid)
-
-        # Brute force dispatcher
-        with open(os.path.join(TITANIC_DIR, 'queue'), 'r+b') as f:
-            for entry in f.readlines():
-                # UUID is prefixed with '-' if still waiting
-                if entry[0] == '-':
-                    uuid = entry[1:].rstrip() # rstrip '\n' etc.
-                    print("I: processing request %s" % uuid)
-                    if service_success(client, uuid):
-                        # mark queue entry as processed
-                        here = f.tell()
-                        f.seek(-1*len(entry), os.SEEK_CUR)
-                        f.write("+")
-                        f.seek(here, os.SEEK_SET)
+            # Queue the new request, it's sent as soon as there's room
+            uuid, service = request_pipe.recv_multipart()
+            queue.add(uuid, service)
+
+        if time.time() >= retry_at:
+            queue.retry()
+            retry_at = time.time() + 1
+
+    queue.close()
+    pool.destroy()
+    store.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,203 @@
+# Titanic record format
+#
+# How Titanic stores a request or reply, replacing pickle. A record is a
+# fixed header ending in a table of frame end offsets, the service
+# name, a checksum, then the frames back to back:
+#
+#   magic "TR", version, flags, created, attempts, service length,
+#   frame count, frame count x 4 byte end offset, from the start of
+#   the frames
+#   service
+#   CRC-32
+#   frames
+#
+# All integers are big endian. The CRC-32 covers everything before it,
+# and the frames too unless the FLAG_HEADER_ONLY flag is set. The
+# offset table lets a reader pull out a single frame, or just the
+# header, without decoding the rest.
+#
+# The header, offset table and service are packed and unpacked by one
+# struct, cached per frame count and service length, so a record costs
+# one pack, one CRC-32 call over the header and one join to encode, and
+# decoded frames are memoryviews into the record rather than copies.
+#
+# Against the protocol 2 pickles Titanic used to write, records win at
+# every size benchmarks/bench_titanic_record.py tries, 256 bytes to
+# 256KB, with or without check_body: a header only record encodes and
+# decodes 2 to 4 times faster at 1KB and over 100 times faster from
+# 64KB, where protocol 2 pickles bytes by way of latin-1 strings, and
+# comes out a third smaller. A checked record is still 2 to 20 times
+# faster. Against pickle at its newest protocol, which does the whole
+# job in a single C call, records only win on decoding from around 64KB,
+# as their frames aren't copied. Below that a header only record loses
+# by a fixed couple of microseconds of Python calls, and with check_body
+# the CRC-32 over the frames costs several times what pickle's copy
+# does, and pickle checks nothing.
+#
+# What the format buys over either is a record that can be loaded from
+# disk without unpickling it, that says when it's damaged, and whose
+# header and frames can be read on their own. A caller that doesn't
+# need the checksum over the frames leaves check_body off, and only the
+# header, offset table and service are checked. Damage to the frames
+# then goes unnoticed, though truncation doesn't.
+
+import struct
+import time
+import zlib
+
+MAGIC = b"TR"
+VERSION = 2
+FLAG_HEADER_ONLY = 0x01 # The CRC-32 doesn't cover the frames
+
+HEADER = struct.Struct(">2sBBdHHH")
+OFFSET = struct.Struct(">I")
+CRC = struct.Struct(">I")
+
+_layouts = {} # (frame count, service length) to the struct for header,
+              # offset table and service
+
+
+def layout(count, service_length):
+    """Returns the struct for the header, offset table and service of a
+    record with count frames
+    """
+    packer = _layouts.get((count, service_length))
+    if packer is None:
+        packer = _layouts[count, service_length] = struct.Struct(
+            "%s%dI%ds" % (HEADER.format, count, service_length)
+        )
+    return packer
+
+
+class RecordError(ValueError):
+    """The data isn't a valid record"""
+
+
+class Record(object):
+    """A decoded record"""
+    __slots__ = (
+        'service', # Service the request is for
+        'created', # When the record was written, secs since the epoch
+        'attempts', # Dispatch attempts made, for a reply
+        'frames', # Message frames as memoryviews into the record
+    )
+
+    def __init__(self, service, created, attempts, frames):
+        self.service = service
+        self.created = created
+        self.attempts = attempts
+        self.frames = frames
+
+
+def encode(frames, service=b"", created=None, attempts=0, check_body=False):
+    """Returns frames, a list of bytes, as a record
+
+    The checksum covers the frames only with check_body.
+    """
+    ends = []
+    end = 0
+    for frame in frames:
+        end += len(frame)
+        ends.append(end)
+    try:
+        packer = _layouts[len(ends), len(service)]
+    except KeyError:
+        packer = layout(len(ends), len(service))
+    head = packer.pack(
+        MAGIC, VERSION, 0 if check_body else FLAG_HEADER_ONLY,
+        time.time() if created is None else created, attempts,
+        len(service), len(ends), *ends, service
+    )
+    crc = zlib.crc32(head)
+    if check_body:
+        for frame in frames:
+            crc = zlib.crc32(frame, crc)
+    return b"".join([head, CRC.pack(crc), *frames])
+
+
+def header(data):
+    """Returns the header fields of a record, checking only the header
+
+    (created, attempts, service length, frame count)
+    """
+    if len(data) < HEADER.size:
+        raise RecordError("truncated header")
+    (magic, version, flags, created, attempts, service_length,
+     count) = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise RecordError("bad magic %r" % magic)
+    if version != VERSION:
+        raise RecordError("unsupported version %d" % version)
+    if (len(data) <
+            HEADER.size + OFFSET.size * count + service_length + CRC.size):
+        raise RecordError("truncated record")
+    return created, attempts, service_length, count
+
+
+def service(data):
+    """Returns the service of a record, without decoding its frames"""
+    created, attempts, service_length, count = header(data)
+    start = HEADER.size + OFFSET.size * count
+    return bytes(data[start:start + service_length])
+
+
+def frame(data, index):
+    """Returns one frame of a record, without decoding the others
+
+    Doesn't verify the checksum, decode() does.
+    """
+    created, attempts, service_length, count = header(data)
+    if not 0 <= index < count:
+        raise IndexError(index)
+    table = HEADER.size
+    start = table + OFFSET.size * count + service_length + CRC.size
+    end = start + OFFSET.unpack_from(data, table + OFFSET.size * index)[0]
+    if index:
+        start += OFFSET.unpack_from(data, table + OFFSET.size * (index - 1))[0]
+    if end > len(data):
+        raise RecordError("truncated frame")
+    return bytes(data[start:end])
+
+
+def decode(data):
+    """Returns the Record in data, raises RecordError if it's damaged
+
+    The frames are views of data, not copies. Damage to the frames is
+    only found if the record checks its body.
+    """
+    try:
+        (magic, version, flags, created, attempts, service_length,
+         count) = HEADER.unpack_from(data)
+    except struct.error:
+        raise RecordError("truncated header")
+    if magic != MAGIC:
+        raise RecordError("bad magic %r" % magic)
+    if version != VERSION:
+        raise RecordError("unsupported version %d" % version)
+    try:
+        packer = _layouts[count, service_length]
+    except KeyError:
+        packer = layout(count, service_length)
+    try:
+        fields = packer.unpack_from(data)
+        stored = CRC.unpack_from(data, packer.size)[0]
+    except struct.error:
+        raise RecordError("truncated record")
+    body = packer.size + CRC.size
+    end = body + fields[6 + count] if count else body
+    if end != len(data):
+        raise RecordError("record length mismatch")
+    view = memoryview(data)
+    crc = zlib.crc32(view[:packer.size])
+    if not flags & FLAG_HEADER_ONLY:
+        crc = zlib.crc32(view[body:], crc)
+    if crc != stored:
+        raise RecordError("checksum mismatch")
+
+    frames = []
+    start = body
+    for end in fields[7:-1]: # The offset table follows the 7 header fields
+        end += body
+        frames.append(view[start:end])
+        start = end
+    return Record(fields[-1], created, attempts, frames)
@@ -0,0 +1,554 @@
+# Titanic storage backends
+#
+# Titanic keeps every request until the client closes it, and every
+# reply until it's fetched. A backend stores both, as lists of frames,
+# by request UUID:
+#
+#   store_request(uuid, frames)   fetch_request(uuid)   has_request(uuid)
+#   store_reply(uuid, frames)     fetch_reply(uuid)     forget(uuid)
+#
+# Messages are kept in the titanic_record format, the first frame of a
+# request, its service, going in the record header. Fetched frames are
+# memoryviews into the stored record, zmq sends them as they are.
+# Records check their bodies: storing a message costs a write and maybe
+# an fsync, next to which the checksum is cheap, and it's what finds
+# damaged records.
+#
+# FileStore is the original layout, a file per message.
+# SegmentStore appends messages to large segment files instead, and
+# finds them through an in memory index, so storing a message is one
+# buffered write rather than an open, write and close.
+#
+# Both take a sync mode saying when a store call may return:
+#
+#   SYNC_NONE     once written to the OS, survives Titanic but not the machine
+#   SYNC_GROUP    once fsynced, along with whatever else was stored meanwhile
+#   SYNC_MESSAGE  once fsynced on its own
+#
+# SYNC_GROUP only batches when several threads store at once, which is
+# why Titanic takes requests in on several threads.
+#
+# UUIDs are 32 hex digits. Clients pass them back to titanic.reply and
+# titanic.close, so anything else is treated as a UUID that isn't
+# stored.
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from binascii import hexlify, unhexlify
+
+from mdbase import titanic_record
+
+SYNC_NONE = "none"
+SYNC_GROUP = "group"
+SYNC_MESSAGE = "message"
+SYNC_MODES = (SYNC_NONE, SYNC_GROUP, SYNC_MESSAGE)
+
+
+def uuid_key(uuid):
+    """Returns the 16 bytes of a hex UUID, None if it isn't one"""
+    if len(uuid) != 32:
+        return None
+    try:
+        return unhexlify(uuid)
+    except (TypeError, ValueError):
+        return None
+
+
+def fsync_directory(directory):
+    """fsync a directory, so files just created in it survive a crash"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return # Not on this platform
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FileStore(object):
+    """A file per request and reply, in one directory
+
+    Files are fsynced one by one, so SYNC_GROUP is the same as
+    SYNC_MESSAGE here. A file that isn't a valid record, torn by a crash
+    or pickled by an older Titanic, is moved aside to a .damaged file
+    and treated as missing.
+    """
+
+    def __init__(self, directory, sync=SYNC_GROUP):
+        assert sync in SYNC_MODES
+        self.directory = directory
+        self.sync = sync
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def request_filename(self, uuid):
+        """Returns freshly allocated request filename for given UUID,
+        None if it isn't a valid UUID
+        """
+        if uuid_key(uuid) is None:
+            return None
+        return os.path.join(self.directory, "%s.req" % uuid.decode("ascii"))
+
+    def reply_filename(self, uuid):
+        """Returns freshly allocated reply filename for given UUID,
+        None if it isn't a valid UUID
+        """
+        if uuid_key(uuid) is None:
+            return None
+        return os.path.join(self.directory, "%s.reo" % uuid.decode("ascii"))
+
+    def write(self, filename, record):
+        with open(filename, "wb") as f:
+            f.write(record)
+            if self.sync != SYNC_NONE:
+                f.flush()
+                os.fsync(f.fileno())
+        if self.sync != SYNC_NONE:
+            fsync_directory(self.directory)
+
+    def read(self, filename):
+        if filename is None or not os.path.exists(filename):
+            return None
+        with open(filename, "rb") as f:
+            return f.read()
+
+    def load(self, filename, parse):
+        """Returns parse(data) for the record in filename, None if there
+        isn't one or it's damaged
+        """
+        data = self.read(filename)
+        if data is None:
+            return None
+        try:
+            return parse(data)
+        except titanic_record.RecordError as e:
+            logging.error("E: moving damaged record %s aside: %s",
+                          filename, e)
+            try:
+                os.rename(filename, filename + ".damaged")
+            except OSError:
+                pass # Another thread got there first
+            return None
+
+    def store_request(self, uuid, frames):
+        self.write(self.request_filename(uuid), titanic_record.encode(
+            frames[1:], service=frames[0], check_body=True
+        ))
+
+    def fetch_request(self, uuid):
+        record = self.load(
+            self.request_filename(uuid), titanic_record.decode
+        )
+        if record is None:
+            return None
+        return [record.service] + record.frames
+
+    def request_service(self, uuid):
+        """Returns the service of a request, None if there's no request"""
+        return self.load(self.request_filename(uuid), titanic_record.service)
+
+    def has_request(self, uuid):
+        filename = self.request_filename(uuid)
+        return filename is not None and os.path.exists(filename)
+
+    def store_reply(self, uuid, frames, attempts=0):
+        self.write(self.reply_filename(uuid), titanic_record.encode(
+            frames, attempts=attempts, check_body=True
+        ))
+
+    def fetch_reply(self, uuid):
+        record = self.load(self.reply_filename(uuid), titanic_record.decode)
+        if record is None:
+            return None
+        return record.frames
+
+    def unanswered(self):
+        """Returns the UUIDs of requests without a reply"""
+        names = set(os.listdir(self.directory))
+        return [
+            name[:-4].encode("ascii") for name in names
+            if name.endswith(".req") and name[:-4] + ".reo" not in names
+        ]
+
+    def forget(self, uuid):
+        """Delete the request and reply, if any"""
+        for filename in (self.request_filename(uuid),
+                         self.reply_filename(uuid)):
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+
+    def close(self):
+        pass
+
+
+class Segment(object):
+    """One append-only segment file"""
+    __slots__ = (
+        'number', # Position in the log, segments are named by it
+        'path', # File path
+        'size', # Bytes written
+        'live', # Index entries pointing into this segment
+        'live_bytes', # Payload bytes of those entries
+        'map', # Read only mmap of the file, None until first read
+    )
+
+    def __init__(self, number, path, size=0):
+        self.number = number
+        self.path = path
+        self.size = size
+        self.live = 0
+        self.live_bytes = 0
+        self.map = None
+
+    def read(self, offset, length):
+        """Returns length bytes at offset, mapping the file as needed"""
+        if self.map is None or offset + length > len(self.map):
+            # The active segment grows, map it again to see new records
+            if self.map is not None:
+                self.map.close()
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class SegmentStore(object):
+    """Requests and replies appended to segment files
+
+    Each entry is a header of kind, UUID and length, then the message
+    as a titanic_record. An in memory index maps UUIDs to records and is
+    rebuilt by scanning the segments on start up. Forgetting a UUID
+    appends a tombstone record, and segments are deleted from the
+    oldest end once nothing in them is live any more. So a request that
+    is never closed doesn't pin every later segment to the disk, the
+    oldest segment is compacted, its live records copied to the head of
+    the log, once they're little compared to what deleting it frees.
+    Compaction runs under the intake lock, so each call copies at most
+    compact_bytes, and a big segment is moved on over several calls.
+
+    Records are flushed to the OS as they're written. With SYNC_GROUP,
+    the first caller to need an fsync leads a group, it fsyncs once for
+    every record written so far, while the records that arrive during
+    that fsync wait to form the next group. The leader can also wait up
+    to group_window msecs, or until group_size records are waiting,
+    before it fsyncs, to make groups bigger at the cost of latency.
+    Segments are fsynced when they're full and on close whatever the
+    mode.
+    """
+
+    HEADER = struct.Struct(">B16sI") # Kind, UUID, payload length
+    REQUEST = 1
+    REPLY = 2
+    FORGET = 3
+
+    segment_size = 64 * 1024 * 1024 # Start a new segment past this size
+    compact_ratio = 0.25 # Most live bytes to copy per byte compacting frees
+    compact_bytes = 4 * 1024 * 1024 # Most bytes copied per compaction call
+    group_window = 0 # Longest wait for a group to fill, msecs
+    group_size = 64 # Records that make a full group
+
+    def __init__(self, directory, segment_size=None, sync=SYNC_GROUP):
+        assert sync in SYNC_MODES
+        self.directory = directory
+        self.sync = sync
+        if segment_size is not None:
+            self.segment_size = segment_size
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.segments = [] # Oldest first, the last one is written to
+        self.index = {} # (kind, UUID) to (segment, offset, length)
+        self.written = 0 # Records written
+        self.durable = 0 # Records known to be fsynced
+        self.syncing = False # A group fsync is under way
+        self.recover()
+        self.writer = open(self.segments[-1].path, "ab")
+        with self.lock:
+            self.drop_dead_segments()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, "%010d.seg" % number)
+
+    def recover(self):
+        """Rebuild the index from the segments on disk"""
+        numbers = sorted(
+            int(name[:-4]) for name in os.listdir(self.directory)
+            if name.endswith(".seg")
+        )
+        for number in numbers:
+            path = self.segment_path(number)
+            segment = Segment(number, path)
+            self.segments.append(segment)
+            with open(path, "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset + self.HEADER.size <= len(data):
+                kind, key, length = self.HEADER.unpack_from(data, offset)
+                start = offset + self.HEADER.size
+                if start + length > len(data):
+                    break # Torn write at the tail
+                if kind != self.FORGET and not self.valid(data, start, length):
+                    logging.error("E: skipping damaged record in %s at %d",
+                                  path, offset)
+                else:
+                    self.apply(kind, key, segment, start, length)
+                offset = start + length
+            if offset < len(data):
+                # Drop a partial record left by a crash mid write
+                with open(path, "r+b") as f:
+                    f.truncate(offset)
+            segment.size = offset
+        if not self.segments:
+            self.segments.append(Segment(0, self.segment_path(0)))
+            open(self.segments[0].path, "ab").close()
+            fsync_directory(self.directory)
+
+    def valid(self, data, offset, length):
+        """Does data hold an undamaged record at offset"""
+        try:
+            titanic_record.decode(data[offset:offset + length])
+        except titanic_record.RecordError:
+            return False
+        return True
+
+    def apply(self, kind, key, segment, offset, length):
+        """Update the index for a record"""
+        if kind == self.FORGET:
+            for kind in (self.REQUEST, self.REPLY):
+                self.unindex((kind, key))
+        else:
+            self.unindex((kind, key))
+            self.index[(kind, key)] = (segment, offset, length)
+            segment.live += 1
+            segment.live_bytes += length
+
+    def unindex(self, entry):
+        location = self.index.pop(entry, None)
+        if location is not None:
+            location[0].live -= 1
+            location[0].live_bytes -= location[2]
+        return location
+
+    def append(self, kind, uuid, payload=b""):
+        """Append a record, returns once it's as durable as sync asks"""
+        key = uuid_key(uuid)
+        if key is None:
+            raise ValueError("invalid UUID %r" % uuid)
+        with self.lock:
+            self.write(kind, key, payload)
+            if kind == self.FORGET:
+                self.drop_dead_segments()
+
+            if self.sync == SYNC_MESSAGE:
+                os.fsync(self.writer.fileno())
+                self.durable = self.written
+            elif self.sync == SYNC_GROUP:
+                if self.written - self.durable >= self.group_size:
+                    self.synced.notify_all() # Wake the leader, group is full
+                self.commit(self.written)
+
+    def write(self, kind, key, payload):
+        """Write a record to the head of the log, with lock held"""
+        record = self.HEADER.pack(kind, key, len(payload)) + payload
+        segment = self.segments[-1]
+        if segment.size and segment.size + len(record) > self.segment_size:
+            segment = self.roll()
+        self.writer.write(record)
+        self.writer.flush()
+        offset = segment.size + self.HEADER.size
+        segment.size += len(record)
+        self.written += 1
+        self.apply(kind, key, segment, offset, len(payload))
+
+    def commit(self, record):
+        """Wait until record is fsynced, with lock held
+
+        The first caller to arrive leads the group, it fsyncs without
+        the lock so others can append in the meantime, then wakes
+        everyone it covered.
+        """
+        while self.durable < record:
+            if self.syncing:
+                self.synced.wait()
+                continue
+            self.syncing = True
+            end = time.time() + 1e-3 * self.group_window
+            while (self.group_window and
+                   self.written - self.durable < self.group_size):
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self.synced.wait(remaining)
+            written = self.written
+            fileno = self.writer.fileno()
+            self.lock.release()
+            try:
+                os.fsync(fileno)
+            finally:
+                self.lock.acquire()
+                self.syncing = False
+            self.durable = max(self.durable, written)
+            self.synced.notify_all()
+
+    def roll(self):
+        """Seal the segment being written and start a new one"""
+        while self.syncing:
+            # The group leader is fsyncing the writer outside the lock
+            self.synced.wait()
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        self.durable = self.written
+        self.synced.notify_all()
+        number = self.segments[-1].number + 1
+        segment = Segment(number, self.segment_path(number))
+        self.segments.append(segment)
+        self.writer = open(segment.path, "ab")
+        fsync_directory(self.directory)
+        return segment
+
+    def drop_dead_segments(self):
+        """Delete sealed segments with nothing live, oldest first, with
+        lock held
+
+        Going in order keeps any tombstone until the records it buried
+        are gone, so they can't come back on recovery. The oldest
+        segment is compacted first if it's worth it, and only deleted
+        once all its live records have been moved.
+        """
+        while len(self.segments) > 1:
+            segment = self.segments[0]
+            if segment.live:
+                if not self.worth_compacting(segment):
+                    break
+                if not self.compact(segment):
+                    break # More to move next time
+            self.segments.pop(0)
+            segment.unmap()
+            os.remove(segment.path)
+
+    def worth_compacting(self, segment):
+        """Should the oldest segment's live records be moved on
+
+        Yes once they're at most compact_ratio of the bytes deleting it
+        frees, its own and those of the dead segments only waiting for
+        it to go.
+        """
+        freed = segment.size
+        for later in self.segments[1:-1]:
+            if later.live:
+                break
+            freed += later.size
+        return segment.live_bytes <= self.compact_ratio * freed
+
+    def compact(self, segment):
+        """Copy up to compact_bytes of segment's live records to the head
+        of the log, with lock held
+
+        Returns True once none are left, with the copies fsynced, and
+        the caller deletes the segment. Until then a moved record is in
+        both places, and recovery finds the later copy.
+        """
+        logging.info("I: compacting %s, %d live records",
+                     segment.path, segment.live)
+        moving = sorted(
+            (offset, kind, key, length)
+            for (kind, key), (owner, offset, length) in self.index.items()
+            if owner is segment
+        )
+        budget = self.compact_bytes
+        for offset, kind, key, length in moving:
+            if budget <= 0:
+                return False
+            self.write(kind, key, segment.read(offset, length))
+            budget -= length
+        while self.syncing:
+            self.synced.wait()
+        os.fsync(self.writer.fileno())
+        self.durable = self.written
+        self.synced.notify_all()
+        return True
+
+    def fetch(self, kind, uuid):
+        """Returns the record of kind for uuid, None if there isn't one"""
+        key = uuid_key(uuid)
+        if key is None:
+            return None
+        with self.lock:
+            location = self.index.get((kind, key))
+            if location is None:
+                return None
+            segment, offset, length = location
+            return segment.read(offset, length)
+
+    def store_request(self, uuid, frames):
+        self.append(self.REQUEST, uuid, titanic_record.encode(
+            frames[1:], service=frames[0], check_body=True
+        ))
+
+    def fetch_request(self, uuid):
+        data = self.fetch(self.REQUEST, uuid)
+        if data is None:
+            return None
+        record = titanic_record.decode(data)
+        return [record.service] + record.frames
+
+    def request_service(self, uuid):
+        """Returns the service of a request, None if there's no request"""
+        data = self.fetch(self.REQUEST, uuid)
+        if data is None:
+            return None
+        return titanic_record.service(data)
+
+    def has_request(self, uuid):
+        return (self.REQUEST, uuid_key(uuid)) in self.index
+
+    def store_reply(self, uuid, frames, attempts=0):
+        self.append(self.REPLY, uuid, titanic_record.encode(
+            frames, attempts=attempts, check_body=True
+        ))
+
+    def fetch_reply(self, uuid):
+        data = self.fetch(self.REPLY, uuid)
+        if data is None:
+            return None
+        return titanic_record.decode(data).frames
+
+    def unanswered(self):
+        """Returns the UUIDs of requests without a reply"""
+        with self.lock:
+            return [
+                hexlify(key) for kind, key in self.index
+                if kind == self.REQUEST and (self.REPLY, key) not in self.index
+            ]
+
+    def forget(self, uuid):
+        """Delete the request and reply, if any"""
+        key = uuid_key(uuid)
+        if key is None:
+            return
+        if ((self.REQUEST, key) in self.index or
+                (self.REPLY, key) in self.index):
+            self.append(self.FORGET, uuid)
+
+    def close(self):
+        with self.lock:
+            while self.syncing:
+                self.synced.wait()
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.writer.close()
+            for segment in self.segments:
+                segment.unmap()
@@ -5,10 +5,13 @@ import os
 
 import zmq
 
+from mdbase.codec import frame_bytes
+
 def dump(msg):
     """Received all message parts from socket, prints neatly"""
     print("-" * 40)
     for part in msg:
+        part = frame_bytes(part)
         print("[%03d]" % len(part)),
         print(part)
 
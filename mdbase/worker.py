@@ -10,9 +10,12 @@ import logging
 import time
 import zmq
 
+from mdbase.codec import (dispatch_time, frame_bytes, frames_bytes,
+                          recv_frames, unpack_properties,
+                          properties_deadline)
 from mdbase.utils import dump
-from mdbase.constants import (W_WORKER, W_READY, W_REQUEST,
-                       W_REPLY, W_DISCONNECT, W_HEARTBEAT)
+from mdbase.constants import (C_STATUS, EXPIRED, W_WORKER, W_READY,
+                       W_REQUEST, W_REPLY, W_DISCONNECT, W_HEARTBEAT)
 
 class MajorDomoWorker(object):
     """Majordomo Protocol Worker API
@@ -30,21 +33,27 @@ class MajorDomoWorker(object):
     liveness = 0 # How many attempts left
     heartbeat = 2500 # Heartbeat delay, msecs
     reconnect = 2500 # Reconnect delay, msecs
+    credit = 1 # Requests the broker may have in flight to us at once
 
     # Internal state
     expect_reply = False # False only at start
+    running = True # Cleared by stop() to leave recv()
 
     timeout = 2500 # poller timeout
     verbose = False # Print activity to stdout
+    copy = True # Return requests as bytes, or as zmq.Frame when False
 
-    # Return address, if any
+    # Return envelope, if any
     reply_to = None
+    properties = None # Properties of the current request
+    deadline = None # When the client gives up on the current request
 
-    def __init__(self, broker, service, verbose=False):
+    def __init__(self, broker, service, verbose=False, credit=1, ctx=None):
         self.broker = broker
         self.service = service
         self.verbose = verbose
-        self.ctx = zmq.Context()
+        self.credit = credit
+        self.ctx = ctx or zmq.Context()
         self.poller = zmq.Poller()
         logging.basicConfig(
             format="%(asctime)s %(message)s",
@@ -65,8 +74,12 @@ class MajorDomoWorker(object):
         if self.verbose:
             logging.info("I: connecting to broker at %s...", self.broker)
 
-        # Register service with broker
-        self.send_to_broker(W_READY, self.service, [])
+        # Register service with broker, asking for more than one
+        # request in flight if we have credit to spare
+        credit = []
+        if self.credit > 1:
+            credit = [str(self.credit).encode("ascii")]
+        self.send_to_broker(W_READY, self.service, credit)
 
         # If liveness hits zero, queue is considered disconnected
         self.liveness = self.HEARTBEAT_LIVENESS
@@ -98,12 +111,12 @@ class MajorDomoWorker(object):
 
         if reply is not None:
             assert self.reply_to is not None
-            reply = [self.reply_to, ''] + reply
+            reply = self.reply_to + [b''] + reply
             self.send_to_broker(W_REPLY, msg=reply)
 
         self.expect_reply = True
 
-        while True:
+        while self.running:
             # Poll socket for a reply, with timeout
             try:
                 items = self.poller.poll(self.timeout)
@@ -111,7 +124,7 @@ class MajorDomoWorker(object):
                 break # Interrupt
 
             if items:
-                msg = self.worker.recv_multipart()
+                msg = recv_frames(self.worker)
                 if self.verbose:
                     logging.info("I: received message from broker: ")
                     dump(msg)
@@ -120,21 +133,34 @@ class MajorDomoWorker(object):
                 # Don't try to handle errors, just assert noisily
                 assert len(msg) >= 3
 
-                empty = msg.pop(0)
-                assert empty == ''
+                assert frame_bytes(msg[0]) == b''
+                assert frame_bytes(msg[1]) == W_WORKER
 
-                header = msg.pop(0)
-                assert header == W_WORKER
-
-                command = msg.pop(0)
+                command = frame_bytes(msg[2])
                 if command == W_REQUEST:
-                    # We should pop and save as many addresses as there are
-                    # Up to a null part, but for now, just save one...
-                    self.reply_to = msg.pop(0)
-                    # pop empty
-                    assert msg.pop(0) == ''
-
-                    return msg # We have a request to process
+                    # Save the return envelope up to the null part, the
+                    # client address and any request properties
+                    self.properties, body = unpack_properties(msg, 4)
+                    self.reply_to = frames_bytes(msg[3:body - 1])
+                    # From when the broker sent it, it may have waited
+                    # here while we handled others
+                    self.deadline = properties_deadline(
+                        self.properties,
+                        dispatch_time(self.properties, time.time())
+                    )
+                    if self.expired():
+                        # Client gave up in transit, answer so the
+                        # broker gives our credit back
+                        self.send_to_broker(W_REPLY, msg=self.reply_to + [
+                            C_STATUS, EXPIRED, b'', EXPIRED
+                        ])
+                        continue
+
+                    # We have a request to process
+                    request = msg[body:]
+                    if self.copy:
+                        request = frames_bytes(request)
+                    return request
                 elif command == W_HEARTBEAT:
                     # Do nothing for heartbeats
                     pass
@@ -142,7 +168,7 @@ class MajorDomoWorker(object):
                     self.reconnect_to_broker()
                 else:
                     logging.error("E: invalid input message: ")
-                    dump(msg)
+                    dump(msg[3:])
 
             else:
                 self.liveness -= 1
@@ -162,8 +188,32 @@ class MajorDomoWorker(object):
                 self.send_to_broker(W_HEARTBEAT)
                 self.heartbeat_at = time.time() + 1e-3 * self.heartbeat
 
-        logging.warn("W: interrupt received, killing worker...")
+        if self.running:
+            logging.warn("W: interrupt received, killing worker...")
         return None
 
+    def remaining(self):
+        """Seconds left before the client gives up on the current
+        request, or None if it set no deadline
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def expired(self):
+        """Has the client given up on the current request"""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def stop(self):
+        """Make recv() return None within a poll timeout, from any thread"""
+        self.running = False
+
+    def close(self):
+        """Disconnect from broker and close our socket, leaving the context"""
+        self.send_to_broker(W_DISCONNECT)
+        self.poller.unregister(self.worker)
+        self.worker.close()
+
     def destroy(self):
         self.ctx.destroy(0)
\ No newline at end of file
@@ -0,0 +1,228 @@
+# Majordomo Protocol Worker API, asyncio version
+#
+# Implements the MDP/Worker spec at http:#rfc.zeromq.org/spec:7
+#
+# Runs a handler coroutine per request, up to a concurrency limit, so an
+# I/O bound service can keep many requests in flight from one process.
+# The worker advertises its concurrency to the broker as credit, and
+# heartbeats and reconnects carry on while handlers are awaiting.
+
+import asyncio
+import contextvars
+import logging
+import time
+
+import zmq
+import zmq.asyncio
+
+from mdbase.codec import (dispatch_time, frame_bytes, frames_bytes,
+                          unpack_properties, properties_deadline)
+from mdbase.constants import (C_STATUS, EXPIRED, W_WORKER, W_READY,
+                       W_REQUEST, W_REPLY, W_DISCONNECT, W_HEARTBEAT)
+from mdbase.utils import dump
+
+# When the client gives up on the request being handled, per task
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+def remaining():
+    """Seconds left before the client gives up on the request being
+    handled, or None if it set no deadline
+    """
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+def valid_reply(reply):
+    """Is reply a list of frames zmq can send"""
+    return isinstance(reply, list) and all(
+        isinstance(frame, (bytes, bytearray, memoryview, zmq.Frame))
+        for frame in reply
+    )
+
+
+class MajorDomoWorker(object):
+    """Majordomo Protocol Worker API for asyncio
+
+    Calls handler(request) for each request, where request is a list
+    of frames, and sends back the list of frames it returns. Handlers
+    can call remaining() for the time left on the client's deadline.
+    """
+
+    HEARTBEAT_LIVENESS = 3 # 3 - 5 is reasonable
+    broker = None
+    ctx = None
+    service = None
+    handler = None # Coroutine function called per request
+
+    worker = None # Socket to broker
+    liveness = 0 # How many attempts left
+    heartbeat = 2500 # Heartbeat delay, msecs
+    reconnect = 2500 # Reconnect delay, msecs
+    concurrency = 10 # Max requests handled at once
+
+    generation = 0 # Bumped on reconnect, stale replies are dropped
+    running = False
+    slots = None # Semaphore limiting requests handled at once
+    tasks = None # Requests being handled
+    verbose = False # Print activity to stdout
+    copy = True # Pass requests as bytes, or as zmq.Frame when False
+
+    def __init__(self, broker, service, handler, concurrency=10,
+                 verbose=False):
+        self.broker = broker
+        self.service = service
+        self.handler = handler
+        self.concurrency = concurrency
+        self.verbose = verbose
+        self.tasks = set()
+        self.ctx = zmq.asyncio.Context()
+        logging.basicConfig(
+            format="%(asctime)s %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+            level=logging.INFO
+        )
+
+    def reconnect_to_broker(self):
+        """Connect or reconnect to broker"""
+        if self.worker:
+            self.worker.close()
+        self.generation += 1
+        self.worker = self.ctx.socket(zmq.DEALER)
+        self.worker.linger = 0
+        self.worker.connect(self.broker)
+        if self.verbose:
+            logging.info("I: connecting to broker at %s...", self.broker)
+
+        # Register service with broker, with our concurrency as credit
+        credit = str(self.concurrency).encode("ascii")
+        self.send_to_broker(W_READY, self.service, [credit])
+
+        # If liveness hits zero, queue is considered disconnected
+        self.liveness = self.HEARTBEAT_LIVENESS
+
+    def send_to_broker(self, command, option=None, msg=None):
+        """Send message to broker.
+
+        If no msg is provided, creates one internally
+        """
+        if msg is None:
+            msg = []
+        elif not isinstance(msg, list):
+            msg = [msg]
+
+        if option:
+            msg = [option] + msg
+
+        msg = [b'', W_WORKER, command] + msg
+        if self.verbose:
+            logging.info("I: sending %s to broker", command)
+            dump(msg)
+        return self.worker.send_multipart(msg)
+
+    async def run(self):
+        """Serve requests until stopped"""
+        self.running = True
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.reconnect_to_broker()
+        heartbeats = asyncio.ensure_future(self.send_heartbeats())
+        try:
+            while self.running:
+                if await self.worker.poll(self.heartbeat, zmq.POLLIN):
+                    msg = await self.worker.recv_multipart(copy=False)
+                    self.liveness = self.HEARTBEAT_LIVENESS
+                    self.process(msg)
+                else:
+                    self.liveness -= 1
+                    if self.liveness == 0:
+                        if self.verbose:
+                            logging.warning(
+                                "W: disconnected from broker - retrying..."
+                            )
+                        await asyncio.sleep(1e-3 * self.reconnect)
+                        self.reconnect_to_broker()
+        finally:
+            heartbeats.cancel()
+
+    def stop(self):
+        """Stop taking requests, handlers already running carry on"""
+        self.running = False
+
+    def process(self, msg):
+        """Handle a message from the broker"""
+        if self.verbose:
+            logging.info("I: received message from broker: ")
+            dump(msg)
+
+        # Don't try to handle errors, just assert noisily
+        assert len(msg) >= 3
+        assert frame_bytes(msg[0]) == b''
+        assert frame_bytes(msg[1]) == W_WORKER
+
+        command = frame_bytes(msg[2])
+        if command == W_REQUEST:
+            # Return envelope is the client address and any request
+            # properties, up to the null part
+            properties, body = unpack_properties(msg, 4)
+            reply_to = frames_bytes(msg[3:body - 1])
+            # From when the broker sent it, in case a busy loop kept it
+            # waiting here
+            deadline = properties_deadline(
+                properties, dispatch_time(properties, time.time())
+            )
+            request = msg[body:]
+            if self.copy:
+                request = frames_bytes(request)
+            task = asyncio.ensure_future(
+                self.handle(reply_to, request, self.generation, deadline)
+            )
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        elif command == W_HEARTBEAT:
+            # Do nothing for heartbeats
+            pass
+        elif command == W_DISCONNECT:
+            self.reconnect_to_broker()
+        else:
+            logging.error("E: invalid input message: ")
+            dump(msg[3:])
+
+    async def handle(self, reply_to, request, generation, deadline=None):
+        """Run the handler for one request and send back its reply
+
+        Requests whose client gave up before a slot came free are
+        answered 504 without running the handler. A handler that fails,
+        or returns something other than bytes or a list of them, is
+        answered 500, so the reply still goes and the credit comes back.
+        """
+        request_deadline.set(deadline)
+        # Credit keeps the broker within our concurrency, but requests
+        # from before a reconnect may still be running
+        async with self.slots:
+            if deadline is not None and deadline <= time.time():
+                reply_to = reply_to + [C_STATUS, EXPIRED]
+                reply = [EXPIRED]
+            else:
+                try:
+                    reply = await self.handler(request)
+                except Exception:
+                    logging.exception("E: handler failed")
+                    reply = [b"500"]
+        if not isinstance(reply, list):
+            reply = [reply]
+        if not valid_reply(reply):
+            logging.error("E: handler returned %r, not bytes", reply)
+            reply = [b"500"]
+
+        # The broker forgot about requests from before a reconnect
+        if generation == self.generation:
+            await self.send_to_broker(W_REPLY, msg=reply_to + [b''] + reply)
+
+    async def send_heartbeats(self):
+        """Send HEARTBEAT every heartbeat interval"""
+        while True:
+            await asyncio.sleep(1e-3 * self.heartbeat)
+            await self.send_to_broker(W_HEARTBEAT)
+
+    def destroy(self):
+        self.ctx.destroy(0)
@@ -1,3 +1,4 @@
+import json
 import logging
 import pytest
 import sys
@@ -7,8 +8,11 @@ import zmq
 from mock import Mock, patch
 from test import support
 
-from mdbase.broker import (Service, Worker, MajorDomoBroker, W_READY, W_REQUEST, W_DISCONNECT,
-                           W_HEARTBEAT, W_REPLY, C_CLIENT)
+from mdbase.broker import (Service, Worker, Request, RequestQueue, HashRing,
+                           MajorDomoBroker,
+                           W_READY, W_REQUEST, W_DISCONNECT,
+                           W_HEARTBEAT, W_REPLY, W_WORKER, C_CLIENT, C_CLIENT_EXT,
+                           C_STATUS, REJECTED, EXPIRED)
 
 log = logging.getLogger()
 log.addHandler(logging.StreamHandler(sys.stdout))
@@ -16,12 +20,16 @@ log.addHandler(logging.StreamHandler(sys.stdout))
 
 @pytest.fixture
 def broker():
-    return MajorDomoBroker()
+    b = MajorDomoBroker()
+    yield b
+    b.ctx.destroy(0)
 
 
 @pytest.fixture
 def broker_verbose():
-    return MajorDomoBroker(True)
+    b = MajorDomoBroker(True)
+    yield b
+    b.ctx.destroy(0)
 
 
 @pytest.fixture
@@ -39,11 +47,120 @@ class TestBrokerService():
         """Test instantiating service model"""
         name = "Service1"
         s = Service(name)
-        assert s.requests == []
-        assert s.waiting == []
+        assert len(s.requests) == 0
+        assert len(s.waiting) == 0
         assert s.name == name
 
 
+class TestRequestQueue():
+    def request(self, priority=None):
+        properties = None
+        if priority is not None:
+            properties = {b"priority": priority}
+        return Request([b"CLIENT", b"", b"body"], properties)
+
+    def test_strict(self):
+        """Test higher priority lanes always go first"""
+        q = RequestQueue(3, 1)
+        low, normal, high = [self.request(p) for p in (b"2", None, b"0")]
+        for request in (low, normal, high):
+            q.append(request)
+        assert len(q) == 3
+        assert [q.popleft() for i in range(3)] == [high, normal, low]
+        assert len(q) == 0
+
+    def test_priority_clamped(self):
+        """Test out of range priorities use the nearest lane, junk the default"""
+        q = RequestQueue(3, 1)
+        assert q.lane({b"priority": b"-4"}) == 0
+        assert q.lane({b"priority": b"9"}) == 2
+        assert q.lane({b"priority": b"high"}) == 1
+        assert q.lane(None) == 1
+
+    def test_weighted(self):
+        """Test lanes share dispatches by weight, interleaved"""
+        q = RequestQueue(2, 0, weights=[3, 1])
+        for i in range(8):
+            q.append(self.request(b"0"))
+            q.append(self.request(b"1"))
+        lanes = [q.popleft().lane for i in range(8)]
+        assert lanes.count(0) == 6
+        assert lanes.count(1) == 2
+        assert lanes[:4].count(1) == 1
+
+    def test_remove_expired(self):
+        """Test expired requests are removed from every lane"""
+        queue = RequestQueue(2)
+        requests = []
+        for lane, timeout in ((0, b"10"), (1, b"5000"), (1, b"10")):
+            request = Request([b"C", b"", b"x"],
+                              {b"priority": b"%d" % lane,
+                               b"timeout": timeout})
+            requests.append(request)
+            queue.append(request)
+        now = requests[0].queued_at + 1
+        assert queue.remove_expired(now) == [requests[0], requests[2]]
+        assert len(queue) == 1
+        assert queue.popleft() is requests[1]
+
+    def test_pop_oldest(self):
+        """Test the request queued longest is found across lanes"""
+        q = RequestQueue(2, 0)
+        old = self.request(b"1")
+        old.queued_at -= 10
+        q.append(self.request(b"0"))
+        q.append(old)
+        assert q.oldest() is old
+        assert q.pop_oldest() is old
+        assert q.depths() == [1, 0]
+
+
+class TestHashRing():
+    def test_remap_minimal(self):
+        """Test removing a worker only moves the keys it owned"""
+        workers = [Worker(b"%d" % i, b"w%d" % i, 1000) for i in range(8)]
+        ring = HashRing(workers)
+        assert len(ring) == 8
+        keys = [b"key%d" % i for i in range(2000)]
+        before = dict((key, ring.get(key)) for key in keys)
+        assert len(set(before.values())) == 8
+
+        ring.remove(workers[3])
+        for key in keys:
+            if before[key] is not workers[3]:
+                assert ring.get(key) is before[key]
+            else:
+                assert ring.get(key) is not workers[3]
+
+        ring.add(workers[3])
+        assert dict((key, ring.get(key)) for key in keys) == before
+
+    def test_batched_changes(self):
+        """Test changes applied together match a ring built afresh"""
+        workers = [Worker(b"%d" % i, b"w%d" % i, 1000) for i in range(600)]
+        ring = HashRing(workers[:300])
+        ring.get(b"key")
+        for worker in workers[300:]:
+            ring.add(worker) # More points than BATCH, merged in one pass
+        ring.remove(workers[0])
+        ring.add(workers[0]) # Back before any lookup
+        ring.add(workers[1])
+        ring.remove(workers[1])
+        ring.remove(workers[1]) # Already gone
+        for worker in workers[2:10]:
+            ring.remove(worker)
+
+        fresh = HashRing([workers[0]] + workers[10:])
+        assert len(ring) == len(fresh) == 591
+        keys = [b"key%d" % i for i in range(2000)]
+        assert [ring.get(k) for k in keys] == [fresh.get(k) for k in keys]
+        assert ring.hashes == fresh.hashes
+
+    def test_empty(self):
+        """Test an empty ring owns no keys"""
+        assert HashRing().get(b"key") is None
+
+
 class TestBrokerWorker():
     def test_worker_instantiate(self):
         """Test instantiating worker model"""
@@ -66,12 +183,303 @@ class TestBrokerModel():
         assert b.verbose == verbose
         assert b.services == {}
         assert b.workers == {}
-        assert b.waiting == []
-        assert b.heartbeat_at
+        assert b.timers == []
         assert isinstance(b.ctx, zmq.Context)
         assert b.socket
         assert b.socket.linger == 0
         assert isinstance(b.poller, zmq.Poller)
+        assert b.batch_size == 1
+
+    def test_broker_batch_size(self):
+        """Test configuring the broker receive batch size"""
+        b = MajorDomoBroker(batch_size=64)
+        assert b.batch_size == 64
+        b.destroy()
+
+    def test_recv_batch(self, broker):
+        """Test draining messages in batches without blocking"""
+        broker.batch_size = 2
+        broker.socket.recv_multipart = Mock(
+            side_effect=[[b"1"], [b"2"], [b"3"], zmq.Again()]
+        )
+        assert broker.recv_batch() == [[b"1"], [b"2"]]
+        assert broker.recv_batch() == [[b"3"]]
+        broker.socket.recv_multipart.assert_called_with(zmq.NOBLOCK, copy=False)
+
+    def test_process_message(self, broker):
+        """Test routing a message to the client handler"""
+        broker.process_client = Mock()
+        broker.process_message([b"CLIENT", b"", C_CLIENT, b"srv1", b"hello"])
+        broker.process_client.assert_called_with(b"CLIENT", [b"srv1", b"hello"])
+
+    def test_process_message_frames(self, broker, address):
+        """Test body frames are forwarded to the worker without copying"""
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        broker.worker_waiting(worker)
+        sent = []
+        broker.socket.send_multipart = sent.append
+
+        body = zmq.Frame(b"x" * 1024)
+        broker.process_message([
+            zmq.Frame(b"CLIENT"), zmq.Frame(b""), zmq.Frame(C_CLIENT),
+            zmq.Frame(b"S_ECHO"), body
+        ])
+        assert sent[0][-1] is body
+        assert sent[0][:6] == [address, b"", W_WORKER, W_REQUEST, b"CLIENT", b""]
+
+    def test_process_message_properties(self, broker, address):
+        """Test extended client properties ride to the worker and back"""
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        broker.worker_waiting(worker)
+        sent = []
+        broker.socket.send_multipart = sent.append
+
+        broker.process_message([
+            b"CLIENT", b"", C_CLIENT_EXT, b"S_ECHO", b"id", b"7", b"", b"hello"
+        ])
+        assert sent[-1] == [address, b"", W_WORKER, W_REQUEST,
+                            b"CLIENT", b"id", b"7", b"", b"hello"]
+
+        broker.process_worker(
+            address, [W_REPLY, b"CLIENT", b"id", b"7", b"", b"world"]
+        )
+        assert sent[-1] == [b"CLIENT", b"", C_CLIENT_EXT, b"S_ECHO",
+                            b"id", b"7", b"", b"world"]
+
+    def test_dispatch_deadline(self, broker, address):
+        """Test expired requests are dropped and the rest get the time left"""
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        sent = []
+        broker.socket.send_multipart = sent.append
+
+        with patch("time.time", return_value=100.0):
+            broker.process_client(b"C1", [b"S_ECHO", b"old"],
+                                  {b"timeout": b"1000"})
+            broker.process_client(b"C2", [b"S_ECHO", b"new"],
+                                  {b"timeout": b"5000"})
+        with patch("time.time", return_value=102.0):
+            broker.worker_waiting(worker)
+        assert sent == [[address, b"", W_WORKER, W_REQUEST,
+                         b"C2", b"timeout", b"3000", b"dispatched",
+                         b"102000", b"", b"new"]]
+        assert worker.service.stats.expired == 1
+        assert len(worker.service.requests) == 0
+
+    def test_dispatch_priority(self, broker, address):
+        """Test interactive requests overtake queued bulk requests"""
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        sent = []
+        broker.socket.send_multipart = sent.append
+        broker.process_client(b"BULK", [b"S_ECHO", b"bulk"],
+                              {b"priority": b"2"})
+        broker.process_client(b"USER", [b"S_ECHO", b"user"],
+                              {b"priority": b"0"})
+
+        info = broker.service_stats(worker.service)
+        assert [lane["depth"] for lane in info["lanes"]] == [1, 0, 1]
+        broker.worker_waiting(worker)
+        assert sent[0][4] == b"USER"
+        info = broker.service_stats(worker.service)
+        assert [lane["dispatched"] for lane in info["lanes"]] == [1, 0, 0]
+        assert info["lanes"][2]["depth"] == 1
+
+    def test_dispatch_affinity(self, broker):
+        """Test keyed requests stick to a worker, and move when it's busy"""
+        srv = broker.require_service(b"S_ECHO")
+        for i in range(4):
+            broker.process_worker(b"worker%d" % i, [W_READY, b"S_ECHO"])
+        sent = []
+        broker.socket.send_multipart = sent.append
+
+        owner = None
+        for i in range(3):
+            broker.process_client(b"C1", [b"S_ECHO", b"hello"],
+                                  {b"key": b"user-42"})
+            worker = broker.require_worker(sent[-1][0])
+            if owner is None:
+                owner = worker
+            assert worker is owner
+            broker.process_worker(owner.address,
+                                  [W_REPLY, b"C1", b"key", b"user-42", b"",
+                                   b"world"])
+        assert srv.stats.affinity == 3
+
+        # Owner busy, the next keyed request goes to another worker
+        broker.process_client(b"C1", [b"S_ECHO", b"a"], {b"key": b"user-42"})
+        broker.process_client(b"C1", [b"S_ECHO", b"b"], {b"key": b"user-42"})
+        assert sent[-1][0] != owner.address
+        assert srv.stats.rerouted == 1
+
+        # Leaving the service takes the worker off the ring
+        broker.delete_worker(owner, False)
+        assert len(srv.ring) == 3
+        assert srv.ring.get(b"user-42") is not owner
+
+    def test_coalesce(self, broker, address):
+        """Test identical requests share one dispatch and its reply"""
+        broker.set_idempotent(b"S_ECHO")
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        broker.worker_waiting(worker)
+        sent = []
+        broker.socket.send_multipart = sent.append
+
+        broker.process_client(b"C1", [b"S_ECHO", b"hello"])
+        broker.process_client(b"C2", [b"S_ECHO", b"hello"],
+                              {b"id": b"7"})
+        broker.process_client(b"C3", [b"S_ECHO", zmq.Frame(b"hello")])
+        assert len(sent) == 1
+        flight = sent[0][6]
+        assert sent[0][4:] == [b"C1", b"flight", flight, b"", b"hello"]
+        assert worker.service.stats.coalesced == 2
+
+        broker.process_worker(address, [W_REPLY, b"C1", b"flight", flight,
+                                        b"", b"world"])
+        assert sent[1:] == [
+            [b"C1", b"", C_CLIENT, b"S_ECHO", b"world"],
+            [b"C2", b"", C_CLIENT_EXT, b"S_ECHO", b"id", b"7", b"", b"world"],
+            [b"C3", b"", C_CLIENT, b"S_ECHO", b"world"],
+        ]
+        assert worker.service.flights == {}
+        assert worker.flights == {}
+
+        # Once landed, the next identical request is dispatched again
+        broker.process_client(b"C4", [b"S_ECHO", b"hello"])
+        assert sent[-1][4] == b"C4"
+
+    def test_coalesce_leader_expired(self, broker, address):
+        """Test the next request leads when a flight's leader expires"""
+        broker.set_idempotent(b"S_ECHO")
+        srv = broker.require_service(b"S_ECHO")
+        sent = []
+        broker.socket.send_multipart = sent.append
+        with patch("time.time", return_value=100.0):
+            broker.process_client(b"C1", [b"S_ECHO", b"hello"],
+                                  {b"timeout": b"10"})
+            broker.process_client(b"C2", [b"S_ECHO", b"hello"])
+        assert len(srv.requests) == 1
+
+        worker = broker.require_worker(address)
+        worker.service = srv
+        broker.worker_waiting(worker)
+        assert sent[0][4] == b"C2"
+        assert srv.stats.expired == 1
+
+    def test_coalesce_worker_lost(self, broker, address):
+        """Test flights die with the worker they were sent to"""
+        broker.set_idempotent(b"S_ECHO")
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        broker.worker_waiting(worker)
+        broker.socket.send_multipart = Mock()
+        broker.process_client(b"C1", [b"S_ECHO", b"hello"])
+        broker.process_client(b"C2", [b"S_ECHO", b"hello"])
+        broker.delete_worker(worker, False)
+        assert worker.service.flights == {}
+        assert worker.service.following == 0
+        assert broker.queued_requests == 0
+
+    def test_coalesce_queue_limit(self, broker, address):
+        """Test followers count against the queue limits"""
+        broker.set_idempotent(b"S_ECHO")
+        broker.set_queue_limits(b"S_ECHO", max_requests=2)
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        broker.worker_waiting(worker)
+        sent = []
+        broker.socket.send_multipart = sent.append
+        for client in (b"C1", b"C2", b"C3", b"C4"):
+            broker.process_client(client, [b"S_ECHO", b"hello"])
+        assert worker.service.following == 2
+        assert broker.queued_requests == 2
+        assert broker.queued_bytes == 10
+        assert sent[1:] == [[b"C4", b"", C_CLIENT, b"S_ECHO", b"503"]]
+        assert worker.service.stats.rejected == 1
+
+    def test_coalesce_follower_expired(self, broker, address):
+        """Test followers whose deadline passed are dropped on landing"""
+        broker.set_idempotent(b"S_ECHO")
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        broker.worker_waiting(worker)
+        sent = []
+        broker.socket.send_multipart = sent.append
+        with patch("time.time", return_value=100.0):
+            broker.process_client(b"C1", [b"S_ECHO", b"hello"])
+            broker.process_client(b"C2", [b"S_ECHO", b"hello"],
+                                  {b"timeout": b"10"})
+            broker.process_client(b"C3", [b"S_ECHO", b"hello"])
+        flight = sent[0][6]
+        broker.process_worker(address, [W_REPLY, b"C1", b"flight", flight,
+                                        b"", b"world"])
+        assert [msg[0] for msg in sent[1:]] == [b"C1", b"C3"]
+        assert worker.service.stats.expired == 1
+        assert worker.service.following == 0
+        assert broker.queued_requests == 0
+
+    def test_coalesce_leader_expired_at_worker(self, broker, address):
+        """Test a leader the worker didn't run hands the flight on"""
+        broker.set_idempotent(b"S_ECHO")
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        broker.worker_waiting(worker)
+        sent = []
+        broker.socket.send_multipart = sent.append
+        with patch("time.time", return_value=100.0):
+            broker.process_client(b"C1", [b"S_ECHO", b"hello"],
+                                  {b"timeout": b"1"})
+            broker.process_client(b"C2", [b"S_ECHO", b"hello"],
+                                  {b"timeout": b"60000"})
+            broker.process_client(b"C3", [b"S_ECHO", b"hello"],
+                                  {b"timeout": b"200000"})
+        flight = sent[0][10]
+        with patch("time.time", return_value=101.0):
+            broker.process_worker(address, [
+                W_REPLY, b"C1", b"timeout", b"1", b"dispatched", b"100000",
+                b"flight", flight,
+                C_STATUS, EXPIRED, b"", EXPIRED
+            ])
+        assert sent[1][0] == b"C1"
+        assert b"dispatched" not in sent[1] # The client doesn't need it
+        assert sent[2][:6] == [address, b"", W_WORKER, W_REQUEST, b"C2",
+                               b"timeout"]
+        assert worker.service.following == 1
+
+        # A worker that doesn't mark it, once the leader's deadline passed
+        flight = sent[2][10]
+        with patch("time.time", return_value=200.0):
+            broker.process_worker(address, [
+                W_REPLY, b"C2", b"timeout", b"60000", b"dispatched",
+                b"101000", b"flight", flight,
+                b"", EXPIRED
+            ])
+        assert sent[4][:5] == [address, b"", W_WORKER, W_REQUEST, b"C3"]
+        assert worker.service.following == 0
+
+    def test_coalesce_shed(self, broker, address):
+        """Test followers queued too long are shed"""
+        broker.set_idempotent(b"S_ECHO")
+        worker = broker.require_worker(address)
+        worker.service = broker.require_service(b"S_ECHO")
+        broker.worker_waiting(worker)
+        sent = []
+        broker.socket.send_multipart = sent.append
+        broker.process_client(b"C1", [b"S_ECHO", b"hello"])
+        broker.process_client(b"C2", [b"S_ECHO", b"hello"])
+        broker.process_client(b"C3", [b"S_ECHO", b"hello"])
+        followers = worker.service.flights[sent[0][6]]
+        followers[0].queued_at -= 10
+
+        broker.MAX_REQUEST_AGE = 5000
+        broker.shed_requests()
+        assert sent[1:] == [[b"C2", b"", C_CLIENT, b"S_ECHO", b"503"]]
+        assert [request.msg[0] for request in followers] == [b"C3"]
+        assert worker.service.stats.shed == 1
+        assert worker.service.following == 1
 
     def test_broker_destroy(self, address):
         """Test destroy broker method"""
@@ -85,15 +493,15 @@ class TestBrokerModel():
         """Test process client method with service internal"""
         service_internal_mock = Mock()
         broker.service_internal = service_internal_mock
-        broker.process_client("TEST", [broker.INTERNAL_SERVICE_PREFIX, "hello"])
-        service_internal_mock.assert_called_with(broker.INTERNAL_SERVICE_PREFIX, ["TEST", "", "hello"])
+        broker.process_client(b"TEST", [broker.INTERNAL_SERVICE_PREFIX, b"hello"])
+        service_internal_mock.assert_called_with(broker.INTERNAL_SERVICE_PREFIX, [b"TEST", b"", b"hello"], None)
 
     def test_process_client_dispatch(self, broker):
         """Test process client method with service internal"""
         dispatch_mock = Mock()
         broker.dispatch = dispatch_mock
-        broker.process_client("TEST", ["srv1", "hello"])
-        dispatch_mock.assert_called_with(broker.require_service("srv1"), ["TEST", "", "hello"])
+        broker.process_client(b"TEST", [b"srv1", b"hello"])
+        dispatch_mock.assert_called_with(broker.require_service(b"srv1"), [b"TEST", b"", b"hello"], None)
 
     def test_require_worker(self, broker, broker_verbose, address):
         """Test require worker method"""
@@ -164,14 +572,14 @@ class TestBrokerModel():
         """Test process worker method with ready command"""
         mock_waiting = Mock()
         broker.worker_waiting = mock_waiting
-        broker.process_worker(address, [W_READY, "TEST", b"hello"])
+        broker.process_worker(address, [W_READY, b"TEST", b"hello"])
         mock_waiting.assert_called_with(broker.require_worker(address))
 
     def test_process_worker_ready_internal_service_prefix(self, broker, address):
         """Test process worker method with ready command and service equal to internal service prefix"""
         mock_delete = Mock()
         broker.delete_worker = mock_delete
-        broker.process_worker(address, [W_READY, "mmi.test", b"hello"])
+        broker.process_worker(address, [W_READY, b"mmi.test", b"hello"])
         mock_delete.assert_called_with(broker.require_worker(address), True)
 
     def test_process_worker_ready_worker_ready(self, broker, address):
@@ -179,7 +587,7 @@ class TestBrokerModel():
         mock_delete = Mock()
         broker.delete_worker = mock_delete
         worker = broker.require_worker(address)
-        broker.process_worker(address, [W_READY, "TEST", b"hello"])
+        broker.process_worker(address, [W_READY, b"TEST", b"hello"])
         mock_delete.assert_called_with(worker, True)
 
     def test_delete_worker(self, broker, address, service):
@@ -199,6 +607,7 @@ class TestBrokerModel():
         assert len(broker.workers) == 1
         broker.delete_worker(worker, False)
         assert len(broker.workers) == 0
+        assert len(worker.service.waiting) == 0
 
     def test_delete_worker_disconnect(self, broker, address):
         """Test delete worker method with disconnect call to worker"""
@@ -225,44 +634,147 @@ class TestBrokerModel():
         """Test service internal method"""
         broker.service_internal(b"mmi.service", [b"", b"Hello"])
 
-    def test_send_heartbeats(self, broker, address, service):
-        """Test send heartbeats method"""
-        worker = broker.require_worker(address)
-        worker.service = broker.require_service(service)
-        broker.worker_waiting(worker)
+    def test_service_internal_available(self, broker, address):
+        """Test mmi.service only finds services that have workers"""
+        sent = []
+        broker.socket.send_multipart = sent.append
+        broker.process_client(b"CLIENT", [b"S_ECHO", b"hello"])
+        broker.process_client(b"CLIENT", [b"mmi.service", b"S_ECHO"])
+        assert sent[-1] == [b"CLIENT", b"", C_CLIENT, b"mmi.service", b"404"]
+        broker.process_worker(address, [W_READY, b"S_ECHO"])
+        broker.process_client(b"CLIENT", [b"mmi.service", b"S_ECHO"])
+        assert sent[-1] == [b"CLIENT", b"", C_CLIENT, b"mmi.service", b"200"]
+
+    def test_service_internal_stats(self, broker, address):
+        """Test mmi.stats and mmi.workers report on a service"""
+        sent = []
+        broker.socket.send_multipart = sent.append
+        broker.process_worker(address, [W_READY, b"S_ECHO"])
+        broker.process_client(b"CLIENT", [b"S_ECHO", b"hello"])
+        broker.process_worker(address, [W_REPLY, b"CLIENT", b"", b"hello"])
+
+        broker.process_client(b"CLIENT", [b"mmi.stats", b"S_ECHO"])
+        assert sent[-1][:5] == [b"CLIENT", b"", C_CLIENT, b"mmi.stats", b"200"]
+        stats = json.loads(sent[-1][5].decode("utf-8"))
+        assert stats["requests"] == 1
+        assert stats["replies"] == 1
+        assert stats["queue_time"]["count"] == 1
+        assert stats["service_time"]["count"] == 1
+        assert stats["workers"] == 1
+
+        broker.process_client(b"CLIENT", [b"mmi.workers", b"S_ECHO"])
+        assert sent[-1][4] == b"200"
+        workers = json.loads(sent[-1][5].decode("utf-8"))
+        assert workers["workers"] == 1
+        assert workers["waiting"] == 1
+        assert workers["requests"] == 0
+
+        broker.process_client(b"CLIENT", [b"mmi.stats", b"S_NONE"])
+        assert sent[-1] == [b"CLIENT", b"", C_CLIENT, b"mmi.stats", b"404"]
 
-        cur_heatbeat_at = broker.heartbeat_at
-        broker.heartbeat_at = time.time() - 10
-        broker.send_heartbeats()
-        assert broker.heartbeat_at > cur_heatbeat_at
+    def test_send_heartbeats(self, broker, address, service):
+        """Test heartbeats are sent to idle and busy workers when due"""
+        idle = broker.require_worker(address)
+        idle.service = broker.require_service(service)
+        broker.worker_waiting(idle)
+        busy = broker.require_worker(b"tcp://localhost:6667")
+        busy.service = idle.service
+
+        sent = []
+        broker.send_to_worker = lambda w, c, o, m=None: sent.append((w, c))
+        broker.run_timers()
+        assert sent == []
+
+        later = time.time() + 1e-3 * broker.HEARTBEAT_INTERVAL + 0.1
+        with patch('mdbase.broker.time.time', return_value=later):
+            broker.run_timers()
+        assert set(sent) == set([(idle, W_HEARTBEAT), (busy, W_HEARTBEAT)])
+        # rescheduled for the next interval, and expiry is still pending
+        assert len(broker.timers) == 4
+        assert min(broker.timers)[0] > later
 
     def test_purge_workers(self, broker, address, service):
-        """Test purge workers method"""
+        """Test silent workers without requests in flight are deleted"""
         worker1 = broker.require_worker(address)
         worker1.service = broker.require_service(service)
 
         worker2 = broker.require_worker(b"tcp://localhost:6667")
         worker2.service = broker.require_service(b"S_LOG")
-
-        broker.worker_waiting(worker1)
         broker.worker_waiting(worker2)
 
-        assert len(broker.waiting) == 2
-
-        # modify expiry to be in past for worker1
-        worker1.expiry = time.time() - 1
-
-        broker.purge_workers()
-        assert len(broker.waiting) == 1
+        worker3 = broker.require_worker(b"tcp://localhost:6668")
+        worker3.service = worker2.service
+
+        # worker2 heartbeats, the others go silent
+        later = time.time() + 1e-3 * broker.HEARTBEAT_EXPIRY + 0.1
+        worker2.expiry = later + 1
+
+        with patch('mdbase.broker.time.time', return_value=later):
+            broker.run_timers()
+        assert list(broker.workers.values()) == [worker2]
+        assert len(worker2.service.waiting) == 1
+
+    def test_slow_handler(self, broker, address):
+        """Test a worker silent in a long request isn't expired
+
+        The sync worker doesn't heartbeat while its handler runs, the
+        reply must still get back to the client.
+        """
+        sent = []
+        broker.socket.send_multipart = sent.append
+        start = time.time()
+        with patch('mdbase.broker.time.time', return_value=start):
+            broker.process_worker(address, [W_READY, b"S_SLOW"])
+            broker.process_client(b"C1", [b"S_SLOW", b"hello"])
+        worker = broker.workers[list(broker.workers)[0]]
+        assert len(worker.inflight) == 1
+
+        later = start + 1e-3 * 4 * broker.HEARTBEAT_EXPIRY
+        with patch('mdbase.broker.time.time', return_value=later):
+            broker.run_timers()
+            assert worker.identity in broker.workers
+            broker.process_worker(address, [W_REPLY, b"C1", b"", b"world"])
+        assert sent[-1] == [b"C1", b"", C_CLIENT, b"S_SLOW", b"world"]
+        assert worker in worker.service.waiting
+
+        # Idle again, it expires as usual
+        later += 1e-3 * broker.HEARTBEAT_EXPIRY + 0.1
+        with patch('mdbase.broker.time.time', return_value=later):
+            broker.run_timers()
+        assert worker.identity not in broker.workers
+
+    def test_busy_expiry(self, broker, address):
+        """Test a busy worker that dies is still deleted, after BUSY_EXPIRY"""
+        broker.socket.send_multipart = Mock()
+        start = time.time()
+        with patch('mdbase.broker.time.time', return_value=start):
+            broker.process_worker(address, [W_READY, b"S_SLOW"])
+            broker.process_client(b"C1", [b"S_SLOW", b"hello"])
+        worker = broker.workers[list(broker.workers)[0]]
+
+        later = start + 1e-3 * 2 * broker.HEARTBEAT_EXPIRY
+        with patch('mdbase.broker.time.time', return_value=later):
+            broker.run_timers()
+        assert worker.identity in broker.workers
+        later = start + 1e-3 * broker.BUSY_EXPIRY + 0.1
+        with patch('mdbase.broker.time.time', return_value=later):
+            broker.run_timers()
+        assert worker.identity not in broker.workers
+
+    def test_next_timeout(self, broker, address):
+        """Test poll timeout tracks the next due timer"""
+        assert broker.next_timeout() == broker.HEARTBEAT_INTERVAL
+        broker.require_worker(address)
+        assert 0 < broker.next_timeout() <= broker.HEARTBEAT_INTERVAL
+        broker.timers[0] = (time.time() - 1,) + broker.timers[0][1:]
+        assert broker.next_timeout() == 0
 
     def test_worker_waiting(self, broker, address, service):
         """Test worker waiting method"""
         worker = broker.require_worker(address)
         worker.service = broker.require_service(service)
-        assert len(broker.waiting) == 0
         assert len(worker.service.waiting) == 0
         broker.worker_waiting(worker)
-        assert len(broker.waiting) == 1
         assert len(worker.service.waiting) == 1
 
     def test_dispatch(self, broker, address, service):
@@ -275,6 +787,167 @@ class TestBrokerModel():
         assert len(worker.service.requests) == 0
         assert len(worker.service.waiting) == 0
 
+    def test_dispatch_longest_idle_first(self, broker, service):
+        """Test dispatch pairs oldest request with longest idle worker"""
+        srv = broker.require_service(service)
+        workers = []
+        for i in range(3):
+            worker = broker.require_worker(b"worker%d" % i)
+            worker.service = srv
+            broker.worker_waiting(worker)
+            workers.append(worker)
+        sent = []
+        broker.send_to_worker = lambda w, c, o, m=None: sent.append((w, m))
+        broker.dispatch(srv, [b'one'])
+        broker.dispatch(srv, [b'two'])
+        assert sent == [(workers[0], [b'one']), (workers[1], [b'two'])]
+        assert list(srv.waiting.values()) == [workers[2]]
+
+    def test_process_worker_ready_credit(self, broker, address):
+        """Test workers can ask for more than one request in flight"""
+        broker.process_worker(address, [W_READY, b"S_ECHO", b"3"])
+        worker = broker.require_worker(address)
+        assert worker.credit == 3
+        broker.process_worker(b"W2", [W_READY, b"S_ECHO", b"100000"])
+        assert broker.require_worker(b"W2").credit == broker.MAX_CREDIT
+        broker.process_worker(b"W3", [W_READY, b"S_ECHO", b"junk"])
+        assert broker.require_worker(b"W3").credit == 1
+
+    def test_dispatch_credit(self, broker):
+        """Test requests are pipelined to workers with most free credit"""
+        sent = []
+        broker.send_to_worker = lambda w, c, o, m=None: sent.append(w.address)
+        broker.process_worker(b"W1", [W_READY, b"S_ECHO"])
+        broker.process_worker(b"W2", [W_READY, b"S_ECHO", b"3"])
+        srv = broker.require_service(b"S_ECHO")
+        for i in range(5):
+            broker.dispatch(srv, [b"CLIENT", b"", b"%d" % i])
+        # W2 until its free credit drops to W1's, then longest idle first
+        assert sent == [b"W2", b"W2", b"W1", b"W2"]
+        assert len(srv.requests) == 1
+        assert len(srv.waiting) == 0
+
+        # a reply tops the worker up and it takes the queued request
+        broker.process_worker(b"W2", [W_REPLY, b"CLIENT", b"", b"0"])
+        assert sent[-1] == b"W2"
+        assert len(srv.requests) == 0
+        assert len(broker.require_worker(b"W2").inflight) == 3
+
+    def test_queue_limit_requests(self, broker):
+        """Test requests over the per-service limit are rejected"""
+        sent = []
+        broker.socket.send_multipart = sent.append
+        broker.set_queue_limits(b"S_ECHO", max_requests=2)
+        srv = broker.require_service(b"S_ECHO")
+        for client in (b"c1", b"c2", b"c3"):
+            broker.dispatch(srv, [client, b"", b"hello"])
+        assert len(srv.requests) == 2
+        assert broker.queued_requests == 2
+        assert sent == [[b"c3", b"", C_CLIENT, b"S_ECHO", b"503"]]
+
+    def test_queue_limit_purges_expired(self, broker, address):
+        """Test expired requests don't hold queue capacity"""
+        sent = []
+        broker.socket.send_multipart = sent.append
+        broker.set_queue_limits(b"S_ECHO", max_requests=2)
+        srv = broker.require_service(b"S_ECHO")
+        with patch("time.time", return_value=100.0):
+            broker.process_client(b"C1", [b"S_ECHO", b"old"],
+                                  {b"timeout": b"1000"})
+            broker.process_client(b"C2", [b"S_ECHO", b"old"],
+                                  {b"timeout": b"1000"})
+        with patch("time.time", return_value=102.0):
+            broker.process_client(b"C3", [b"S_ECHO", b"new"],
+                                  {b"timeout": b"1000"})
+        assert sent == []
+        assert len(srv.requests) == 1
+        assert broker.queued_requests == 1
+        assert srv.queued_bytes == 3
+        assert srv.stats.expired == 2
+        assert srv.deadline == 103.0
+
+    def test_queue_limit_purges_followers(self, broker, address):
+        """Test expired followers are purged and a live one leads"""
+        broker.set_idempotent(b"S_ECHO")
+        broker.set_queue_limits(b"S_ECHO", max_requests=2)
+        srv = broker.require_service(b"S_ECHO")
+        broker.socket.send_multipart = Mock()
+        with patch("time.time", return_value=100.0):
+            broker.process_client(b"C1", [b"S_ECHO", b"hello"],
+                                  {b"timeout": b"1000"})
+            broker.process_client(b"C2", [b"S_ECHO", b"hello"])
+        with patch("time.time", return_value=102.0):
+            broker.process_client(b"C3", [b"S_ECHO", b"other"])
+        assert broker.socket.send_multipart.call_count == 0
+        assert [request.msg[0] for request in srv.requests.lanes[1]] == \
+            [b"C2", b"C3"]
+        assert srv.following == 0
+        assert broker.queued_requests == 2
+        assert srv.stats.expired == 1
+
+    def test_reject_status(self, broker):
+        """Test extended clients can tell a rejection from a reply"""
+        sent = []
+        broker.socket.send_multipart = sent.append
+        broker.set_queue_limits(b"S_ECHO", max_requests=0)
+        broker.process_client(b"C1", [b"S_ECHO", b"hello"], {b"id": b"7"})
+        assert sent == [[b"C1", b"", C_CLIENT_EXT, b"S_ECHO", b"id", b"7",
+                         C_STATUS, REJECTED, b"", REJECTED]]
+
+    def test_queue_limit_bytes(self, broker):
+        """Test requests over the per-service byte limit are rejected"""
+        broker.socket.send_multipart = Mock()
+        broker.set_queue_limits(b"S_ECHO", max_bytes=10)
+        srv = broker.require_service(b"S_ECHO")
+        broker.dispatch(srv, [b"c1", b"", b"x" * 8])
+        broker.dispatch(srv, [b"c2", b"", b"x" * 8])
+        assert len(srv.requests) == 1
+        assert srv.queued_bytes == 8
+        assert broker.queued_bytes == 8
+
+    def test_queue_limit_global(self, broker):
+        """Test the global limit applies across services"""
+        broker.socket.send_multipart = Mock()
+        broker.MAX_REQUESTS = 1
+        broker.dispatch(broker.require_service(b"S_ECHO"), [b"c1", b"", b"a"])
+        broker.dispatch(broker.require_service(b"S_LOG"), [b"c2", b"", b"b"])
+        assert len(broker.services[b"S_LOG"].requests) == 0
+        broker.socket.send_multipart.assert_called_with(
+            [b"c2", b"", C_CLIENT, b"S_LOG", b"503"]
+        )
+
+    def test_dispatch_releases_queue(self, broker, address):
+        """Test dispatched requests no longer count against limits"""
+        srv = broker.require_service(b"S_ECHO")
+        broker.dispatch(srv, [b"c1", b"", b"hello"])
+        assert broker.queued_requests == 1
+        worker = broker.require_worker(address)
+        worker.service = srv
+        broker.worker_waiting(worker)
+        assert broker.queued_requests == 0
+        assert broker.queued_bytes == 0
+        assert srv.queued_bytes == 0
+
+    def test_shed_requests(self, broker):
+        """Test requests queued too long are shed"""
+        sent = []
+        broker.socket.send_multipart = sent.append
+        srv = broker.require_service(b"S_ECHO")
+        broker.dispatch(srv, [b"c1", b"", b"old"])
+        broker.dispatch(srv, [b"c2", b"", b"new"])
+        srv.requests.oldest().queued_at -= 10
+        assert srv.oldest_age() >= 10
+
+        # no age limit by default
+        broker.shed_requests()
+        assert len(srv.requests) == 2
+
+        broker.MAX_REQUEST_AGE = 5000
+        broker.shed_requests()
+        assert len(srv.requests) == 1
+        assert srv.oldest_age() < 5
+        assert sent == [[b"c1", b"", C_CLIENT, b"S_ECHO", b"503"]]
+
     def test_send_to_worker(self, broker, broker_verbose, address):
         """Test send to worker method"""
         worker = broker.require_worker(address)
@@ -0,0 +1,102 @@
+import pytest
+
+from mock import Mock, patch
+
+from mdbase.circuit import (ServiceGuard, ServiceUnavailable, CLOSED, OPEN,
+                            HALF_OPEN)
+
+
+def replies(service_reply=None, available=True):
+    """Client send side effect answering mmi.service and the service"""
+    def send(service, request):
+        if service == b"mmi.service":
+            return [b"200"] if available else [b"404"]
+        return service_reply
+    return send
+
+
+@pytest.fixture
+def client():
+    return Mock()
+
+
+class TestServiceGuard():
+    def test_mmi_cached(self, client):
+        """Test mmi.service is asked once per ttl, not once per request"""
+        client.send.side_effect = replies([b"world"])
+        guard = ServiceGuard(client)
+        assert guard.send(b"echo", b"hello") == [b"world"]
+        assert guard.send(b"echo", b"hello") == [b"world"]
+        assert [c[0][0] for c in client.send.call_args_list] == [
+            b"mmi.service", b"echo", b"echo"
+        ]
+
+        with patch("time.time", return_value=1e12):
+            guard.send(b"echo", b"hello")
+        assert client.send.call_args_list[3][0] == (b"mmi.service", b"echo")
+
+    def test_unknown_service(self, client):
+        """Test services without workers fail fast"""
+        client.send.side_effect = replies(available=False)
+        guard = ServiceGuard(client)
+        for i in range(2):
+            with pytest.raises(ServiceUnavailable):
+                guard.send(b"echo", b"hello")
+        assert client.send.call_count == 1
+
+    def test_circuit_opens(self, client):
+        """Test repeated timeouts open the circuit, which then fails fast"""
+        client.send.side_effect = replies(None)
+        guard = ServiceGuard(client, threshold=2)
+        assert guard.send(b"echo", b"hello") is None
+        assert guard.circuits[b"echo"].state == CLOSED
+        assert guard.send(b"echo", b"hello") is None
+        assert guard.circuits[b"echo"].state == OPEN
+
+        calls = client.send.call_count
+        with pytest.raises(ServiceUnavailable):
+            guard.send(b"echo", b"hello")
+        assert client.send.call_count == calls
+
+    def test_half_open_probe(self, client):
+        """Test a single probe is let through after the cooldown"""
+        client.send.side_effect = replies(None)
+        guard = ServiceGuard(client, threshold=1, cooldown=0)
+        guard.send(b"echo", b"hello")
+        assert guard.circuits[b"echo"].state == OPEN
+
+        guard.allow(b"echo")
+        assert guard.circuits[b"echo"].state == HALF_OPEN
+        with pytest.raises(ServiceUnavailable):
+            guard.allow(b"echo") # probe still out
+
+        guard.record(b"echo", False)
+        assert guard.circuits[b"echo"].state == OPEN
+
+        client.send.side_effect = replies([b"world"])
+        assert guard.send(b"echo", b"hello") == [b"world"]
+        assert guard.circuits[b"echo"].state == CLOSED
+        assert guard.circuits[b"echo"].failures == 0
+
+    def test_probe_raises(self, client):
+        """Test a probe whose send raises reopens the circuit"""
+        client.send.side_effect = replies(None)
+        guard = ServiceGuard(client, threshold=1, cooldown=0)
+        guard.send(b"echo", b"hello")
+
+        def send(service, request):
+            if service == b"mmi.service":
+                return [b"200"]
+            raise RuntimeError("socket closed")
+        client.send.side_effect = send
+        with pytest.raises(RuntimeError):
+            guard.send(b"echo", b"hello")
+        assert guard.circuits[b"echo"].state == OPEN
+
+    def test_broker_unreachable(self, client):
+        """Test an unanswered mmi.service counts as a timeout"""
+        client.send.return_value = None
+        guard = ServiceGuard(client, threshold=1)
+        with pytest.raises(ServiceUnavailable):
+            guard.send(b"echo", b"hello")
+        assert guard.circuits[b"echo"].state == OPEN
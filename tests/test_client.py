@@ -1,7 +1,14 @@
+import time
+
 import pytest
 import zmq
 
-from mdbase.client import MajorDomoClient
+from mock import Mock
+
+from mdbase.client import (MajorDomoClient, PipelinedMajorDomoClient,
+                           RequestExpired, RequestRejected, RequestTimeout)
+from mdbase.constants import C_CLIENT_EXT, C_STATUS, EXPIRED, REJECTED
+from mdbase.stats import HedgeStats
 
 
 @pytest.fixture
@@ -25,3 +32,132 @@ class TestMajorDomoClient():
         assert c.verbose is True
         assert isinstance(c.ctx, zmq.Context)
         assert isinstance(c.poller, zmq.Poller)
+
+
+class TestPipelinedMajorDomoClient():
+    def test_send(self, broker_url):
+        """Test requests are tagged with a correlation id"""
+        c = PipelinedMajorDomoClient(broker_url)
+        sent = []
+        c.client.send_multipart = sent.append
+        f1 = c.send(b"echo", b"one")
+        f2 = c.send(b"echo", [b"two"])
+        assert sent[0] == [b"", C_CLIENT_EXT, b"echo", b"id", b"1",
+                           b"timeout", b"2500", b"", b"one"]
+        assert sent[1] == [b"", C_CLIENT_EXT, b"echo", b"id", b"2",
+                           b"timeout", b"2500", b"", b"two"]
+        assert len(c) == 2
+        assert not f1.done() and not f2.done()
+        c.destroy()
+
+    def test_resolve_out_of_order(self, broker_url):
+        """Test replies resolve the future of their own request"""
+        c = PipelinedMajorDomoClient(broker_url)
+        c.client.send_multipart = Mock()
+        f1 = c.send(b"echo", b"one")
+        f2 = c.send(b"echo", b"two")
+        c.resolve([b"", C_CLIENT_EXT, b"echo", b"id", b"2", b"", b"TWO"])
+        assert f2.result(0) == [b"TWO"]
+        assert not f1.done()
+        c.resolve([b"", C_CLIENT_EXT, b"echo", b"id", b"1", b"", b"ONE"])
+        assert f1.result(0) == [b"ONE"]
+        assert len(c) == 0
+        c.destroy()
+
+    def test_status(self, broker_url):
+        """Test refused and expired requests fail rather than resolve"""
+        c = PipelinedMajorDomoClient(broker_url)
+        c.client.send_multipart = Mock()
+        f1 = c.send(b"echo", b"one")
+        f2 = c.send(b"echo", b"two")
+        c.resolve([b"", C_CLIENT_EXT, b"echo", b"id", b"1", C_STATUS,
+                   REJECTED, b"", REJECTED])
+        c.resolve([b"", C_CLIENT_EXT, b"echo", b"id", b"2", C_STATUS,
+                   EXPIRED, b"", EXPIRED])
+        with pytest.raises(RequestRejected):
+            f1.result(0)
+        with pytest.raises(RequestExpired):
+            f2.result(0)
+        assert len(c) == 0
+        c.destroy()
+
+    def test_timeout(self, broker_url):
+        """Test requests fail on their own timeout, late replies are dropped"""
+        c = PipelinedMajorDomoClient(broker_url)
+        c.client.send_multipart = Mock()
+        f1 = c.send(b"echo", b"one", timeout=0)
+        f2 = c.send(b"echo", b"two", timeout=60000)
+        c.poll(0)
+        with pytest.raises(RequestTimeout):
+            f1.result(0)
+        assert not f2.done()
+        c.resolve([b"", C_CLIENT_EXT, b"echo", b"id", b"1", b"", b"late"])
+        assert len(c) == 1
+        c.destroy()
+
+    def test_wait_timeout(self, broker_url):
+        """Test wait gives up after its own timeout"""
+        c = PipelinedMajorDomoClient(broker_url)
+        c.client.send_multipart = Mock()
+        future = c.send(b"echo", b"one", timeout=60000)
+        assert c.wait([future], timeout=10) is False
+        c.destroy()
+
+    def test_hedge(self, broker_url):
+        """Test a slow request is duplicated by poll, a refusal of one copy
+        waits for the other, and the first reply resolves the future
+        """
+        c = PipelinedMajorDomoClient(broker_url)
+        c.hedge = 95
+        c.hedges[b"echo"] = stats = HedgeStats()
+        for i in range(20):
+            stats.record(0.001)
+        sent = []
+        c.client.send_multipart = sent.append
+        future = c.send(b"echo", b"one")
+        time.sleep(0.002) # Past the hedge delay
+        c.poll(0)
+        assert [frames[4] for frames in sent] == [b"1", b"1h"]
+        assert int(sent[1][6]) < 2500 # What's left of the timeout
+        c.resolve([b"", C_CLIENT_EXT, b"echo", b"id", b"1", C_STATUS,
+                   REJECTED, b"", REJECTED])
+        assert not future.done()
+        c.resolve([b"", C_CLIENT_EXT, b"echo", b"id", b"1h", b"", b"ONE"])
+        assert future.result(0) == [b"ONE"]
+        assert (stats.requests, stats.hedges, stats.wins) == (1, 1, 1)
+        assert len(c) == 0 and not c.sent
+        c.destroy()
+
+    def test_hedge_budget(self, broker_url):
+        """Test duplicates stop once the hedge budget is spent, though
+        every request in flight was planned one
+        """
+        c = PipelinedMajorDomoClient(broker_url)
+        c.hedge = 90
+        c.hedges[b"echo"] = stats = HedgeStats()
+        for i in range(20):
+            stats.record(0.001)
+        c.client.send_multipart = Mock()
+        for i in range(200):
+            c.send(b"echo", b"one")
+        assert len(c.hedging) == 200
+        time.sleep(0.002) # Past the hedge delay
+        c.poll(0)
+        assert (stats.requests, stats.hedges) == (200, 10)
+        assert c.client.send_multipart.call_count == 210
+        c.destroy()
+
+    def test_hedge_cold_service(self, broker_url):
+        """Test services without a latency history aren't hedged, but
+        their latency is recorded
+        """
+        c = PipelinedMajorDomoClient(broker_url)
+        c.hedge = 95
+        c.client.send_multipart = Mock()
+        future = c.send(b"echo", b"one")
+        c.poll(0)
+        assert c.client.send_multipart.call_count == 1
+        c.resolve([b"", C_CLIENT_EXT, b"echo", b"id", b"1", b"", b"ONE"])
+        assert future.result(0) == [b"ONE"]
+        assert c.hedges[b"echo"].latency.count == 1
+        c.destroy()
@@ -0,0 +1,277 @@
+import time
+
+import pytest
+import zmq
+
+from mock import Mock, patch
+
+from mdbase.client_sync import MajorDomoClient
+from mdbase.constants import C_CLIENT_EXT, C_STATUS, EXPIRED, REJECTED
+from mdbase.stats import HedgeStats
+
+
+@pytest.fixture
+def client():
+    c = MajorDomoClient("tcp://localhost:6666")
+    c.client = Mock()
+    c.poller = Mock()
+    c.poller.poll.return_value = [(c.client, zmq.POLLIN)]
+    yield c
+    c.destroy()
+
+
+def reply(correlation, body, service=b"echo"):
+    return [b"", C_CLIENT_EXT, service, b"id", correlation, b"", body]
+
+
+def rejected(correlation, service=b"echo", status=REJECTED):
+    return [b"", C_CLIENT_EXT, service, b"id", correlation, C_STATUS,
+            status, b"", status]
+
+
+def sent_id(client):
+    """Returns the id of the last request client sent"""
+    return client.client.send_multipart.call_args[0][0][4]
+
+
+class TestMajorDomoClient():
+    def test_instantiate(self):
+        """Test the client talks to the broker over a DEALER socket"""
+        c = MajorDomoClient("tcp://localhost:6666")
+        assert c.client.type == zmq.DEALER
+        c.destroy()
+
+    def test_send(self, client):
+        """Test requests carry an id and the matching reply is returned"""
+        client.client.recv_multipart.return_value = reply(b"1", b"world")
+        assert client.send(b"echo", b"hello") == [b"world"]
+        client.client.send_multipart.assert_called_with(
+            [b"", C_CLIENT_EXT, b"echo", b"id", b"1", b"timeout", b"2500",
+             b"", b"hello"]
+        )
+
+    def test_late_reply_discarded(self, client):
+        """Test replies to abandoned requests are skipped"""
+        client.client.recv_multipart.side_effect = [
+            reply(b"7", b"stale", b"other"), reply(b"1", b"world")
+        ]
+        assert client.send(b"echo", b"hello") == [b"world"]
+
+    def test_retry_same_socket(self, client):
+        """Test retries resend on the same socket after a backoff"""
+        client.poller.poll.side_effect = [[], [(client.client, zmq.POLLIN)]]
+        client.client.recv_multipart.return_value = reply(b"2", b"world")
+        socket = client.client
+        with patch("time.sleep") as sleep:
+            assert client.send(b"echo", b"hello") == [b"world"]
+        assert client.client is socket
+        assert socket.send_multipart.call_count == 2
+        assert sleep.call_count == 1
+
+    def test_permanent_error(self, client):
+        """Test None is returned once retries run out"""
+        client.poller.poll.return_value = []
+        with patch("time.sleep") as sleep:
+            assert client.send(b"echo", b"hello") is None
+        assert client.client.send_multipart.call_count == client.retries
+        assert sleep.call_count == client.retries - 1
+
+    def test_rejected(self, client):
+        """Test a request the broker refused is retried, never returned"""
+        client.client.recv_multipart.side_effect = [
+            rejected(b"1"), reply(b"2", b"world")
+        ]
+        with patch("time.sleep") as sleep:
+            assert client.send(b"echo", b"hello") == [b"world"]
+        assert client.client.send_multipart.call_count == 2
+        assert sleep.call_count == 1
+
+        client.client.recv_multipart.side_effect = (
+            lambda *args, **kwargs: rejected(sent_id(client))
+        )
+        with patch("time.sleep"):
+            assert client.send(b"echo", b"hello") is None
+
+    def test_expired(self, client):
+        """Test an expired reply fails the attempt, late or not"""
+        client.poller.poll.side_effect = [
+            [], [(client.client, zmq.POLLIN)], [(client.client, zmq.POLLIN)],
+            [(client.client, zmq.POLLIN)],
+        ]
+        client.client.recv_multipart.side_effect = [
+            rejected(b"1", status=EXPIRED), reply(b"2", b"world"),
+        ]
+        with patch("time.sleep"):
+            assert client.send(b"echo", b"hello") == [b"world"]
+        assert [call[0][0][4] for call in
+                client.client.send_multipart.call_args_list] == [b"1", b"2"]
+
+        client.poller.poll.side_effect = None
+        client.client.recv_multipart.side_effect = [
+            rejected(b"3", status=EXPIRED), reply(b"4", b"world"),
+        ]
+        with patch("time.sleep"):
+            assert client.send(b"echo", b"hello") == [b"world"]
+
+    def test_retry_delay(self, client):
+        """Test backoff doubles per attempt up to the cap, with jitter"""
+        with patch("random.uniform", side_effect=lambda a, b: b):
+            delays = [client.retry_delay(n) for n in range(1, 10)]
+        assert delays[:3] == [100, 200, 400]
+        assert delays[-1] == client.backoff_max
+
+    def test_send_many_ordered(self, client):
+        """Test replies arriving out of order are yielded in request order"""
+        client.client.recv_multipart.side_effect = [
+            reply(b"2", b"B"), reply(b"1", b"A"), zmq.Again(),
+            reply(b"3", b"C"), zmq.Again(),
+        ]
+        results = client.send_many(b"echo", [b"a", b"b", b"c"], window=2)
+        assert list(results) == [(0, [b"A"]), (1, [b"B"]), (2, [b"C"])]
+
+    def test_send_many_window(self, client):
+        """Test no more than window requests are in flight"""
+        client.client.recv_multipart.side_effect = [
+            reply(b"1", b"A"), zmq.Again(), reply(b"2", b"B"), zmq.Again(),
+            reply(b"3", b"C"), zmq.Again(),
+        ]
+        results = client.send_many(b"echo", [b"a", b"b", b"c"], window=1)
+        assert next(results) == (0, [b"A"])
+        assert client.client.send_multipart.call_count == 1
+        assert [index for index, result in results] == [1, 2]
+
+    def test_send_many_unordered(self, client):
+        """Test replies are yielded as they arrive when order isn't needed"""
+        client.client.recv_multipart.side_effect = [
+            reply(b"2", b"B"), zmq.Again(), reply(b"1", b"A"), zmq.Again(),
+        ]
+        results = client.send_many(b"echo", [b"a", b"b"], ordered=False)
+        assert list(results) == [(1, [b"B"]), (0, [b"A"])]
+
+    def test_send_many_failure(self, client):
+        """Test a request without reply fails alone after its retries"""
+        client.timeout = 0
+        client.retries = 2
+        client.backoff = 0
+        client.poller.poll.side_effect = [
+            [(client.client, zmq.POLLIN)], [], [], [],
+        ]
+        client.client.recv_multipart.side_effect = [
+            reply(b"2", b"B"), zmq.Again(),
+        ]
+        results = client.send_many(b"echo", [b"a", b"b"])
+        assert list(results) == [(0, None), (1, [b"B"])]
+        assert client.client.send_multipart.call_count == 3
+
+    def test_send_many_rejected(self, client):
+        """Test a refused request is resent, and fails once retries run out"""
+        client.retries = 2
+        client.backoff = 0
+        client.client.recv_multipart.side_effect = [
+            rejected(b"1"), reply(b"2", b"B"), zmq.Again(), zmq.Again(),
+            reply(b"3", b"A"), zmq.Again(),
+        ]
+        results = client.send_many(b"echo", [b"a", b"b"])
+        assert list(results) == [(0, [b"A"]), (1, [b"B"])]
+        assert client.client.send_multipart.call_count == 3
+
+        client.client.recv_multipart.side_effect = [
+            rejected(b"4"), zmq.Again(), zmq.Again(),
+            rejected(b"5"), zmq.Again(),
+        ]
+        assert list(client.send_many(b"echo", [b"a"])) == [(0, None)]
+
+    def test_send_many_late_expired(self, client):
+        """Test a retry ignores an expired reply to its earlier attempt"""
+        client.retries = 2
+        client.backoff = 0
+        client.timeout = 0
+        client.poller.poll.side_effect = [
+            [], [], [(client.client, zmq.POLLIN)],
+        ]
+        client.client.recv_multipart.side_effect = [
+            rejected(b"1", status=EXPIRED), reply(b"2", b"A"), zmq.Again(),
+        ]
+        assert list(client.send_many(b"echo", [b"a"])) == [(0, [b"A"])]
+        assert [call[0][0][4] for call in
+                client.client.send_multipart.call_args_list] == [b"1", b"2"]
+
+    def test_hedge(self, client):
+        """Test a slow request is duplicated and the first reply wins"""
+        client.hedge = 95
+        client.hedges[b"echo"] = stats = HedgeStats()
+        for i in range(20):
+            stats.record(0.01)
+        client.poller.poll.side_effect = [[], [(client.client, zmq.POLLIN)]]
+        client.client.recv_multipart.return_value = reply(b"1h", b"world")
+        assert client.send(b"echo", b"hello") == [b"world"]
+        assert client.poller.poll.call_args_list[0][0] == (10,)
+        client.client.send_multipart.assert_called_with(
+            [b"", C_CLIENT_EXT, b"echo", b"id", b"1h", b"timeout", b"2500",
+             b"", b"hello"]
+        )
+        assert (stats.requests, stats.hedges, stats.wins) == (1, 1, 1)
+
+    def test_send_many_hedge(self, client):
+        """Test a slow request in a batch is duplicated, and a refusal of
+        one copy waits for the other
+        """
+        client.hedge = 95
+        client.hedges[b"echo"] = stats = HedgeStats()
+        for i in range(20):
+            stats.record(0.001)
+        polls = iter([[], [(client.client, zmq.POLLIN)]])
+
+        def poll(timeout):
+            time.sleep(0.002) # Past the hedge delay
+            return next(polls)
+        client.poller.poll.side_effect = poll
+        client.client.recv_multipart.side_effect = [
+            rejected(b"1"), reply(b"1h", b"A"), zmq.Again(),
+        ]
+        assert list(client.send_many(b"echo", [b"a"])) == [(0, [b"A"])]
+        assert [call[0][0][4] for call in
+                client.client.send_multipart.call_args_list] == [b"1", b"1h"]
+        assert (stats.requests, stats.hedges, stats.wins) == (1, 1, 1)
+
+    def test_send_many_hedge_budget(self, client):
+        """Test duplicates in a batch stop once the hedge budget is spent,
+        though every request was planned one
+        """
+        client.hedge = 90
+        client.timeout = 50
+        client.retries = 1
+        client.hedges[b"echo"] = stats = HedgeStats()
+        for i in range(20):
+            stats.record(0.001)
+
+        def poll(timeout):
+            time.sleep(1e-3 * timeout)
+            return []
+        client.poller.poll.side_effect = poll
+        results = client.send_many(b"echo", [b"a"] * 200, window=200)
+        assert [reply for index, reply in results] == [None] * 200
+        assert (stats.requests, stats.hedges) == (200, 10)
+        assert client.client.send_multipart.call_count == 210
+
+    def test_hedge_budget(self, client):
+        """Test no duplicate is sent once the hedge budget is spent"""
+        client.hedge = 95
+        client.hedges[b"echo"] = stats = HedgeStats()
+        for i in range(20):
+            stats.record(0.01)
+        stats.requests = 19
+        stats.hedges = 1
+        client.client.recv_multipart.return_value = reply(b"1", b"world")
+        assert client.send(b"echo", b"hello") == [b"world"]
+        client.poller.poll.assert_called_with(client.timeout)
+        assert client.client.send_multipart.call_count == 1
+        assert (stats.requests, stats.hedges, stats.wins) == (20, 1, 0)
+
+    def test_hedge_cold_service(self, client):
+        """Test services without a latency history aren't hedged"""
+        client.hedge = 95
+        client.client.recv_multipart.return_value = reply(b"1", b"world")
+        assert client.send(b"echo", b"hello") == [b"world"]
+        assert client.client.send_multipart.call_count == 1
+        assert client.hedges[b"echo"].latency.count == 1
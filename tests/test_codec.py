@@ -0,0 +1,69 @@
+import pytest
+import zmq
+
+from mdbase.codec import (dispatch_time, frame_bytes, frames_bytes,
+                          recv_frames, send_frames, pack_properties,
+                          unpack_properties, properties_deadline)
+
+
+@pytest.fixture
+def ctx():
+    ctx = zmq.Context()
+    yield ctx
+    ctx.destroy(0)
+
+
+class TestCodec():
+    def test_frame_bytes(self):
+        """Test reading frames and plain bytes"""
+        assert frame_bytes(zmq.Frame(b"hello")) == b"hello"
+        assert frame_bytes(b"hello") == b"hello"
+
+    def test_frames_bytes(self):
+        """Test reading a list of mixed frames"""
+        assert frames_bytes([zmq.Frame(b"a"), b"b"]) == [b"a", b"b"]
+
+    def test_recv_frames(self, ctx):
+        """Test receiving without copying payloads"""
+        a = ctx.socket(zmq.PAIR)
+        b = ctx.socket(zmq.PAIR)
+        a.bind("inproc://codec")
+        b.connect("inproc://codec")
+        a.send_multipart([b"", b"hello"])
+        msg = recv_frames(b)
+        assert all(isinstance(frame, zmq.Frame) for frame in msg)
+        assert frames_bytes(msg) == [b"", b"hello"]
+
+    def test_send_frames(self, ctx):
+        """Test received frames are sent on as one message"""
+        a = ctx.socket(zmq.PAIR)
+        b = ctx.socket(zmq.PAIR)
+        a.bind("inproc://codec")
+        b.connect("inproc://codec")
+        send_frames(a, [zmq.Frame(b""), b"hello"])
+        send_frames(a, [b"bye"])
+        assert b.recv_multipart() == [b"", b"hello"]
+        assert b.recv_multipart() == [b"bye"]
+
+    def test_properties(self):
+        """Test properties round trip up to the empty frame"""
+        msg = [b"C1"] + pack_properties({b"id": b"7"}) + [b"", b"body"]
+        assert unpack_properties(msg, 1) == ({b"id": b"7"}, 4)
+        assert unpack_properties([b"", b"body"]) == ({}, 1)
+
+    def test_properties_deadline(self):
+        """Test the timeout property becomes an absolute deadline"""
+        assert properties_deadline({b"timeout": b"1500"}, 100.0) == 101.5
+        assert properties_deadline({b"timeout": b"soon"}, 100.0) is None
+        assert properties_deadline({}, 100.0) is None
+        assert properties_deadline(None, 100.0) is None
+
+    def test_dispatch_time(self):
+        """Test the dispatched property is read in secs, never later than
+        now
+        """
+        assert dispatch_time({b"dispatched": b"99000"}, 100.0) == 99.0
+        assert dispatch_time({b"dispatched": b"101000"}, 100.0) == 100.0
+        assert dispatch_time({b"dispatched": b"then"}, 100.0) == 100.0
+        assert dispatch_time({b"timeout": b"1500"}, 100.0) == 100.0
+        assert dispatch_time(None, 100.0) == 100.0
@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+from mock import Mock
+
+from mdbase.pool import ClientPool, PoolTimeout
+
+
+@pytest.fixture
+def pool():
+    p = ClientPool("tcp://localhost:6666", size=2)
+    yield p
+    p.destroy()
+
+
+class TestClientPool():
+    def test_checkout_reuses_client(self, pool):
+        """Test returned clients are lent again on the shared context"""
+        client = pool.checkout()
+        assert client.ctx is pool.ctx
+        pool.checkin(client)
+        assert pool.checkout() is client
+        assert pool.opened == 1
+
+    def test_size_cap(self, pool):
+        """Test checkout waits for a client once size are lent out"""
+        first = pool.checkout()
+        pool.checkout()
+        with pytest.raises(PoolTimeout):
+            pool.checkout(timeout=0.01)
+
+        threading.Timer(0.05, pool.checkin, (first,)).start()
+        assert pool.checkout(timeout=5) is first
+        assert pool.opened == 2
+
+    def test_send(self, pool):
+        """Test send borrows a client for one request"""
+        client = pool.checkout()
+        client.send = Mock(return_value=[b"world"])
+        pool.checkin(client)
+        assert pool.send(b"echo", b"hello") == [b"world"]
+        client.send.assert_called_with(b"echo", b"hello")
+        assert pool.idle[0][0] is client
+
+    def test_suspect_client_replaced(self, pool):
+        """Test a client whose request got no reply is pinged, then replaced"""
+        client = pool.checkout()
+        client.send = Mock(return_value=None)
+        pool.checkin(client)
+        assert pool.send(b"echo", b"hello") is None
+
+        replacement = pool.checkout()
+        client.send.assert_called_with(b"mmi.service", b"mmi.service")
+        assert replacement is not client
+        assert client.client.closed
+        assert pool.opened == 1
+
+    def test_client_failure_releases_slot(self, pool):
+        """Test a client that raises is closed and its slot freed"""
+        with pytest.raises(ValueError):
+            with pool.client() as client:
+                raise ValueError()
+        assert client.client.closed
+        assert pool.opened == 0
+        assert pool.idle == []
+
+    def test_close(self, pool):
+        """Test close shuts idle clients now and lent clients on return"""
+        idle = pool.checkout()
+        lent = pool.checkout()
+        pool.checkin(idle)
+        pool.close()
+        assert idle.client.closed
+        assert not lent.client.closed
+        pool.checkin(lent)
+        assert lent.client.closed
+        assert pool.opened == 0
@@ -0,0 +1,157 @@
+import json
+import time
+
+import pytest
+
+from mock import Mock, patch
+
+from mdbase.constants import (C_CLIENT, C_CLIENT_EXT, W_WORKER, W_READY,
+                              W_HEARTBEAT, W_REQUEST, W_DISCONNECT)
+from mdbase.shard import (ShardFront, ShardedClient, ShardsUnavailable,
+                          shard_endpoint, shard_endpoints, shard_for)
+
+ENDPOINTS = ["tcp://localhost:5556", "tcp://localhost:5557",
+             "tcp://localhost:5558", "tcp://localhost:5559"]
+
+
+@pytest.fixture
+def front():
+    f = ShardFront(ENDPOINTS)
+    f.proxy_linger = 0
+    f.socket.close()
+    f.socket = Mock()
+    yield f
+    f.destroy()
+
+
+@pytest.fixture
+def proxies(front):
+    """Stand in DEALERs, one per shard"""
+    sockets = [Mock() for endpoint in ENDPOINTS]
+    front.proxy = Mock(side_effect=lambda address, shard: sockets[shard])
+    return sockets
+
+
+def sent(socket):
+    """Returns the frames sent on socket, frame by frame"""
+    return [call[0][0] for call in socket.send.call_args_list]
+
+
+class TestShardRouting():
+    def test_shard_for(self):
+        """Test service names map to a stable shard"""
+        assert shard_for(b"echo", 4) == shard_for(b"echo", 4)
+        assert 0 <= shard_for(b"echo", 4) < 4
+        assert shard_for(b"echo", 1) == 0
+        assert len(set(shard_for(b"s%d" % i, 4) for i in range(100))) == 4
+
+    def test_shard_endpoints(self):
+        """Test shards bind next to the directory"""
+        assert shard_endpoints("tcp://*:5555", 2) == [
+            "tcp://*:5556", "tcp://*:5557"
+        ]
+        assert shard_endpoints("ipc:///tmp/mdp", 2) == [
+            "ipc:///tmp/mdp-0", "ipc:///tmp/mdp-1"
+        ]
+        assert shard_endpoint(ENDPOINTS, b"echo") == \
+            ENDPOINTS[shard_for(b"echo", 4)]
+
+
+class TestShardFront():
+    def test_shards(self, front):
+        """Test mmi.shards lists the shard endpoints"""
+        front.process_message([b"C1", b"", C_CLIENT, b"mmi.shards", b""])
+        front.socket.send_multipart.assert_called_with(
+            [b"C1", b"", C_CLIENT, b"mmi.shards", b"200",
+             json.dumps(ENDPOINTS).encode("utf-8")]
+        )
+
+    def test_shards_extended(self, front):
+        """Test extended clients get their properties back"""
+        front.process_message([b"C1", b"", C_CLIENT_EXT, b"mmi.shards",
+                               b"id", b"1", b"", b""])
+        msg = front.socket.send_multipart.call_args[0][0]
+        assert msg[:7] == [b"C1", b"", C_CLIENT_EXT, b"mmi.shards",
+                           b"id", b"1", b""]
+        assert json.loads(msg[8].decode("utf-8")) == ENDPOINTS
+
+    def test_forward_requests(self, front, proxies):
+        """Test requests go to the shard owning the service, MMI requests
+        to the shard owning the service asked about
+        """
+        owner = shard_for(b"echo", 4)
+        front.process_message([b"C1", b"", C_CLIENT_EXT, b"echo",
+                               b"id", b"1", b"", b"hello"])
+        front.process_message([b"C1", b"", C_CLIENT, b"mmi.service",
+                               b"echo"])
+        front.proxy.assert_called_with(b"C1", owner)
+        assert sent(proxies[owner]) == [
+            b"", C_CLIENT_EXT, b"echo", b"id", b"1", b"", b"hello",
+            b"", C_CLIENT, b"mmi.service", b"echo",
+        ]
+        assert sum(proxy.send.call_count for proxy in proxies) == 11
+
+    def test_forward_workers(self, front, proxies):
+        """Test workers stay with the shard owning their service"""
+        owner = shard_for(b"echo", 4)
+        front.process_message([b"W1", b"", W_WORKER, W_READY, b"echo"])
+        front.process_message([b"W1", b"", W_WORKER, W_HEARTBEAT])
+        assert sent(proxies[owner]) == [
+            b"", W_WORKER, W_READY, b"echo", b"", W_WORKER, W_HEARTBEAT
+        ]
+        assert front.workers == {b"W1": owner}
+
+        # Unknown workers go to any shard, to be told to reconnect
+        front.process_message([b"W2", b"", W_WORKER, W_HEARTBEAT])
+        front.proxy.assert_called_with(b"W2", shard_for(b"W2", 4))
+
+    def test_invalid(self, front, proxies):
+        """Test messages with an unknown header are dropped"""
+        front.process_message([b"C1", b"", b"XXX", b"echo"])
+        assert front.proxy.call_count == 0
+
+    def test_replies(self, front):
+        """Test shard messages go back to the peer their DEALER is for,
+        and a worker's DEALER closes once it is told to reconnect
+        """
+        front.process_message([b"W1", b"", W_WORKER, W_READY, b"echo"])
+        proxy = front.proxies[(b"W1", shard_for(b"echo", 4))]
+        front.process_reply(proxy, [b"", W_WORKER, W_REQUEST, b"C1", b"",
+                                    b"hello"])
+        assert sent(front.socket) == [b"W1", b"", W_WORKER, W_REQUEST,
+                                      b"C1", b"", b"hello"]
+        front.process_reply(proxy, [b"", W_WORKER, W_DISCONNECT])
+        assert proxy.closed
+        assert not front.proxies and not front.peers and not front.workers
+
+    def test_purge_proxies(self, front):
+        """Test DEALERs of peers gone quiet are closed"""
+        old = front.proxy(b"C1", 0)
+        new = front.proxy(b"C2", 0)
+        front.peers[old][2] = time.time() - front.proxy_ttl - 1
+        front.purge_proxies()
+        assert old.closed and not new.closed
+        assert list(front.proxies) == [(b"C2", 0)]
+
+
+class TestShardedClient():
+    def test_routes_by_service(self):
+        """Test requests go straight to the shard owning the service"""
+        with patch("mdbase.shard.resolve_shards", return_value=ENDPOINTS):
+            client = ShardedClient("tcp://localhost:5555")
+        assert [c.broker for c in client.clients] == ENDPOINTS
+        for c in client.clients:
+            c.send = Mock(return_value=[b"world"])
+        owner = client.clients[shard_for(b"echo", 4)]
+        assert client.send(b"echo", b"hello") == [b"world"]
+        owner.send.assert_called_with(b"echo", b"hello", None)
+        client.send(b"mmi.service", b"echo")
+        owner.send.assert_called_with(b"mmi.service", b"echo", None)
+        assert sum(c.send.call_count for c in client.clients) == 2
+        client.destroy()
+
+    def test_no_directory(self):
+        """Test a client without shard endpoints fails to start"""
+        with patch("mdbase.shard.resolve_shards", return_value=None):
+            with pytest.raises(ShardsUnavailable):
+                ShardedClient("tcp://localhost:5555")
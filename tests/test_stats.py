@@ -0,0 +1,63 @@
+from mdbase.stats import HedgeStats, Histogram, ServiceStats
+
+
+class TestHistogram():
+    def test_empty(self):
+        """Test summary of an empty histogram"""
+        h = Histogram()
+        assert h.count == 0
+        assert h.percentile(99) == 0.0
+        assert h.summary()["mean"] == 0.0
+
+    def test_record(self):
+        """Test recording values and reading percentiles"""
+        h = Histogram()
+        for i in range(99):
+            h.record(0.001)
+        h.record(1.0)
+        assert h.count == 100
+        assert h.max == 1.0
+        # within a factor of two of the recorded value
+        assert 0.001 <= h.percentile(50) < 0.002
+        assert 0.001 <= h.percentile(99) < 0.002
+        assert h.percentile(100) == 1.0
+
+    def test_record_extremes(self):
+        """Test zero and very large values land in the end buckets"""
+        h = Histogram()
+        h.record(0)
+        h.record(1e9)
+        assert h.buckets[0] == 1
+        assert h.buckets[-1] == 1
+
+    def test_decay(self):
+        """Test decay halves counts so recent values dominate"""
+        h = Histogram()
+        for i in range(4):
+            h.record(0.001)
+        h.decay()
+        assert h.count == 2
+        assert h.total == 0.002
+
+
+class TestServiceStats():
+    def test_summary(self):
+        """Test service stats summary"""
+        stats = ServiceStats()
+        stats.requests += 1
+        stats.queue_time.record(0.5)
+        summary = stats.summary()
+        assert summary["requests"] == 1
+        assert summary["queue_time"]["count"] == 1
+        assert summary["service_time"]["count"] == 0
+
+
+class TestHedgeStats():
+    def test_record_window(self):
+        """Test latencies decay once a window has been recorded"""
+        stats = HedgeStats()
+        for i in range(stats.WINDOW):
+            stats.record(1.0)
+        stats.record(0.001)
+        assert stats.latency.count == stats.WINDOW // 2 + 1
+        assert stats.summary()["latency"]["count"] == stats.latency.count
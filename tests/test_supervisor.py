@@ -0,0 +1,114 @@
+import json
+import pytest
+
+from mock import Mock
+
+from mdbase.supervisor import Pool, Supervisor, serve
+
+
+@pytest.fixture
+def supervisor():
+    s = Supervisor("tcp://localhost:6666", interval=100)
+    yield s
+    s.ctx.destroy(0)
+
+
+@pytest.fixture
+def pool():
+    p = Mock(spec=Pool)
+    p.service = b"echo"
+    p.grow.side_effect = lambda count: count
+    p.shrink.side_effect = lambda count: count
+    p.pending_stops.return_value = 0
+    p.reap.return_value = 0
+    p.__len__ = Mock(return_value=2)
+    return p
+
+
+def info(requests, waiting, workers=2):
+    return {"requests": requests, "waiting": waiting, "workers": workers}
+
+
+class TestSupervisor():
+    def test_instantiate(self, supervisor):
+        """Test supervisor shares its context with its client"""
+        assert supervisor.client.ctx is supervisor.ctx
+        assert supervisor.client.timeout == 100
+        assert supervisor.pools == {}
+
+    def test_scale_up(self, supervisor, pool):
+        """Test pool grows by the backlog when no worker is idle"""
+        assert supervisor.scale(pool, info(5, 0)) == 5
+        pool.grow.assert_called_with(5)
+
+    def test_scale_down(self, supervisor, pool):
+        """Test pool shrinks one at a time while workers sit idle"""
+        assert supervisor.scale(pool, info(0, 3)) == -1
+        pool.shrink.assert_called_with(1)
+
+    def test_scale_down_pending(self, supervisor, pool):
+        """Test workers already stopping count against idle workers"""
+        pool.pending_stops.return_value = 2
+        assert supervisor.scale(pool, info(0, 3)) == 0
+        assert pool.shrink.call_count == 0
+
+    def test_scale_steady(self, supervisor, pool):
+        """Test busy pools with a short queue are left alone"""
+        assert supervisor.scale(pool, info(3, 1)) == 0
+        assert supervisor.scale(pool, info(0, 1)) == 0
+        assert supervisor.scale(pool, None) == 0
+
+    def test_scale_replaces_dead(self, supervisor, pool):
+        """Test workers that died are replaced whatever the queue"""
+        pool.reap.return_value = 2
+        assert supervisor.scale(pool, None) == 0
+        pool.grow.assert_called_with(2)
+
+    def test_queue_info(self, supervisor):
+        """Test reading mmi.workers from the broker"""
+        counts = info(1, 0)
+        supervisor.client.send = Mock(
+            return_value=[b"200", json.dumps(counts).encode("utf-8")]
+        )
+        assert supervisor.queue_info(b"echo") == counts
+        supervisor.client.send.assert_called_with(b"mmi.workers", b"echo")
+        supervisor.client.send.return_value = [b"404"]
+        assert supervisor.queue_info(b"echo") is None
+
+
+class TestPool():
+    def test_limits(self):
+        """Test pools stay between their min and max size"""
+        p = Pool(None, "tcp://localhost:6666", b"echo", None, 1, 2)
+        p.members = [Mock(), Mock()]
+        assert p.grow(3) == 0
+        assert p.shrink(3) == 1
+        assert len(p) == 1
+        assert len(p.stopping) == 1
+        p.stopping[0].alive.return_value = False
+        assert p.pending_stops() == 0
+
+    def test_reap(self):
+        """Test dead workers stop counting against max_workers"""
+        p = Pool(None, "tcp://localhost:6666", b"echo", None, 1, 2)
+        dead, live = Mock(), Mock()
+        dead.alive.return_value = False
+        p.members = [dead, live]
+        assert p.reap() == 1
+        assert p.members == [live]
+
+
+def test_serve_handler_fails():
+    """Test a raising handler is answered 500 and the worker carries on"""
+    worker = Mock()
+    worker.recv.side_effect = [[b"boom"], [b"hello"], None]
+
+    def handler(request):
+        if request == [b"boom"]:
+            raise ValueError("boom")
+        return [b"world"]
+
+    serve(worker, handler)
+    assert [call[0][0] for call in worker.recv.call_args_list] == \
+        [None, [b"500"], [b"world"]]
+    worker.close.assert_called_with()
@@ -0,0 +1,191 @@
+import threading
+import time
+from uuid import uuid4
+
+import zmq
+
+from mock import Mock
+
+from mdbase.broker import MajorDomoBroker, W_READY
+from mdbase.circuit import ServiceGuard, ServiceUnavailable
+from mdbase.client_sync import MajorDomoClient
+from mdbase.titanic import PendingQueue, service_success
+from mdbase.titanic_store import FileStore, SegmentStore
+
+UUID = b"0123456789abcdef0123456789abcdef"
+OTHER = b"fedcba9876543210fedcba9876543210"
+
+
+def test_service_success(tmpdir):
+    """Test a stored request is sent and its reply stored"""
+    store = SegmentStore(str(tmpdir))
+    store.store_request(UUID, [b"echo", b"hello"])
+    client = Mock()
+    client.send.return_value = [b"hello"]
+    assert service_success(client, store, UUID)
+    client.send.assert_called_with(b"echo", [b"hello"])
+    assert store.fetch_reply(UUID) == [b"hello"]
+    other = Mock()
+    assert service_success(client, other, UUID, attempts=3)
+    other.store_reply.assert_called_with(UUID, [b"hello"], 3)
+
+    # No reply, or no service, leaves the request pending
+    store.forget(UUID)
+    store.store_request(UUID, [b"echo", b"hello"])
+    client.send.return_value = None
+    assert not service_success(client, store, UUID)
+    client.send.side_effect = ServiceUnavailable(b"echo")
+    assert not service_success(client, store, UUID)
+    assert store.fetch_reply(UUID) is None
+    store.close()
+
+
+def test_service_success_rejected(tmpdir):
+    """Test a request the broker refuses stays pending and counts as a
+    failure for the service
+    """
+    broker = MajorDomoBroker()
+    broker.set_queue_limits(b"echo", max_requests=0)
+    # A worker, so mmi.service finds echo and the broker gets to refuse
+    broker.process_worker(b"W1", [W_READY, b"echo"])
+    client = MajorDomoClient("tcp://localhost:6666")
+    client.retries = 1
+    # Wire the client straight to the broker
+    replies = []
+    broker.socket.send_multipart = lambda msg: replies.append(msg[1:])
+    client.client = Mock()
+    client.client.send_multipart = lambda msg: broker.process_message(
+        [b"C1"] + msg
+    )
+    client.client.recv_multipart = lambda *args, **kwargs: replies.pop(0)
+    client.poller = Mock()
+    client.poller.poll.side_effect = lambda timeout: (
+        [(client.client, zmq.POLLIN)] if replies else []
+    )
+    guard = ServiceGuard(client, threshold=1)
+
+    store = SegmentStore(str(tmpdir))
+    store.store_request(UUID, [b"echo", b"hello"])
+    assert not service_success(guard, store, UUID)
+    assert store.fetch_reply(UUID) is None
+    assert guard.circuits[b"echo"].failures == 1
+    assert broker.services[b"echo"].stats.rejected == 1
+    store.close()
+    client.destroy()
+    broker.ctx.destroy(0)
+
+
+def test_service_success_closed(tmpdir):
+    """Test a request the client already closed counts as done"""
+    store = SegmentStore(str(tmpdir))
+    client = Mock()
+    assert service_success(client, store, UUID)
+    assert not client.send.called
+    store.close()
+
+
+def settle(queue):
+    """Wait for the requests in flight to finish"""
+    end = time.time() + 5
+    while queue.dispatching and time.time() < end:
+        time.sleep(0.01)
+
+
+def test_pending_queue(tmpdir):
+    """Test the queue log is replayed once, and only pending work kept"""
+    filename = str(tmpdir.join("queue"))
+    store = SegmentStore(str(tmpdir.join("store")))
+    client = Mock()
+    client.send.side_effect = lambda service, request: (
+        None if service == b"down" else request
+    )
+    queue = PendingQueue(filename, store, client, workers=1)
+    for uuid, service in ((UUID, b"down"), (OTHER, b"up")):
+        store.store_request(uuid, [service, b"hello"])
+        queue.add(uuid, service)
+    settle(queue)
+    assert store.fetch_reply(OTHER) == [b"hello"]
+    assert list(queue.queues) == [b"down"]
+    assert queue.paused == set([b"down"])
+    queue.close()
+
+    # Restart sees only the pending request, and rewrites the log
+    queue = PendingQueue(filename, store, client)
+    assert list(queue.queues[b"down"]) == [UUID]
+    assert len(queue) == 1
+    with open(filename, 'rb') as f:
+        assert f.read() == b"-" + UUID + b"\n"
+    queue.close()
+    store.close()
+
+
+def test_pending_queue_services(tmpdir):
+    """Test a slow service holds up only itself, within its limit"""
+    store = SegmentStore(str(tmpdir.join("store")))
+    release = threading.Event()
+
+    def send(service, request):
+        if service == b"slow":
+            release.wait(5)
+        return request
+    client = Mock()
+    client.send.side_effect = send
+
+    queue = PendingQueue(
+        str(tmpdir.join("queue")), store, client, workers=4, service_limit=2
+    )
+    slow = [uuid4().hex.encode("ascii") for i in range(4)]
+    for uuid in slow:
+        store.store_request(uuid, [b"slow", b"hello"])
+        queue.add(uuid, b"slow")
+    fast = uuid4().hex.encode("ascii")
+    store.store_request(fast, [b"fast", b"hello"])
+    queue.add(fast, b"fast")
+
+    end = time.time() + 5
+    while store.fetch_reply(fast) is None and time.time() < end:
+        time.sleep(0.01)
+    assert store.fetch_reply(fast) == [b"hello"]
+    assert queue.inflight == {b"slow": 2}
+    assert len(queue.queues[b"slow"]) == 2
+
+    release.set()
+    end = time.time() + 5
+    while len(queue) and time.time() < end:
+        time.sleep(0.01)
+    queue.close()
+    assert len(queue) == 0
+    assert all(store.fetch_reply(uuid) == [b"hello"] for uuid in slow)
+    store.close()
+
+
+def test_pending_queue_lost_entry(tmpdir):
+    """Test a stored request missing from the log is still dispatched"""
+    store = SegmentStore(str(tmpdir.join("store")))
+    store.store_request(UUID, [b"echo", b"hello"])
+    queue = PendingQueue(str(tmpdir.join("queue")), store, Mock())
+    assert list(queue.queues[b"echo"]) == [UUID]
+    queue.close()
+    store.close()
+
+
+def test_pending_queue_damaged(tmpdir):
+    """Test a damaged request neither stops Titanic starting nor holds up
+    its service
+    """
+    store = FileStore(str(tmpdir.join("store")))
+    store.store_request(UUID, [b"echo", b"hello"])
+    store.store_request(OTHER, [b"echo", b"world"])
+    with open(store.request_filename(UUID), "r+b") as f:
+        f.seek(-1, 2)
+        f.write(b"X")
+    client = Mock()
+    client.send.side_effect = lambda service, request: request
+    queue = PendingQueue(str(tmpdir.join("queue")), store, client)
+    queue.dispatch()
+    settle(queue)
+    assert len(queue) == 0
+    assert store.fetch_reply(OTHER) == [b"world"]
+    assert not store.has_request(UUID)
+    queue.close()
+    store.close()
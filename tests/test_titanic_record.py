@@ -0,0 +1,56 @@
+import pickle
+
+import pytest
+
+from mdbase import titanic_record
+from mdbase.titanic_record import RecordError
+
+FRAMES = [b"hello", b"", b"x" * 1000]
+
+
+class TestRecord():
+    def test_round_trip(self):
+        """Test frames, service and header fields survive encoding"""
+        data = titanic_record.encode(
+            FRAMES, service=b"echo", created=1.5, attempts=3
+        )
+        record = titanic_record.decode(data)
+        assert record.frames == FRAMES
+        assert record.service == b"echo"
+        assert record.created == 1.5
+        assert record.attempts == 3
+        assert titanic_record.decode(titanic_record.encode([])).frames == []
+
+    def test_seek(self):
+        """Test the service and single frames are read without decoding"""
+        data = titanic_record.encode(FRAMES, service=b"echo")
+        assert titanic_record.service(data) == b"echo"
+        for index, frame in enumerate(FRAMES):
+            assert titanic_record.frame(data, index) == frame
+        with pytest.raises(IndexError):
+            titanic_record.frame(data, 3)
+
+    def test_damaged(self):
+        """Test corrupt, truncated and foreign data is rejected"""
+        data = titanic_record.encode(FRAMES, service=b"echo", check_body=True)
+        corrupt = data[:-1] + b"y"
+        for damaged in (corrupt, data[:-1], data + b"z", data[:10],
+                        b"XX" + data[2:], pickle.dumps(FRAMES)):
+            with pytest.raises(RecordError):
+                titanic_record.decode(damaged)
+        future = data[:2] + b"\x03" + data[3:]
+        with pytest.raises(RecordError):
+            titanic_record.service(future)
+
+    def test_header_only(self):
+        """Test records that don't check their body still check the rest"""
+        data = titanic_record.encode(FRAMES, service=b"echo")
+        assert titanic_record.decode(data).frames == FRAMES
+        start = data.index(b"echo")
+        for damaged in (data[:start] + b"ECHO" + data[start + 4:],
+                        data[:-1], data + b"z"):
+            with pytest.raises(RecordError):
+                titanic_record.decode(damaged)
+        # Damage to the frames goes unnoticed
+        corrupt = data[:-1] + b"y"
+        assert bytes(titanic_record.decode(corrupt).frames[-1])[-1:] == b"y"
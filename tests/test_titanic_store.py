@@ -0,0 +1,272 @@
+import os
+import pickle
+import threading
+from uuid import uuid4
+
+import pytest
+
+from mock import patch
+
+from mdbase.titanic_store import (FileStore, SegmentStore, SYNC_NONE,
+                                  SYNC_GROUP, SYNC_MESSAGE)
+
+UUID = b"0123456789abcdef0123456789abcdef"
+OTHER = b"fedcba9876543210fedcba9876543210"
+
+
+@pytest.fixture(params=[FileStore, SegmentStore])
+def store(request, tmpdir):
+    s = request.param(str(tmpdir.join("titanic")))
+    yield s
+    s.close()
+
+
+def segments(store):
+    return sorted(n for n in os.listdir(store.directory) if n.endswith(".seg"))
+
+
+class TestStore():
+    def test_request_reply(self, store):
+        """Test requests and replies are stored by UUID"""
+        assert store.fetch_request(UUID) is None
+        assert not store.has_request(UUID)
+        store.store_request(UUID, [b"echo", b"hello"])
+        assert store.has_request(UUID)
+        assert store.fetch_request(UUID) == [b"echo", b"hello"]
+        assert store.fetch_reply(UUID) is None
+        store.store_reply(UUID, [b"hello"])
+        assert store.fetch_reply(UUID) == [b"hello"]
+        assert store.fetch_request(OTHER) is None
+
+    def test_forget(self, store):
+        """Test forget drops the request and reply, and tolerates repeats"""
+        store.store_request(UUID, [b"echo", b"hello"])
+        store.store_reply(UUID, [b"hello"])
+        store.store_request(OTHER, [b"echo", b"world"])
+        store.forget(UUID)
+        store.forget(UUID)
+        assert not store.has_request(UUID)
+        assert store.fetch_reply(UUID) is None
+        assert store.fetch_request(OTHER) == [b"echo", b"world"]
+
+    def test_unanswered(self, store):
+        """Test requests without a reply are listed"""
+        store.store_request(UUID, [b"echo", b"hello"])
+        store.store_request(OTHER, [b"echo", b"world"])
+        store.store_reply(OTHER, [b"world"])
+        assert store.unanswered() == [UUID]
+
+    @pytest.mark.parametrize("uuid", [
+        b"", b"xyz", b"0123", b"0123456789abcdef0123456789abcdeg",
+        b"../../../../etc/passwd", UUID + b"00",
+    ])
+    def test_malformed_uuid(self, store, uuid):
+        """Test a malformed UUID from a client is an unknown request"""
+        store.store_request(UUID, [b"echo", b"hello"])
+        assert not store.has_request(uuid)
+        assert store.fetch_request(uuid) is None
+        assert store.request_service(uuid) is None
+        assert store.fetch_reply(uuid) is None
+        store.forget(uuid)
+        assert store.has_request(UUID)
+
+
+class TestFileStore():
+    def test_damaged_files(self, tmpdir):
+        """Test torn and pickled files are moved aside and read as missing"""
+        store = FileStore(str(tmpdir.join("titanic")))
+        store.store_request(UUID, [b"echo", b"hello"])
+        store.store_request(OTHER, [b"echo", b"world"])
+        store.store_reply(OTHER, [b"world"])
+        with open(store.request_filename(UUID), "r+b") as f:
+            f.truncate(10)
+        with open(store.reply_filename(OTHER), "wb") as f:
+            pickle.dump([b"world"], f, 2)
+
+        assert store.request_service(UUID) is None
+        assert store.fetch_request(UUID) is None
+        assert not store.has_request(UUID)
+        assert store.fetch_reply(OTHER) is None
+        assert store.fetch_request(OTHER) == [b"echo", b"world"]
+        assert store.unanswered() == [OTHER]
+        assert sorted(os.listdir(store.directory)) == [
+            UUID.decode("ascii") + ".req.damaged",
+            OTHER.decode("ascii") + ".reo.damaged",
+            OTHER.decode("ascii") + ".req",
+        ]
+
+    @pytest.mark.parametrize("sync,fsyncs", [
+        (SYNC_NONE, 0), (SYNC_GROUP, 1), (SYNC_MESSAGE, 1),
+    ])
+    def test_sync_directory(self, tmpdir, sync, fsyncs):
+        """Test the directory is fsynced after a file is created in it"""
+        store = FileStore(str(tmpdir.join("titanic")), sync=sync)
+        with patch("mdbase.titanic_store.fsync_directory") as fsync:
+            store.store_request(UUID, [b"echo", b"hello"])
+        assert fsync.call_count == fsyncs
+        if fsyncs:
+            fsync.assert_called_with(store.directory)
+
+
+class TestSegmentStore():
+    def test_recover(self, tmpdir):
+        """Test the index is rebuilt from the segments on reopen"""
+        directory = str(tmpdir.join("titanic"))
+        store = SegmentStore(directory)
+        store.store_request(UUID, [b"echo", b"hello"])
+        store.store_request(OTHER, [b"echo", b"world"])
+        store.store_reply(OTHER, [b"world"])
+        store.forget(UUID)
+        store.close()
+
+        store = SegmentStore(directory)
+        assert not store.has_request(UUID)
+        assert store.fetch_request(OTHER) == [b"echo", b"world"]
+        assert store.fetch_reply(OTHER) == [b"world"]
+        store.close()
+
+    def test_torn_tail(self, tmpdir):
+        """Test a partly written last record is dropped on recovery"""
+        directory = str(tmpdir.join("titanic"))
+        store = SegmentStore(directory)
+        store.store_request(UUID, [b"echo", b"hello"])
+        store.close()
+        path = os.path.join(directory, segments(store)[-1])
+        size = os.path.getsize(path)
+        with open(path, "ab") as f:
+            f.write(SegmentStore.HEADER.pack(1, b"\0" * 16, 100) + b"partial")
+
+        store = SegmentStore(directory)
+        assert os.path.getsize(path) == size
+        assert store.fetch_request(UUID) == [b"echo", b"hello"]
+        store.store_request(OTHER, [b"echo", b"world"])
+        assert store.fetch_request(OTHER) == [b"echo", b"world"]
+        store.close()
+
+    def test_damaged_record(self, tmpdir):
+        """Test a record that fails its checksum is skipped on recovery"""
+        directory = str(tmpdir.join("titanic"))
+        store = SegmentStore(directory)
+        store.store_request(UUID, [b"echo", b"hello"])
+        store.store_request(OTHER, [b"echo", b"world"])
+        store.close()
+        path = os.path.join(directory, segments(store)[-1])
+        with open(path, "r+b") as f:
+            data = f.read()
+            f.seek(data.index(b"hello"))
+            f.write(b"HELLO")
+
+        store = SegmentStore(directory)
+        assert not store.has_request(UUID)
+        assert store.fetch_request(OTHER) == [b"echo", b"world"]
+        assert store.request_service(OTHER) == b"echo"
+        store.close()
+
+    def test_roll_and_drop(self, tmpdir):
+        """Test full segments are sealed, and deleted oldest first once dead"""
+        store = SegmentStore(str(tmpdir.join("titanic")), segment_size=64)
+        store.store_request(UUID, [b"echo", b"x" * 40])
+        with patch("mdbase.titanic_store.fsync_directory") as fsync:
+            store.store_request(OTHER, [b"echo", b"y" * 40])
+        assert len(segments(store)) == 2
+        fsync.assert_called_once_with(store.directory)
+        assert store.fetch_request(UUID) == [b"echo", b"x" * 40]
+
+        # The first segment is dead and goes, the second still holds OTHER
+        store.forget(UUID)
+        assert len(segments(store)) == 2
+        assert store.segments[0].number == 1
+        assert store.fetch_request(OTHER) == [b"echo", b"y" * 40]
+        store.close()
+
+    def test_compact(self, tmpdir):
+        """Test a request never closed doesn't keep dead segments on disk"""
+        directory = str(tmpdir.join("titanic"))
+        store = SegmentStore(directory, segment_size=256)
+        store.store_request(UUID, [b"echo", b"x" * 40])
+        for i in range(50):
+            uuid = uuid4().hex.encode("ascii")
+            store.store_request(uuid, [b"echo", b"y" * 40])
+            store.store_reply(uuid, [b"y" * 40])
+            store.forget(uuid)
+        assert len(segments(store)) <= 3
+        assert store.fetch_request(UUID) == [b"echo", b"x" * 40]
+        store.close()
+
+        store = SegmentStore(directory, segment_size=256)
+        assert store.fetch_request(UUID) == [b"echo", b"x" * 40]
+        assert store.unanswered() == [UUID]
+        store.close()
+
+    def test_compact_live_segment(self, tmpdir):
+        """Test a mostly live segment isn't copied to free a little"""
+        store = SegmentStore(str(tmpdir.join("titanic")), segment_size=256)
+        uuids = [uuid4().hex.encode("ascii") for i in range(4)]
+        for uuid in uuids:
+            store.store_request(uuid, [b"echo", b"x" * 40])
+        store.store_request(UUID, [b"echo", b"z" * 40])
+        assert len(segments(store)) == 3
+        written = store.written
+        # The second segment dies, but copying the first would cost more
+        # than compact_ratio of what it frees
+        store.forget(uuids[2])
+        store.forget(uuids[3])
+        assert store.segments[1].live == 0
+        assert store.written == written + 2 # Just the tombstones
+        assert len(segments(store)) == 3
+        store.close()
+
+    def test_compact_bounded(self, tmpdir):
+        """Test each call copies at most compact_bytes"""
+        store = SegmentStore(str(tmpdir.join("titanic")), segment_size=256)
+        store.compact_bytes = 1
+        first, second = [uuid4().hex.encode("ascii") for i in range(2)]
+        store.store_request(first, [b"echo", b"x" * 40])
+        store.store_request(second, [b"echo", b"x" * 40])
+        store.compact_ratio = 1.0
+        uuid = uuid4().hex.encode("ascii")
+        store.store_request(uuid, [b"echo", b"y" * 40])
+        written = store.written
+        store.forget(uuid)
+        # The tombstone and one moved record, the segment stays for now
+        assert store.written == written + 2
+        assert store.segments[0].number == 0
+        uuid = uuid4().hex.encode("ascii")
+        store.store_request(uuid, [b"echo", b"y" * 40])
+        store.forget(uuid)
+        assert store.segments[0].number > 0
+        assert store.fetch_request(first) == [b"echo", b"x" * 40]
+        assert store.fetch_request(second) == [b"echo", b"x" * 40]
+        store.close()
+
+    @pytest.mark.parametrize("sync,fsyncs", [
+        (SYNC_NONE, 0), (SYNC_MESSAGE, 10), (SYNC_GROUP, 10),
+    ])
+    def test_sync(self, tmpdir, sync, fsyncs):
+        """Test each store call fsyncs as the sync mode asks"""
+        store = SegmentStore(str(tmpdir), sync=sync)
+        with patch("os.fsync", wraps=os.fsync) as fsync:
+            for i in range(10):
+                store.store_request(uuid4().hex.encode("ascii"), [b"x"])
+        assert fsync.call_count == fsyncs
+        assert store.durable == (0 if sync == SYNC_NONE else 10)
+        store.close()
+
+    def test_group_commit(self, tmpdir):
+        """Test threads storing at once share fsyncs"""
+        store = SegmentStore(str(tmpdir), sync=SYNC_GROUP)
+        store.group_window = 50
+        store.group_size = 8
+
+        def intake():
+            for i in range(20):
+                store.store_request(uuid4().hex.encode("ascii"), [b"x"])
+        threads = [threading.Thread(target=intake) for i in range(8)]
+        with patch("os.fsync", wraps=os.fsync) as fsync:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert store.durable == store.written == 160
+        assert fsync.call_count < 160
+        store.close()
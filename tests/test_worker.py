@@ -1,6 +1,10 @@
+import time
+
 import pytest
 import zmq
 
+from mock import Mock
+
 from mdbase import constants
 from mdbase.broker import MajorDomoBroker
 from mdbase.worker import MajorDomoWorker
@@ -36,3 +40,69 @@ class TestMajorDomoWorker():
         """Test reconnecting to broker"""
         b = MajorDomoBroker(False)
         w = MajorDomoWorker(broker_url, b"echo", False)
+
+    def test_shared_context_stop(self, broker_url):
+        """Test worker on a shared context stops and closes cleanly"""
+        ctx = zmq.Context()
+        w = MajorDomoWorker(broker_url, b"echo", ctx=ctx)
+        assert w.ctx is ctx
+        w.stop()
+        assert w.recv() is None
+        w.close()
+        assert w.worker.closed
+        ctx.destroy(0)
+
+    def test_recv_deadline(self, broker_url):
+        """Test expired requests are answered 504, marked as expired, others
+        get a deadline
+        """
+        ctx = zmq.Context()
+        w = MajorDomoWorker(broker_url, b"echo", ctx=ctx)
+        socket = w.worker
+        sent = []
+        socket.send_multipart = sent.append
+        w.poller = Mock()
+        w.poller.poll.return_value = [(socket, zmq.POLLIN)]
+        socket.recv_multipart = Mock(side_effect=[
+            [b"", constants.W_WORKER, constants.W_REQUEST,
+             b"C1", b"timeout", b"0", b"", b"late"],
+            [b"", constants.W_WORKER, constants.W_REQUEST,
+             b"C2", b"timeout", b"5000", b"", b"hello"],
+        ])
+        assert w.recv() == [b"hello"]
+        assert sent[-1] == [b"", constants.W_WORKER, constants.W_REPLY,
+                            b"C1", b"timeout", b"0", constants.C_STATUS,
+                            constants.EXPIRED, b"", b"504"]
+        assert 4 < w.remaining() <= 5
+        assert not w.expired()
+        w.worker.close()
+        ctx.destroy(0)
+
+    def test_recv_deadline_credit(self, broker_url):
+        """Test time a request waited here behind others counts against
+        its timeout
+        """
+        ctx = zmq.Context()
+        w = MajorDomoWorker(broker_url, b"echo", credit=3, ctx=ctx)
+        socket = w.worker
+        sent = []
+        socket.send_multipart = sent.append
+        w.poller = Mock()
+        w.poller.poll.return_value = [(socket, zmq.POLLIN)]
+        now = int(1e3 * time.time())
+        socket.recv_multipart = Mock(side_effect=[
+            # Sent a second ago, while the handler ran
+            [b"", constants.W_WORKER, constants.W_REQUEST, b"C1",
+             b"timeout", b"500", b"dispatched", b"%d" % (now - 1000),
+             b"", b"waited"],
+            [b"", constants.W_WORKER, constants.W_REQUEST, b"C2",
+             b"timeout", b"5000", b"dispatched", b"%d" % (now - 1000),
+             b"", b"hello"],
+        ])
+        assert w.recv() == [b"hello"]
+        assert sent[-1][3:] == [b"C1", b"timeout", b"500", b"dispatched",
+                                b"%d" % (now - 1000), constants.C_STATUS,
+                                constants.EXPIRED, b"", b"504"]
+        assert 3.5 < w.remaining() <= 4
+        w.worker.close()
+        ctx.destroy(0)
@@ -0,0 +1,168 @@
+import asyncio
+import pytest
+import time
+import zmq
+
+from mdbase import constants, worker_asyncio
+from mdbase.worker_asyncio import MajorDomoWorker
+
+
+@pytest.fixture
+def broker_url():
+    return "tcp://localhost:6666"
+
+
+async def echo(request):
+    return request
+
+
+def connected(worker):
+    """Connect worker, capturing what it sends to the broker"""
+    sent = []
+
+    def send_multipart(msg):
+        sent.append(msg)
+        future = asyncio.Future()
+        future.set_result(None)
+        return future
+
+    worker.slots = asyncio.Semaphore(worker.concurrency)
+    worker.reconnect_to_broker()
+    worker.worker.send_multipart = send_multipart
+    return sent
+
+
+class TestMajorDomoWorker():
+    def test_instantiate(self, broker_url):
+        """Test instantiating asyncio worker"""
+        w = MajorDomoWorker(broker_url, b"echo", echo, concurrency=5)
+        assert w.broker == broker_url
+        assert w.service == b"echo"
+        assert w.concurrency == 5
+        assert isinstance(w.ctx, zmq.asyncio.Context)
+        w.destroy()
+
+    def test_request_reply(self, broker_url):
+        """Test requests are handled and replied to concurrently"""
+        w = MajorDomoWorker(broker_url, b"echo", echo)
+
+        async def run():
+            sent = connected(w)
+            for client in (b"C1", b"C2"):
+                w.process([b"", constants.W_WORKER, constants.W_REQUEST,
+                           client, b"", b"hello"])
+            assert len(w.tasks) == 2
+            await asyncio.gather(*w.tasks)
+            return sent
+
+        sent = asyncio.run(run())
+        assert sent == [
+            [b"", constants.W_WORKER, constants.W_REPLY, client, b"", b"hello"]
+            for client in (b"C1", b"C2")
+        ]
+        w.destroy()
+
+    def test_request_properties(self, broker_url):
+        """Test request properties are echoed back with the reply"""
+        w = MajorDomoWorker(broker_url, b"echo", echo)
+
+        async def run():
+            sent = connected(w)
+            w.process([b"", constants.W_WORKER, constants.W_REQUEST,
+                       b"C1", b"id", b"7", b"", b"hello"])
+            await asyncio.gather(*w.tasks)
+            return sent
+
+        assert asyncio.run(run()) == [[
+            b"", constants.W_WORKER, constants.W_REPLY,
+            b"C1", b"id", b"7", b"", b"hello"
+        ]]
+        w.destroy()
+
+    def test_deadline(self, broker_url):
+        """Test handlers see the time left, expired requests get a 504"""
+        seen = []
+
+        async def handler(request):
+            seen.append(worker_asyncio.remaining())
+            return request
+
+        w = MajorDomoWorker(broker_url, b"echo", handler)
+
+        async def run():
+            sent = connected(w)
+            await w.handle([b"C1"], [b"hello"], w.generation,
+                           time.time() + 10)
+            await w.handle([b"C2"], [b"hello"], w.generation,
+                           time.time() - 1)
+            return sent
+
+        sent = asyncio.run(run())
+        assert len(seen) == 1 and 9 < seen[0] <= 10
+        assert sent[1][-5:] == [b"C2", constants.C_STATUS, constants.EXPIRED,
+                                b"", b"504"]
+        assert worker_asyncio.remaining() is None
+        w.destroy()
+
+    def test_deadline_dispatched(self, broker_url):
+        """Test time a request waited here counts against its timeout"""
+        w = MajorDomoWorker(broker_url, b"echo", echo, concurrency=3)
+        dispatched = b"%d" % (1e3 * time.time() - 1000)
+
+        async def run():
+            sent = connected(w)
+            w.process([b"", constants.W_WORKER, constants.W_REQUEST, b"C1",
+                       b"timeout", b"500", b"dispatched", dispatched, b"",
+                       b"hello"])
+            await asyncio.gather(*w.tasks)
+            return sent
+
+        sent = asyncio.run(run())
+        assert sent[0][-5:] == [dispatched, constants.C_STATUS,
+                                constants.EXPIRED, b"", b"504"]
+        w.destroy()
+
+    def test_stale_reply_dropped(self, broker_url):
+        """Test replies to requests from before a reconnect are dropped"""
+        w = MajorDomoWorker(broker_url, b"echo", echo)
+
+        async def run():
+            sent = connected(w)
+            await w.handle([b"C1"], [b"hello"], w.generation - 1)
+            return sent
+
+        assert asyncio.run(run()) == []
+        w.destroy()
+
+    def test_handler_failure(self, broker_url):
+        """Test a failing handler still replies so credit is returned"""
+        async def fail(request):
+            raise ValueError(request)
+
+        w = MajorDomoWorker(broker_url, b"echo", fail)
+
+        async def run():
+            sent = connected(w)
+            await w.handle([b"C1"], [b"hello"], w.generation)
+            return sent
+
+        assert asyncio.run(run())[0][-1] == b"500"
+        w.destroy()
+
+    @pytest.mark.parametrize("reply", [None, u"hello", [b"hello", 42]])
+    def test_handler_bad_reply(self, broker_url, reply):
+        """Test a handler returning something other than bytes is
+        answered 500
+        """
+        async def bad(request):
+            return reply
+
+        w = MajorDomoWorker(broker_url, b"echo", bad)
+
+        async def run():
+            sent = connected(w)
+            await w.handle([b"C1"], [b"hello"], w.generation)
+            return sent
+
+        assert asyncio.run(run())[0][-2:] == [b"", b"500"]
+        w.destroy()